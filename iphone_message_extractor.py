@@ -10,12 +10,68 @@ Simple CLI written in python to extract messages (SMS/iMessage) to CSV from iPho
 """
 
 import argparse
+import csv
+import getpass
 import os, re
+import sqlite3
+import sys
 
-from iphone_message_extractor.message_extractor import extract_messages
+from iphone_message_extractor import backup_index, batch, encryption, schema, search_index, \
+    split_output, util
+from iphone_message_extractor.compressed_output import COMPRESSIONS
+from iphone_message_extractor.instrumentation import Profiler, save_profile, format_report, \
+    report_path_for_output
+from iphone_message_extractor.message_extractor import extract_messages, ENGINES, OUTPUT_FORMATS
+from iphone_message_extractor.phone_db import MessageDB, MessageFilter
+
+def search(argv):
+    """ The search subcommand: searches an export written with -f sqlite and prints the matching
+    messages as CSV """
+    parser = argparse.ArgumentParser(prog="iphone_message_extractor.py search",
+                                     description="Searches messages exported with -f sqlite")
+    parser.add_argument("db_path", help="The path to the export")
+    parser.add_argument("text", nargs='?', help="Text to search for (SQLite full-text query \
+                                                 syntax, e.g. 'ring', 'ring OR mordor' or \
+                                                 '\"mount doom\"')")
+    parser.add_argument("--contact", help="Part of a name, phone number or e-mail address")
+    parser.add_argument("--since", help="Only messages from this date on (YYYY-MM-DD or \
+                                         'YYYY-MM-DD HH:MM:SS')")
+    parser.add_argument("--until", help="Only messages up to and including this date")
+    parser.add_argument("-n", "--limit", type=int, help="The maximum number of messages to show")
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.db_path):
+        print("No export at {} (create one with -f sqlite)".format(args.db_path))
+        return
+    try:
+        rows = search_index.search_messages(args.db_path, args.text, args.contact, args.since,
+                                            args.until, args.limit)
+    except sqlite3.Error as e:
+        print("Search failed: {}".format(e))
+        return
+    writer = csv.writer(sys.stdout)
+    writer.writerow(search_index.SEARCH_HEADER_ROW)
+    writer.writerows(rows)
+
+def backup_selection(argv):
+    """ Works out how the backups to extract are picked, before the arguments are parsed for
+    real: by device hash (the device_hash positional argument, as always) or with a flag that
+    picks them instead (-a, --device-name), in which case there's no device_hash positional
+    argument. --list extracts nothing, so it takes neither positional argument
+    @return: the parsed flags (all, list, device_name)
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-a", "--all", action="store_true")
+    parser.add_argument("-l", "--list", action="store_true")
+    parser.add_argument("--device-name", action="append", default=[])
+    return parser.parse_known_args(argv)[0]
 
 def main():
 
+    if sys.argv[1:2] == ['search']:
+        return search(sys.argv[2:])
+    selection = backup_selection(sys.argv[1:])
+
     # Set up the arg parser with appropriate help text
     parser = argparse.ArgumentParser(description="Extracts messages (SMS/iMessage) to CSV from \
                                                  iPhone backups")
@@ -24,47 +80,334 @@ def main():
                             This can be found by going to iTunes > Preferences > Devices and right
                             clicking the backup you wish to extract and selecting 'Show in Finder'.
                             It will be 40 characters and look like 
-                            '9504c9835a9fcd2da71a23b42cd4e7c971a23842'
+                            '9504c9835a9fcd2da71a23b42cd4e7c971a23842'. Not given with -a,
+                            --device-name or --list
                             """
-    parser.add_argument("device_hash", help=device_hash_help_text) # nargs='+', 
-    parser.add_argument("output_path", help="The full output path to where you would like to store\
-                                             the CSV")
-    parser.add_argument("-v", "--verbose", help="Make output more verbose", action="store_true")
+    if selection.all or selection.list or selection.device_name:
+        parser.set_defaults(device_hash=None)
+    else:
+        parser.add_argument("device_hash", help=device_hash_help_text)
+    if not selection.list:
+        parser.add_argument("output_path", help="The full output path to where you would like to \
+                                                 store the CSV (a directory when extracting \
+                                                 several backups, in which case each gets its own \
+                                                 <device_hash>.csv). Not given with --list")
+    parser.add_argument("-v", "--verbose", help="Print a summary of where the time went (stage \
+                                                 and query timings, cache hit rates)",
+                        action="store_true")
     country_code_help_text = """
                              The country code to apply for phone numbers without them (defaults to
                              USA). For example, 555-555-5555 will become +1-555-555-5555. Numbers
                              with country codes (eg. +49-17-555-55555) will be unaffected.
                              """
     parser.add_argument("-c", "--country", help=country_code_help_text)
+    fallback_country_help_text = """
+                                 Another country code to try for numbers without one that aren't
+                                 valid in the country given by -c (e.g. the contacts of someone who
+                                 has moved from GB to the US). Repeat to try several, in order
+                                 """
+    parser.add_argument("--fallback-country", action="append", default=[],
+                        help=fallback_country_help_text)
     parser.add_argument("-d", "--backup-dir", help="Path to backup directory (if non-standard)")
+    batch_size_help_text = """
+                           The number of messages to read from the backup at a time (defaults to
+                           {}). Messages are streamed to the CSV in batches of this size, so memory
+                           use stays flat regardless of the size of the backup.
+                           """.format(MessageDB.DEFAULT_BATCH_SIZE)
+    parser.add_argument("-b", "--batch-size", type=int, default=MessageDB.DEFAULT_BATCH_SIZE,
+                        help=batch_size_help_text)
+    parser.add_argument("-a", "--all", help="Extract every backup under the backup directory \
+                                             (instead of giving a device hash)",
+                        action="store_true")
+    parser.add_argument("--device-hash", dest="extra_device_hashes", action="append", default=[],
+                        help="Another backup to extract along with device_hash, in one batch \
+                              (see -j). Can be given more than once")
+    parser.add_argument("-l", "--list", help="List the backups under the backup directory (device \
+                                              hash, name, iOS version, date of the last backup \
+                                              and whether it's encrypted)",
+                        action="store_true")
+    device_name_help_text = """
+                            Extract the backup of the device with this name (e.g. "Frodo's
+                            iPhone") instead of giving its device hash. Can be given more than once
+                            """
+    parser.add_argument("--device-name", action="append", default=[],
+                        help=device_name_help_text)
+    parser.add_argument("-j", "--workers", type=int, help="Number of backups to extract in \
+                                                           parallel in batch mode (defaults to \
+                                                           the number of CPUs)")
+    incremental_help_text = """
+                            Only append messages that are new since the last export to the same
+                            output path (the export is rebuilt from scratch if the names of people
+                            in it have changed in the address book)
+                            """
+    parser.add_argument("-i", "--incremental", help=incremental_help_text, action="store_true")
+    format_help_text = """
+                       The output format (defaults to csv). parquet and arrow write typed columns
+                       and require pyarrow to be installed. sqlite writes a database with a
+                       full-text index that the search subcommand can query (run
+                       '%(prog)s search -h' for details)
+                       """
+    parser.add_argument("-f", "--format", choices=sorted(OUTPUT_FORMATS), default='csv',
+                        help=format_help_text)
+    compress_help_text = """
+                         Compress the CSV as it's written (zstd needs the zstandard package). Name
+                         the output accordingly, e.g. messages.csv.gz
+                         """
+    parser.add_argument("--compress", choices=sorted(COMPRESSIONS), help=compress_help_text)
+    split_help_text = """
+                      Split the CSV into parts (<output_path minus .csv>.00001.csv, etc.) of at
+                      most this many messages. A manifest listing every part with its row count
+                      and SHA-256 is written to <output_path>.manifest.json
+                      """
+    parser.add_argument("--split-rows", type=int, help=split_help_text)
+    parser.add_argument("--split-size", help="Split the CSV into parts of about this size before \
+                                              compression, e.g. 500M or 2G")
+    parser.add_argument("--split-by", choices=split_output.SPLIT_BY,
+                        help="Start a new part for every contact (or conversation with --chats) \
+                              or every month")
+    parser.add_argument("--resume", help="Pick up a split export that was interrupted after its \
+                                          last complete part", action="store_true")
+    engine_help_text = """
+                       How to match messages to contacts (defaults to python). The sql engine
+                       does the matching inside SQLite, which is faster for large backups
+                       """
+    parser.add_argument("-e", "--engine", choices=ENGINES, default='python',
+                        help=engine_help_text)
+    cache_dir_help_text = """
+                          Where to cache Manifest.db lookups between runs (defaults to
+                          {})
+                          """.format(util.get_cache_dir())
+    parser.add_argument("--cache-dir", default=util.get_cache_dir(), help=cache_dir_help_text)
+    attachments_help_text = """
+                            Copy attachments (photos, videos, etc.) to this directory and add an
+                            Attachments column with their paths to the output. Identical files are
+                            only stored once, and rerunning picks up where an interrupted copy left
+                            off
+                            """
+    parser.add_argument("--attachments", help=attachments_help_text)
+    parser.add_argument("--attachment-workers", type=int, help="Number of threads to copy \
+                                                                attachments with")
+    parser.add_argument("--query-workers", type=int, help="Number of processes to query sms.db \
+                                                           and match messages to contacts with \
+                                                           (python engine only; defaults to 1)")
+    chats_help_text = """
+                      Order messages by conversation (including group chats) and add the chat,
+                      its name and its participants to each message
+                      """
+    parser.add_argument("--chats", help=chats_help_text, action="store_true")
+    parser.add_argument("--since", help="Only extract messages from this date on (YYYY-MM-DD or \
+                                         'YYYY-MM-DD HH:MM:SS', in --timezone)")
+    parser.add_argument("--until", help="Only extract messages up to and including this date")
+    contact_help_text = """
+                        Only extract messages with this contact: a phone number or e-mail address
+                        (with all of the contact's other numbers/addresses) or part of a name. Can
+                        be given more than once
+                        """
+    parser.add_argument("--contact", action="append", help=contact_help_text)
+    parser.add_argument("--service", choices=MessageFilter.SERVICES,
+                        help="Only extract messages sent over this service")
+    direction_group = parser.add_mutually_exclusive_group()
+    direction_group.add_argument("--from-me", dest="from_me", action="store_const", const=True,
+                                 help="Only extract messages you sent")
+    direction_group.add_argument("--not-from-me", dest="from_me", action="store_const",
+                                 const=False, help="Only extract messages you received")
+    tapbacks_help_text = """
+                         What to do with tapbacks (reactions like "Loved" or "Laughed at"), which
+                         are stored as messages of their own: keep them as messages (the
+                         default), skip them or fold them into a Reactions column of the message
+                         they react to
+                         """
+    parser.add_argument("--tapbacks", choices=schema.TAPBACKS, default='keep',
+                        help=tapbacks_help_text)
+    parser.add_argument("--timezone", help="Timezone to show dates in, e.g. UTC or \
+                                            Europe/London (defaults to local time)")
+    parser.add_argument("--date-format", default=util.DEFAULT_DATE_FORMAT,
+                        help="strftime format for dates in CSV output (defaults to \
+                              %%Y-%%m-%%d %%H:%%M:%%S)")
+    password_help_text = """
+                         Password for encrypted backups (you're asked for it if a backup is
+                         encrypted and this isn't given). Only the files needed are decrypted, into
+                         a temp directory that's removed afterwards
+                         """
+    parser.add_argument("--password", help=password_help_text)
+    profile_help_text = """
+                        Profile the export: stage and SQLite query timings, rows/sec and cache
+                        hit rates are saved to <output_path>.profile.json and summarized
+                        """
+    parser.add_argument("--profile", help=profile_help_text, action="store_true")
+    parser.add_argument("--profile-cpu", help="Also capture a cProfile of the export (saved to \
+                                               <output_path>.prof; implies --profile)",
+                        action="store_true")
+    parser.add_argument("--profile-memory", help="Also capture peak memory use and the top \
+                                                  allocation sites (implies --profile)",
+                        action="store_true")
     args = parser.parse_args()
 
     # Either take the path provided or use the defaults on macOS and Windows (path must
     # be provided for Linux)
     backup_dir = args.backup_dir or util.get_backup_dir()
     if backup_dir is None:
-        print("Can't guess the location of your backups; please specify a path with -p")
+        print("Can't guess the location of your backups; please specify a path with -d")
+        return
+
+    backups = None
+    if args.list or args.device_name:
+        if not os.path.isdir(backup_dir):
+            print("Backup directory doesn't exist: {}".format(backup_dir))
+            return
+        backups = backup_index.discover_backups(backup_dir, args.cache_dir)
+    if args.list:
+        print(backup_index.format_backup_list(backups))
+        return
+
+    if args.query_workers is not None and args.query_workers > 1 and args.engine != 'python':
+        print("--query-workers only works with the python engine")
         return
 
     # If a country code was provided, verify it makes sense
     country_code = args.country or 'US'
-    if not re.match(r"^[A-Z]{2}$", country_code):
+    if not all(re.match(r"^[A-Z]{2}$", code) for code in [country_code] + args.fallback_country):
         print("Invalid country code (must be 2 characters; e.g. GB for Great Britain)")
         return
 
-    # Check that the db path is in fact valid
-    device_hash = args.device_hash
-    backup_dir = os.path.join(backup_dir, args.device_hash)
-    if not os.path.exists(backup_dir):
-        print("Backup path isn't valid. Check path or device hash.")
+    try:
+        util.get_timezone(args.timezone)
+    except Exception:
+        print("Unknown timezone: {}".format(args.timezone))
+        return
+
+    try:
+        for date in (args.since, args.until):
+            if date is not None:
+                util.parse_date_bound(date)
+    except ValueError:
+        print("Invalid date (must be YYYY-MM-DD or 'YYYY-MM-DD HH:MM:SS')")
+        return
+
+    split_bytes = None
+    if args.split_size is not None:
+        try:
+            split_bytes = util.parse_size(args.split_size)
+        except ValueError:
+            print("Invalid split size (e.g. 500M or 2G)")
+            return
+    split = args.split_rows is not None or split_bytes is not None or args.split_by is not None
+    if (args.compress is not None or split) and args.format != 'csv':
+        print("--compress and splitting only work with csv output")
+        return
+    if args.resume and not split:
+        print("--resume only works with split output (--split-rows, --split-size or --split-by)")
+        return
+    if any(value is not None and value < 1 for value in (args.split_rows, split_bytes)):
+        print("Invalid split (must be a positive number)")
+        return
+
+    if args.batch_size < 1:
+        print("Invalid batch size (must be a positive number)")
+        return
+
+    if any(workers is not None and workers < 1
+           for workers in (args.workers, args.attachment_workers, args.query_workers)):
+        print("Invalid number of workers (must be a positive number)")
+        return
+
+    if args.all:
+        device_hashes = batch.find_device_hashes(backup_dir)
+    else:
+        device_hashes = []
+        for device_hash in [args.device_hash] + args.extra_device_hashes:
+            if device_hash is not None and device_hash not in device_hashes:
+                device_hashes.append(device_hash)
+    for device_name in args.device_name:
+        matches = backup_index.find_backups_by_device_name(backups, device_name)
+        if not matches:
+            print("No backup of a device named '{}' (see --list)".format(device_name))
+            return
+        device_hashes.extend(backup.device_hash for backup in matches
+                             if backup.device_hash not in device_hashes)
+    if not device_hashes:
+        print("No backups to extract. Specify a device hash or use -a for all backups.")
+        return
+
+    # Check that the db paths are in fact valid
+    for device_hash in device_hashes:
+        if not os.path.exists(os.path.join(backup_dir, device_hash)):
+            print("Backup path isn't valid. Check path or device hash ({}).".format(device_hash))
+            return
+
+    password = args.password
+    if password is None and any(encryption.is_encrypted(os.path.join(backup_dir, device_hash))
+                                for device_hash in device_hashes):
+        password = getpass.getpass("Backup password: ")
+
+    # Options that apply to every backup being extracted
+    options = dict(assumed_country_code=country_code,
+                   fallback_country_codes=args.fallback_country,
+                   batch_size=args.batch_size,
+                   incremental=args.incremental,
+                   output_format=args.format,
+                   engine=args.engine,
+                   cache_dir=args.cache_dir,
+                   attachments_dir=args.attachments,
+                   attachment_workers=args.attachment_workers,
+                   query_workers=args.query_workers,
+                   compression=args.compress,
+                   split_rows=args.split_rows,
+                   split_bytes=split_bytes,
+                   split_by=args.split_by,
+                   resume=args.resume,
+                   chats=args.chats,
+                   since=args.since,
+                   until=args.until,
+                   contacts=args.contact,
+                   service=args.service,
+                   from_me=args.from_me,
+                   tapbacks=args.tapbacks,
+                   timezone=args.timezone,
+                   date_format=args.date_format,
+                   password=password)
+
+    profile = None
+    if args.profile or args.profile_cpu or args.profile_memory:
+        profile = dict(cpu=args.profile_cpu, memory=args.profile_memory)
+
+    if args.all or len(device_hashes) > 1:
+        # Batch mode: extract all of the backups in parallel, one CSV each
+        print("Extracting messages from {} backups...".format(len(device_hashes)))
+        results = batch.extract_messages_batch(backup_dir=backup_dir,\
+                                               device_hashes=device_hashes,\
+                                               output_dir=args.output_path,\
+                                               workers=args.workers,\
+                                               profile=profile,\
+                                               **options)
+        batch.write_batch_summary(os.path.join(args.output_path, 'summary.json'), results)
+        print(batch.format_batch_summary(results))
+        print("Done. Files at: {}".format(args.output_path))
         return
 
     # Let's actually extract the messages to the specified backup path
     print("Extracting messages...")
-    extract_messages(backup_dir=backup_dir,\
+    profiler = None
+    if profile is not None or args.verbose:
+        profiler = Profiler(**(profile or {}))
+        profiler.start()
+    extract_messages(backup_dir=os.path.join(backup_dir, device_hashes[0]),\
                      output_path=args.output_path,\
-                     assumed_country_code=country_code)
-    print("Done. File at: {}".format(args.output_path))
+                     profiler=profiler,\
+                     **options)
+    if split:
+        print("Done. Parts listed in: {}".format(
+            split_output.manifest_path_for_output(args.output_path)))
+    else:
+        print("Done. File at: {}".format(args.output_path))
+    if profiler is not None:
+        profiler.stop()
+        if profile is not None:
+            report = save_profile(profiler, args.output_path)
+            print("Profile at: {}".format(report_path_for_output(args.output_path)))
+        else:
+            report = profiler.report()
+        print(format_report(report))
  
 if __name__ == '__main__':
     main()
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Attachments live in the MediaDomain of the backup
+ATTACHMENT_DOMAIN = 'MediaDomain'
+
+# Log of files that have been exported (one "<fileID>\t<path relative to the attachments dir>"
+# line per file), so an interrupted export can pick up where it left off
+INDEX_FILENAME = 'index.tsv'
+
+HASH_CHUNK_SIZE = 1 << 20
+
+def attachment_domain_path(filename):
+    """ Translates attachment.filename (the path on the device, which is either relative to the
+    home dir or absolute) to the (domain, relativePath) it's stored under in Manifest.db
+    e.g. ~/Library/SMS/Attachments/0a/10/.../IMG_0001.jpeg ->
+         ('MediaDomain', 'Library/SMS/Attachments/0a/10/.../IMG_0001.jpeg')
+    @return: a (domain, relativePath) tuple or None if it isn't an SMS attachment path
+    """
+    for prefix in ('~/', '/var/mobile/'):
+        if filename.startswith(prefix):
+            return (ATTACHMENT_DOMAIN, filename[len(prefix):])
+    return None
+
+def hash_file(path):
+    """ SHA256 of the contents of the file at path, read in chunks """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def copy_file(src, dst):
+    """ Copies src to dst in chunks, hashing it on the way through so it's only read once
+    @return: the SHA256 of the contents (as hash_file)
+    """
+    digest = hashlib.sha256()
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            fdst.write(chunk)
+    return digest.hexdigest()
+
+
+class AttachmentExporter():
+    """ Copies attachment files out of a backup with a pool of threads. Files are named after a
+    hash of their contents, so the same photo sent to several people (or forwarded) is only
+    stored once, and every copied file is logged to an index so a rerun skips files that have
+    already been exported
+    """
+
+    def __init__(self, attachments_dir, workers=None):
+        """
+        @param attachments_dir: the directory to copy attachments to
+        @param workers: the number of copy threads (default=ThreadPoolExecutor's default)
+        """
+        self.attachments_dir = attachments_dir
+        self.workers = workers
+        self.lock = threading.Lock()
+        # Relative paths being (or already) copied in this run, with an event set once done
+        self.claimed = {}
+        self.stats = {'copied': 0, 'deduplicated': 0, 'previously_exported': 0, 'missing': 0}
+        os.makedirs(attachments_dir, exist_ok=True)
+        self.index_path = os.path.join(attachments_dir, INDEX_FILENAME)
+        self.index = self.__load_index()
+
+    def export(self, sources):
+        """ Exports many files in parallel
+        @param sources: an iterable of (path of the file in the backup, original filename) tuples;
+        the original filename is only used for its extension. The path is None for a file the
+        backup doesn't have at all (e.g. one offloaded to iCloud)
+        @return: a dict of path in the backup to the path of the exported copy (files that are
+        missing from the backup are left out, and counted in stats)
+        """
+        sources = list(sources)
+        unlisted_count = sum(1 for src, _ in sources if src is None)
+        sources = dict((src, filename) for src, filename in sources if src is not None)
+        to_copy = [(src, filename) for src, filename in sources.items()
+                   if not self.is_exported(src)]
+        self.stats['previously_exported'] += len(sources) - len(to_copy)
+        with open(self.index_path, 'a') as index_file:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(lambda source: self.__export_one(index_file, *source), to_copy))
+        exported = dict((src, os.path.join(self.attachments_dir,
+                                           self.index[os.path.basename(src)]))
+                        for src in sources if self.is_exported(src))
+        # Whatever wasn't exported is missing: not listed in Manifest.db, or listed but not in
+        # the backup itself (e.g. a backup that didn't finish)
+        self.stats['missing'] += unlisted_count + len(sources) - len(exported)
+        return exported
+
+    def is_exported(self, src):
+        """ Whether the file at src (a path in the backup) was exported by an earlier run """
+        return os.path.basename(src) in self.index
+
+    def __export_one(self, index_file, src, filename):
+        # The contents are hashed as they're copied, under a temporary name so a half-copied file
+        # is never mistaken for a complete one, and then renamed after the hash
+        tmp_dst = os.path.join(self.attachments_dir, '.{}.{}.part'.format(
+            os.path.basename(src), threading.get_ident()))
+        try:
+            digest = copy_file(src, tmp_dst)
+        except FileNotFoundError:
+            # Not in the backup (counted by export)
+            return
+        relative_path = os.path.join(digest[:2], digest + os.path.splitext(filename)[1].lower())
+        dst = os.path.join(self.attachments_dir, relative_path)
+
+        with self.lock:
+            done = self.claimed.get(relative_path)
+            if done is None:
+                done = self.claimed[relative_path] = threading.Event()
+                first = True
+            else:
+                first = False
+
+        if first:
+            if os.path.exists(dst):
+                os.remove(tmp_dst)
+                self.__count('deduplicated')
+            else:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(tmp_dst, dst)
+                self.__count('copied')
+            done.set()
+        else:
+            # Someone else is storing the same contents; make sure they're done before this file
+            # is marked as exported
+            os.remove(tmp_dst)
+            done.wait()
+            self.__count('deduplicated')
+
+        with self.lock:
+            self.index[os.path.basename(src)] = relative_path
+            index_file.write('{}\t{}\n'.format(os.path.basename(src), relative_path))
+            index_file.flush()
+
+    def __count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def __load_index(self):
+        index = {}
+        try:
+            with open(self.index_path) as fp:
+                for line in fp:
+                    fields = line.rstrip('\n').split('\t')
+                    # Skip a line that was only partly written when an export was killed
+                    if len(fields) == 2 and \
+                            os.path.isfile(os.path.join(self.attachments_dir, fields[1])):
+                        index[fields[0]] = fields[1]
+        except FileNotFoundError:
+            pass
+        return index
+
+
+def export_attachments(message_db, manifest_resolver, attachments_dir, rowid_range=None,
+                       workers=None, encrypted_backup=None, message_filter=None):
+    """ Attachment export stage: resolves every attachment in sms.db through the manifest in one
+    go and copies them out of the backup
+    @param message_db: a connected MessageDB
+    @param manifest_resolver: a ManifestResolver for the backup
+    @param attachments_dir: the directory to copy attachments to
+    @param rowid_range: an optional (exclusive min, inclusive max) tuple of message.ROWIDs
+    @param workers: the number of copy threads
+    @param encrypted_backup: the encryption.EncryptedBackup, if the backup is encrypted; only
+    attachments that haven't already been exported are decrypted
+    @param message_filter: an optional phone_db.MessageFilter (only the attachments of the
+    messages it selects are exported)
+    @return: a tuple of (a dict of message.ROWID to the ';' separated paths of its exported
+    attachments, the AttachmentExporter's stats)
+    """
+    attachments = [(message_id, filename, attachment_domain_path(filename))
+                   for message_id, filename in message_db.get_attachments(rowid_range,
+                                                                          message_filter)]
+    physical_paths = manifest_resolver.resolve(domain_path for _, _, domain_path in attachments
+                                               if domain_path is not None)
+
+    exporter = AttachmentExporter(attachments_dir, workers)
+    sources = dict((physical_paths[domain_path], filename)
+                   for _, filename, domain_path in attachments if domain_path in physical_paths)
+    # Copy from decrypted copies (named after the same fileIDs, which the index is keyed on)
+    source_paths = dict((src, src) for src in sources)
+    if encrypted_backup is not None:
+        # (files missing from the backup are left for the exporter to count)
+        source_paths.update(encrypted_backup.decrypt_files(
+            src for src in sources if not exporter.is_exported(src) and os.path.isfile(src)))
+    # Attachments that aren't in Manifest.db (e.g. offloaded to iCloud) are only counted
+    unlisted = dict((domain_path, filename) for _, filename, domain_path in attachments
+                    if domain_path is not None and domain_path not in physical_paths)
+    exported_paths = exporter.export(
+        [(source_paths[src], filename) for src, filename in sources.items()] +
+        [(None, filename) for filename in unlisted.values()])
+
+    attachment_dict = {}
+    for message_id, _, domain_path in attachments:
+        if domain_path not in physical_paths:
+            continue
+        path = exported_paths.get(source_paths[physical_paths[domain_path]])
+        if path is None:
+            continue
+        attachment_dict[message_id] = path if message_id not in attachment_dict else \
+            attachment_dict[message_id] + ';' + path
+    return attachment_dict, exporter.stats
@@ -0,0 +1,106 @@
+import re
+import struct
+
+# Newer iOS versions often leave message.text NULL and only store the body in
+# message.attributedBody: an NSAttributedString archived with NSArchiver (Apple's "typedstream"
+# format). Rather than unarchiving the whole object graph, the decoder here just walks up to the
+# first string in the stream, which is always the plain text of the message. Attributes (links,
+# mentions, etc.) come after it, keyed by '__kIM...AttributeName' strings
+
+TYPEDSTREAM_HEADER = b'\x04\x0bstreamtyped'
+
+# The class of the message text (length-prefixed, as it appears in the stream)
+STRING_CLASS_RE = re.compile(b'\x08NSString|\x0fNSMutableString')
+# A new C string type (the first string in a stream never refers back to an earlier one)
+C_STRING_TYPE = b'\x84\x01+'
+
+# Integers in a typedstream are a signed byte, or one of these tags followed by a wider int
+INT16_TAG = 0x81
+INT32_TAG = 0x82
+
+ATTRIBUTE_NAME_RE = re.compile(rb'__kIM[A-Za-z]+AttributeName')
+LINK_ATTRIBUTE_NAME = b'__kIMLinkAttributeName'
+URL_CLASS = b'\x05NSURL'
+URL_RE = re.compile(rb'[A-Za-z][A-Za-z0-9+.\-]*:[\x21-\x7e]+\Z')
+# How far past its class name to look for the string of a URL
+URL_SEARCH_LENGTH = 64
+
+def decode_attributed_body(blob):
+    """ Gets the plain text of a message out of its attributedBody
+    @param blob: the message.attributedBody (bytes)
+    @return: the text, or None if blob is empty or isn't a typedstream with a string in it
+    """
+    if not blob or not blob.startswith(TYPEDSTREAM_HEADER):
+        return None
+    match = STRING_CLASS_RE.search(blob)
+    if match is None:
+        return None
+    start = blob.find(C_STRING_TYPE, match.end())
+    if start < 0:
+        return None
+    length, offset = read_length(blob, start + len(C_STRING_TYPE))
+    if length is None or offset + length > len(blob):
+        return None
+    return blob[offset:offset + length].decode('utf-8', 'replace')
+
+def read_length(blob, offset):
+    """ Reads a typedstream integer (as used for string lengths) at offset
+    @return: a tuple of (the integer, the offset just past it), or (None, offset) if there isn't
+    a non-negative integer there
+    """
+    if offset >= len(blob):
+        return None, offset
+    tag = blob[offset]
+    if tag == INT16_TAG and offset + 3 <= len(blob):
+        length, = struct.unpack_from('<h', blob, offset + 1)
+        offset += 3
+    elif tag == INT32_TAG and offset + 5 <= len(blob):
+        length, = struct.unpack_from('<i', blob, offset + 1)
+        offset += 5
+    elif tag < 0x80:
+        length = tag
+        offset += 1
+    else:
+        return None, offset
+    return (length, offset) if length >= 0 else (None, offset)
+
+def attributed_body_attributes(blob):
+    """ The names of the attributes set on (parts of) a message, e.g. '__kIMLinkAttributeName' or
+    '__kIMMentionConfidenceLevelAttributeName'
+    @return: a sorted list of names
+    """
+    if not blob:
+        return []
+    return sorted(set(name.decode('ascii') for name in ATTRIBUTE_NAME_RE.findall(blob)))
+
+def attributed_body_links(blob):
+    """ The URLs of the links in a message (the NSURL values of its link attributes)
+    @return: a list of URLs in the order they appear
+    """
+    links = []
+    if not blob or LINK_ATTRIBUTE_NAME not in blob:
+        return links
+    position = blob.find(URL_CLASS)
+    while position >= 0:
+        end = min(position + len(URL_CLASS) + URL_SEARCH_LENGTH, len(blob))
+        for offset in range(position + len(URL_CLASS), end):
+            length, start = read_length(blob, offset)
+            if length and start + length <= len(blob) and \
+                    URL_RE.match(blob, start, start + length):
+                links.append(blob[start:start + length].decode('ascii'))
+                break
+        position = blob.find(URL_CLASS, position + len(URL_CLASS))
+    return links
+
+def decode_text_column(rows, index):
+    """ Fills in the text of a batch of rows whose text column is the message.text or, where that
+    is NULL, the message.attributedBody (e.g. COALESCE(message.text, message.attributedBody)).
+    Batches without any attributedBody in them are returned as they are
+    @param rows: a list of rows (tuples)
+    @param index: the index of the text column
+    @return: the list of rows with the text decoded
+    """
+    if not any(isinstance(row[index], bytes) for row in rows):
+        return rows
+    return [row[:index] + (decode_attributed_body(row[index]),) + row[index + 1:]
+            if isinstance(row[index], bytes) else row for row in rows]
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import plistlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Backups are found by scanning a backup root (the directory with one sub-directory per device,
+# named after its 40 character device hash) and reading each one's Info.plist and Manifest.plist.
+# What was read is saved in an index in the cache directory, keyed on the mtime of each backup's
+# directory: iTunes/Finder replace those files when a backup finishes, which updates it, so
+# unchanged backups are never opened again and listing a root with thousands of backups only
+# costs a stat per directory. Those stats (and any plists that do need reading) are spread over
+# threads, since on a network share nearly all of the time is spent waiting on the server
+
+# Bump whenever the layout of the index (or of BackupInfo) changes
+INDEX_VERSION = 1
+
+INFO_PLIST_FILENAME = 'Info.plist'
+MANIFEST_PLIST_FILENAME = 'Manifest.plist'
+
+# The default number of threads to scan with
+DEFAULT_SCAN_WORKERS = 16
+
+# What's known about a backup. last_backup_date is an ISO 8601 string; any of the fields but
+# device_hash and is_encrypted can be None when the backup doesn't record them
+BackupInfo = namedtuple('BackupInfo', ['device_hash', 'device_name', 'product_type',
+                                       'product_version', 'last_backup_date', 'is_encrypted'])
+
+def index_path_for_backup_dir(cache_dir, backup_dir):
+    """ Where the index of the backups under backup_dir is kept in cache_dir """
+    backup_dir_hash = hashlib.sha1(os.path.abspath(backup_dir).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'backups-{}.json'.format(backup_dir_hash[:16]))
+
+def read_backup_info(backup_path):
+    """ Reads what's known about a backup from its Info.plist (written by iTunes/Finder) and
+    Manifest.plist (written by the device; its Lockdown dict is used for anything Info.plist
+    doesn't have)
+    @param backup_path: the path to the backup (the device hash directory)
+    @return: a BackupInfo, or None if it isn't a (complete) backup
+    """
+    try:
+        with open(os.path.join(backup_path, MANIFEST_PLIST_FILENAME), 'rb') as fp:
+            manifest = plistlib.load(fp)
+    except (OSError, plistlib.InvalidFileException, ValueError):
+        return None
+    try:
+        with open(os.path.join(backup_path, INFO_PLIST_FILENAME), 'rb') as fp:
+            info = plistlib.load(fp)
+    except (OSError, plistlib.InvalidFileException, ValueError):
+        info = {}
+    lockdown = manifest.get('Lockdown', {})
+    last_backup_date = info.get('Last Backup Date') or manifest.get('Date')
+    return BackupInfo(os.path.basename(os.path.normpath(backup_path)),
+                      info.get('Device Name') or lockdown.get('DeviceName'),
+                      info.get('Product Type') or lockdown.get('ProductType'),
+                      info.get('Product Version') or lockdown.get('ProductVersion'),
+                      None if last_backup_date is None else last_backup_date.isoformat(),
+                      bool(manifest.get('IsEncrypted', False)))
+
+def discover_backups(backup_dir, cache_dir=None, workers=DEFAULT_SCAN_WORKERS):
+    """ Finds every backup under backup_dir, only reading the ones that are new or have changed
+    since the last scan
+    @param backup_dir: the root backup directory (the one containing the device hash dirs)
+    @param cache_dir: the directory to keep the index in (default=None, everything is read)
+    @param workers: the number of threads to scan with
+    @return: a list of BackupInfos, sorted by device hash
+    """
+    index_path = None if cache_dir is None else index_path_for_backup_dir(cache_dir, backup_dir)
+    entries = _load_index(index_path)
+
+    def scan(entry):
+        try:
+            mtime = entry.stat().st_mtime_ns
+        except OSError:
+            return entry.name, None
+        cached = entries.get(entry.name)
+        if cached is not None and cached[0] == mtime:
+            return entry.name, cached
+        # Directories that aren't backups are remembered too (as None) so they aren't re-read
+        info = read_backup_info(entry.path)
+        return entry.name, [mtime, None if info is None else info._asdict()]
+
+    directories = [entry for entry in os.scandir(backup_dir) if entry.is_dir()]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(directories)))) as executor:
+        scanned = dict(entry for entry in executor.map(scan, directories) if entry[1] is not None)
+    if index_path is not None and scanned != entries:
+        _save_index(index_path, scanned)
+    return [BackupInfo(**scanned[name][1]) for name in sorted(scanned)
+            if scanned[name][1] is not None]
+
+def find_backups_by_device_name(backups, device_name):
+    """ The backups of the device(s) with the given name (ignoring case)
+    @param backups: a list of BackupInfos (see discover_backups)
+    @return: a list of BackupInfos, the most recent first
+    """
+    device_name = device_name.casefold()
+    return sorted((backup for backup in backups
+                   if backup.device_name is not None and
+                   backup.device_name.casefold() == device_name),
+                  key=lambda backup: backup.last_backup_date or '', reverse=True)
+
+def format_backup_list(backups):
+    """ Human-readable table of backups (see discover_backups), the most recent first """
+    lines = ['{:<42} {:<24} {:<10} {:<19}  {}'.format('Device', 'Name', 'iOS', 'Last backup',
+                                                       'Encrypted')]
+    for backup in sorted(backups, key=lambda backup: backup.last_backup_date or '',
+                         reverse=True):
+        lines.append('{:<42} {:<24} {:<10} {:<19}  {}'.format(
+            backup.device_hash, backup.device_name or '-', backup.product_version or '-',
+            (backup.last_backup_date or '-')[:19].replace('T', ' '),
+            'Yes' if backup.is_encrypted else 'No'))
+    lines.append('{} backups'.format(len(backups)))
+    return '\n'.join(lines)
+
+def _load_index(index_path):
+    # Device hash: [directory mtime, BackupInfo as a dict (or None if it isn't a backup)]
+    if index_path is None:
+        return {}
+    try:
+        with open(index_path) as fp:
+            index = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    return index['backups'] if index.get('version') == INDEX_VERSION else {}
+
+def _save_index(index_path, entries):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(index_path + '.tmp', 'w') as fp:
+        json.dump({'version': INDEX_VERSION, 'backups': entries}, fp)
+    os.replace(index_path + '.tmp', index_path)
@@ -0,0 +1,100 @@
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .message_extractor import extract_messages, MANIFEST_PLIST_FILENAME
+from .compressed_output import COMPRESSIONS
+from .instrumentation import Profiler, save_profile
+
+# Result of extracting a single backup as part of a batch. error is None on success, otherwise
+# a string describing what went wrong (row_count is then None)
+BatchResult = namedtuple('BatchResult', ['device_hash', 'output_path', 'row_count', 'seconds',
+                                         'error'])
+
+def find_device_hashes(backup_dir):
+    """ Finds every backup under backup_dir (i.e. every sub-directory with a Manifest.plist)
+    @param backup_dir: the root backup directory (the one containing the device hash dirs)
+    @return: a sorted list of device hashes
+    """
+    return sorted(entry.name for entry in os.scandir(backup_dir) if entry.is_dir() and \
+                  os.path.isfile(os.path.join(entry.path, MANIFEST_PLIST_FILENAME)))
+
+def output_path_for_device(output_dir, device_hash, output_format='csv', compression=None):
+    """ Each backup in a batch gets its own file named after its device hash """
+    return os.path.join(output_dir, '{}.{}{}'.format(device_hash, output_format,
+                                                     COMPRESSIONS.get(compression, '')))
+
+def extract_device(backup_dir, device_hash, output_path, assumed_country_code, profile=None,
+                   **options):
+    """ Runs extract_messages for a single device, catching any failure so that one broken
+    backup can't take down the rest of the batch (this runs in a worker process)
+    @param profile: if given, a dict of keyword arguments for instrumentation.Profiler; the
+    export is profiled and the report saved next to its output
+    @param options: any other keyword arguments for extract_messages (batch_size, etc.)
+    @return: a BatchResult
+    """
+    start = time.perf_counter()
+    try:
+        profiler = None if profile is None else Profiler(**profile)
+        if profiler is not None:
+            profiler.start()
+        row_count = extract_messages(backup_dir=os.path.join(backup_dir, device_hash),
+                                     output_path=output_path,
+                                     assumed_country_code=assumed_country_code,
+                                     profiler=profiler,
+                                     **options)
+        if profiler is not None:
+            profiler.stop()
+            save_profile(profiler, output_path)
+        error = None
+    except Exception as e:
+        row_count = None
+        error = '{}: {}'.format(type(e).__name__, e)
+    return BatchResult(device_hash, output_path, row_count, time.perf_counter() - start, error)
+
+def extract_messages_batch(backup_dir, device_hashes, output_dir, assumed_country_code,
+                           workers=None, **options):
+    """ Extracts messages from many backups at once using a pool of worker processes
+    @param backup_dir: the root backup directory (the one containing the device hash dirs)
+    @param device_hashes: the device hashes to extract
+    @param output_dir: the directory to write one file per device to
+    @param assumed_country_code: two-letter country code to assume when numbers lack one
+    @param workers: the number of worker processes (default=number of CPUs)
+    @param options: any other keyword arguments for extract_messages (batch_size, incremental,
+    output_format, profile, etc.), applied to every device. If attachments_dir is given, each
+    device's attachments go in their own <attachments_dir>/<device_hash> sub-directory
+    @return: a list of BatchResults in the same order as device_hashes
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_format = options.get('output_format', 'csv')
+    compression = options.get('compression')
+    attachments_dir = options.pop('attachments_dir', None)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(extract_device, backup_dir, device_hash,
+                                   output_path_for_device(output_dir, device_hash, output_format,
+                                                          compression),
+                                   assumed_country_code,
+                                   attachments_dir=None if attachments_dir is None else \
+                                       os.path.join(attachments_dir, device_hash),
+                                   **options)
+                   for device_hash in device_hashes]
+        return [future.result() for future in futures]
+
+def format_batch_summary(results):
+    """ Human-readable summary table of a batch run with per-device timings and row counts """
+    lines = ['{:<42} {:>10} {:>9}  {}'.format('Device', 'Messages', 'Seconds', 'Status')]
+    for result in results:
+        lines.append('{:<42} {:>10} {:>9.2f}  {}'.format(
+            result.device_hash, '-' if result.row_count is None else result.row_count,
+            result.seconds, 'OK' if result.error is None else result.error))
+    failures = sum(1 for result in results if result.error is not None)
+    lines.append('{} backups, {} succeeded, {} failed'.format(len(results),
+                                                            len(results) - failures, failures))
+    return '\n'.join(lines)
+
+def write_batch_summary(path, results):
+    """ Writes the batch results to path as JSON (one object per device) """
+    with open(path, 'w') as fp:
+        json.dump([result._asdict() for result in results], fp, indent=2)
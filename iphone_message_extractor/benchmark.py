@@ -0,0 +1,231 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .phone_db import PhoneDB, ManifestDB, AddressDB, MessageDB
+from .manifest_cache import ManifestResolver
+from .message_extractor import extract_messages, write_messages_to_csv
+from . import synthetic, util
+
+# Bump whenever the layout of the results changes
+RESULTS_VERSION = 1
+
+# Stages in the order they run; each one (except end_to_end) is a piece of what
+# extract_messages does, timed on its own
+STAGES = ['manifest', 'contacts', 'handles', 'query', 'map', 'write', 'end_to_end']
+
+# The raw query the python engine maps onto contacts (without any of the mapping); the text
+# expression depends on the schema of the DB (see schema.MessageSchema)
+QUERY_SQL = '''
+              SELECT handle.id, message.date, message.is_from_me, {text}, handle.service
+              FROM message
+              INNER JOIN handle
+                  ON handle.ROWID = message.handle_id
+              ORDER BY handle.id, {unix_timestamp}
+            '''
+
+def git_commit():
+    """ The commit being benchmarked (or None outside of a git checkout) """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def peak_rss_bytes():
+    """ Peak resident memory of this process so far (None where it can't be measured) """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def time_stage(func, repeat=1, trace_memory=False):
+    """ Runs func repeat times
+    @param trace_memory: also record the peak memory allocated by Python during the first run
+    (tracemalloc slows things down, so that run isn't timed)
+    @return: a tuple of (the result of the last run, a dict with the fastest run in seconds and,
+    if trace_memory, the peak memory in bytes)
+    """
+    stats = {}
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        func()
+        stats['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    stats['seconds'] = min(timings)
+    return result, stats
+
+def run_benchmark(backup_dir, output_dir, assumed_country_code='US', repeat=1,
+                  trace_memory=False, **options):
+    """ Times each stage of an extract against an (unencrypted) backup
+    @param backup_dir: the path to the backup (e.g. one made by synthetic.create_synthetic_backup)
+    @param output_dir: where to write the output of the write and end_to_end stages
+    @param assumed_country_code: two-letter country code to assume when numbers lack one
+    @param repeat: how many times to run each stage (the fastest run is reported)
+    @param trace_memory: also record each stage's peak Python memory use with tracemalloc
+    @param options: any other keyword arguments for extract_messages (engine, batch_size, etc.),
+    used for the end_to_end stage
+    @return: a dict of results (see STAGES), ready to be saved with save_results
+    """
+    stages = {}
+    def run(name, func):
+        result, stages[name] = time_stage(func, repeat, trace_memory)
+        return result
+
+    resolver_paths = run('manifest', lambda: ManifestResolver(backup_dir).resolve(
+        [ManifestDB.SMS_DB_DOMAIN_PATH, ManifestDB.ADDRESS_BOOK_DOMAIN_PATH]))
+    sms_db_path = resolver_paths[ManifestDB.SMS_DB_DOMAIN_PATH]
+    address_book_db_path = resolver_paths[ManifestDB.ADDRESS_BOOK_DOMAIN_PATH]
+
+    def build_contacts():
+        # Start cold, the way a fresh run would
+        util.normalize_cache_clear()
+        address_db = AddressDB(address_book_db_path, **PhoneDB.BACKUP_DB_OPTIONS)
+        address_db.connect()
+        try:
+            return address_db.generate_dict_from_address_book(assumed_country_code)
+        finally:
+            address_db.close()
+    contacts_dict = run('contacts', build_contacts)
+
+    message_db = MessageDB(sms_db_path, **PhoneDB.BACKUP_DB_OPTIONS)
+    message_db.connect()
+    try:
+        def build_handles():
+            util.normalize_cache_clear()
+            return message_db.generate_handle_dict(assumed_country_code)
+        handle_dict = run('handles', build_handles)
+
+        def query():
+            cur = message_db.conn.execute(QUERY_SQL.format(
+                text=message_db.get_schema().text_sql,
+                unix_timestamp=MessageDB.UNIX_TIMESTAMP_SQL))
+            row_count = 0
+            while True:
+                rows = cur.fetchmany(MessageDB.DEFAULT_BATCH_SIZE)
+                if not rows:
+                    return row_count
+                row_count += len(rows)
+        run('query', query)
+
+        # The query again, plus mapping each row onto a contact and formatting its date
+        rows = run('map', lambda: list(message_db.iter_messages_matched_to_contact_dict(
+            contacts_dict, assumed_country_code=assumed_country_code, handle_dict=handle_dict)))
+    finally:
+        message_db.close()
+
+    run('write', lambda: write_messages_to_csv(os.path.join(output_dir, 'write.csv'), rows))
+    del rows
+
+    output_path = os.path.join(output_dir, 'end_to_end.{}'.format(
+        options.get('output_format', 'csv')))
+    row_count = run('end_to_end', lambda: extract_messages(backup_dir, output_path,
+                                                           assumed_country_code, **options))
+
+    return {'version': RESULTS_VERSION,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': util.np is not None,
+            'options': options,
+            'rows': row_count,
+            'rows_per_second': row_count / stages['end_to_end']['seconds']
+                if stages['end_to_end']['seconds'] else None,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': stages}
+
+def save_results(path, results):
+    """ Writes benchmark results to path as JSON """
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+def load_results(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+def format_results(results, baseline=None, threshold=0.1):
+    """ Human-readable table of the stage timings, optionally compared to an earlier run
+    @param baseline: results (e.g. from another commit) to compare against
+    @param threshold: how much slower (as a fraction) a stage has to be to be flagged
+    """
+    lines = ['{:<12} {:>10} {:>12}'.format('Stage', 'Seconds', 'Peak memory') + \
+             ('  {:>10} {:>8}'.format('Baseline', 'Change') if baseline else '')]
+    for name in STAGES:
+        stage = results['stages'].get(name)
+        if stage is None:
+            continue
+        line = '{:<12} {:>10.3f} {:>12}'.format(
+            name, stage['seconds'],
+            '-' if stage.get('peak_memory_bytes') is None else \
+                '{:.1f} MB'.format(stage['peak_memory_bytes'] / 1e6))
+        base = baseline['stages'].get(name) if baseline else None
+        if base is not None and base['seconds']:
+            change = stage['seconds'] / base['seconds'] - 1
+            line += '  {:>10.3f} {:>+7.1%}{}'.format(base['seconds'], change,
+                                                   ' SLOWER' if change > threshold else '')
+        lines.append(line)
+    lines.append('{} rows, {:,.0f} rows/s end to end'.format(results['rows'],
+                                                           results['rows_per_second'] or 0))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks extracting messages from a \
+                                                  synthetic backup")
+    parser.add_argument("--contacts", type=int, default=1000, help="Contacts in the address book")
+    parser.add_argument("--handles", type=int, default=1500, help="Handles in sms.db")
+    parser.add_argument("--messages", type=int, default=100000, help="Messages in sms.db")
+    parser.add_argument("--group-chats", type=int, default=50, help="Group chats in sms.db")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the backup")
+    parser.add_argument("--backup-dir", help="Where to create the synthetic backup (reused if \
+                                              it already exists; defaults to a temp dir)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per stage (the \
+                                                                     fastest is reported)")
+    parser.add_argument("-m", "--trace-memory", action="store_true", help="Record each stage's \
+                                                                          peak memory use")
+    parser.add_argument("-e", "--engine", default='python', help="Engine for the end to end run")
+    parser.add_argument("-o", "--output", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Compare against results saved with -o (e.g. from \
+                                           another commit)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        backup_dir = args.backup_dir or os.path.join(tmp_dir, 'backup')
+        if not os.path.isdir(backup_dir):
+            print("Creating a synthetic backup with {} messages...".format(args.messages))
+            synthetic.create_synthetic_backup(backup_dir, args.contacts, args.handles,
+                                              args.messages, args.group_chats, args.seed)
+        results = run_benchmark(backup_dir, tmp_dir, repeat=args.repeat,
+                                trace_memory=args.trace_memory, engine=args.engine)
+    results['backup'] = dict(contacts=args.contacts, handles=args.handles,
+                             messages=args.messages, group_chats=args.group_chats,
+                             seed=args.seed)
+
+    print(format_results(results, load_results(args.compare) if args.compare else None))
+    if args.output:
+        save_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import hashlib
+import io
+import lzma
+import queue
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed outputs are written through a background thread: the export hands chunks of CSV
+# over to the thread and carries on querying and formatting messages while the thread compresses
+# them and writes them out (zlib, lzma and zstandard all release the GIL while they work). The
+# queue between them is bounded, so memory use stays flat however big the export is
+
+# File extensions by compression
+COMPRESSIONS = {'gzip': '.gz', 'xz': '.xz', 'zstd': '.zst'}
+
+# The size of the chunks handed to the compression thread, and how many can be waiting at once
+CHUNK_SIZE = 1 << 20
+QUEUE_SIZE = 8
+
+def new_compressor(compression):
+    """ A compressor object (with compress and flush methods) for one of COMPRESSIONS """
+    if compression == 'gzip':
+        # wbits=31 for a gzip header and trailer rather than a raw zlib stream
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif compression == 'xz':
+        return lzma.LZMACompressor()
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is required for zstd output (pip3 install zstandard)')
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+def file_sha256(path):
+    """ Hashes a file, a chunk at a time
+    @return: a hashlib sha256 object
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for data in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            sha256.update(data)
+    return sha256
+
+
+class CompressedFile(io.RawIOBase):
+    """ A binary file that compresses what's written to it on a background thread and keeps a
+    running SHA-256 and size of the compressed output (just the new stream, when appending). Wrap
+    it in a BufferedWriter so that the thread gets big chunks (see open_text):
+
+        text_file, raw_file = open_text(path, 'gzip')
+        text_file.write('...')
+        text_file.close()
+
+    Compressed streams can be appended to: gzip, xz and zstd readers all read concatenated
+    streams as one
+    """
+
+    def __init__(self, path, compression=None, append=False):
+        """
+        @param path: the path to write to
+        @param compression: one of COMPRESSIONS (default=None, written as is, on this thread)
+        @param append: add a new stream to the end of the file instead of overwriting it
+        """
+        super().__init__()
+        self.fp = open(path, 'ab' if append else 'wb')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.bytes_in = 0
+        self.error = None
+        self.compressor = None if compression is None else new_compressor(compression)
+        self.thread = None
+        if self.compressor is not None:
+            self.queue = queue.Queue(QUEUE_SIZE)
+            self.thread = threading.Thread(target=self.__compress, daemon=True)
+            self.thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        data = bytes(data)
+        self.bytes_in += len(data)
+        if self.thread is None:
+            self.__write(data)
+        else:
+            self.queue.put(data)
+        return len(data)
+
+    def __write(self, data):
+        self.fp.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def __compress(self):
+        closed = False
+        try:
+            while not closed:
+                data = self.queue.get()
+                closed = data is None
+                self.__write(self.compressor.flush() if closed else
+                             self.compressor.compress(data))
+        except BaseException as e:
+            self.error = e
+            # Keep taking chunks until the file is closed so that the export never blocks on a
+            # full queue
+            while not closed:
+                closed = self.queue.get() is None
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+        finally:
+            self.fp.close()
+        if self.error is not None:
+            raise self.error
+
+def open_text(path, compression=None, append=False):
+    """ Opens a CompressedFile for writing text, as UTF-8 with a BOM (like the plain CSV output;
+    the BOM is left out when appending)
+    @return: a tuple of (the text file, the CompressedFile under it)
+    """
+    raw_file = CompressedFile(path, compression, append)
+    text_file = io.TextIOWrapper(io.BufferedWriter(raw_file, CHUNK_SIZE),
+                                 encoding='utf-8' if append else 'utf-8-sig', newline='')
+    return text_file, raw_file
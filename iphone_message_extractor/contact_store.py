@@ -0,0 +1,108 @@
+import sys
+from collections.abc import Mapping
+
+# The name columns of messages from handles that aren't in the address book
+NO_NAME = ('', '')
+
+
+class ContactStore(Mapping):
+    """ Compact map of canonical phone numbers/e-mails to (first name, last name) tuples, used in
+    place of a plain dict of tuples. Every contact has an integer id (its ABPerson ROWID) and one
+    names tuple, shared by all of its phone numbers/e-mails, and names are interned so the same
+    name is only stored once however many contacts have it. Reads like the dict it replaces:
+
+        contacts['+1 212-555-1212'] == ('Samwise', 'Gamgee')
+    """
+
+    __slots__ = ('key_ids', 'names')
+
+    def __init__(self):
+        # Canonical phone number/e-mail: contact id
+        self.key_ids = {}
+        # Contact id: (first name, last name)
+        self.names = {}
+
+    @staticmethod
+    def from_mapping(contacts):
+        """ Builds a store from any mapping of canonical phone numbers/e-mails to (first name, last
+        name) (e.g. a plain dict); contacts with exactly the same names share an id """
+        if isinstance(contacts, ContactStore):
+            return contacts
+        store, name_ids = ContactStore(), {}
+        for key, (first, last) in contacts.items():
+            store.add(key, first, last, name_ids.setdefault((first, last), len(name_ids) + 1))
+        return store
+
+    def add(self, key, first, last, contact_id):
+        """ Adds a phone number/e-mail of a contact (replacing whoever it belonged to before)
+        @param key: the canonical phone number/e-mail
+        @param first: first name (or None)
+        @param last: last name (or None)
+        @param contact_id: the contact's id
+        """
+        names = self.names.get(contact_id)
+        if names is None or names != (first, last):
+            names = (ContactStore.__intern(first), ContactStore.__intern(last))
+            self.names[contact_id] = names
+        self.key_ids[key] = contact_id
+
+    def contact_id(self, key):
+        """ The id of the contact with phone number/e-mail key (None if there isn't one) """
+        return self.key_ids.get(key)
+
+    def contact_keys(self, key):
+        """ Every phone number/e-mail of the contact with phone number/e-mail key (just key itself
+        if it isn't in the store) """
+        contact_id = self.key_ids.get(key)
+        if contact_id is None:
+            return {key}
+        return set(other for other, other_id in self.key_ids.items() if other_id == contact_id)
+
+    def find_keys(self, name):
+        """ The phone numbers/e-mails of every contact whose name contains name, ignoring case, as
+        'First Last' or 'Last First' (e.g. 'frodo', 'Frodo Baggins' or 'Baggins, Frodo' without
+        the comma)
+        @return: a set of canonical phone numbers/e-mails
+        """
+        name = name.casefold()
+        contact_ids = set()
+        for contact_id, (first, last) in self.names.items():
+            for names in ((first, last), (last, first)):
+                if name in ' '.join(part for part in names if part).casefold():
+                    contact_ids.add(contact_id)
+        return set(key for key, contact_id in self.key_ids.items() if contact_id in contact_ids)
+
+    def handle_columns(self, handle_dict):
+        """ The last name, first name and canonical phone number/e-mail columns of the messages
+        from each handle, built once so that every message from a handle shares one tuple
+        @param handle_dict: the dictionary of raw handle.id values to canonical phone numbers/
+        e-mails (see MessageDB.generate_handle_dict)
+        @return: a dictionary of raw handle.id to a (last name, first name, key) tuple
+        """
+        columns = {}
+        for handle_id, key in handle_dict.items():
+            names = self.get(key, NO_NAME)
+            columns[handle_id] = (names[1], names[0], key)
+        return columns
+
+    def __intern(name):
+        return sys.intern(name) if isinstance(name, str) else name
+
+    def __getitem__(self, key):
+        return self.names[self.key_ids[key]]
+
+    def get(self, key, default=None):
+        contact_id = self.key_ids.get(key)
+        return default if contact_id is None else self.names[contact_id]
+
+    def __contains__(self, key):
+        return key in self.key_ids
+
+    def __iter__(self):
+        return iter(self.key_ids)
+
+    def __len__(self):
+        return len(self.key_ids)
+
+    def __repr__(self):
+        return 'ContactStore({} keys, {} contacts)'.format(len(self.key_ids), len(self.names))
@@ -0,0 +1,235 @@
+import hashlib
+import os
+import plistlib
+import shutil
+import struct
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.keywrap import aes_key_unwrap, InvalidUnwrap
+except ImportError:
+    Cipher = None
+
+from .phone_db import PhoneDB, ManifestDB
+
+# Encrypted backups (iOS 10.2 and later) work like this: Manifest.plist holds a keybag with one
+# key per data protection class, each wrapped (RFC 3394) with a key derived from the backup
+# password. Manifest.db is encrypted (AES-256-CBC, zero IV) with its own key, wrapped with one of
+# the class keys, and every file in the backup is encrypted the same way with a key of its own
+# that is stored (wrapped) in the Files.file column of Manifest.db
+
+# Class keys that are wrapped with the key derived from the password
+WRAP_PASSCODE = 2
+
+# Bytes decrypted at a time (a multiple of the AES block size)
+DECRYPT_CHUNK_SIZE = 1 << 20
+AES_BLOCK_SIZE = 16
+
+# Class keys unwrapped so far in this process, by a digest of the keybag and password, so the
+# (deliberately slow) PBKDF2 rounds only run once per backup however many times it's opened
+_class_key_cache = {}
+_class_key_cache_lock = threading.Lock()
+
+def is_encrypted(backup_dir):
+    """ Whether the backup at backup_dir is encrypted (according to its Manifest.plist) """
+    with open(os.path.join(backup_dir, 'Manifest.plist'), 'rb') as fp:
+        return bool(plistlib.load(fp).get('IsEncrypted'))
+
+def parse_keybag(data):
+    """ Parses a keybag (a list of 4 byte tag, 4 byte big-endian length, value records)
+    @return: a tuple of (a dict of the keybag's own attributes, a dict of protection class to
+    that class's attributes)
+    """
+    attributes, class_keys, current = {}, {}, None
+    offset = 0
+    while offset + 8 <= len(data):
+        tag = data[offset:offset + 4].decode('ascii')
+        length, = struct.unpack('>I', data[offset + 4:offset + 8])
+        value = data[offset + 8:offset + 8 + length]
+        offset += 8 + length
+        if length == 4 and tag != 'WPKY':
+            value, = struct.unpack('>I', value)
+        if tag == 'UUID' and 'UUID' in attributes:
+            # Every class key starts with its own UUID
+            current = {}
+        if current is None:
+            attributes[tag] = value
+        else:
+            current[tag] = value
+            if tag == 'CLAS':
+                class_keys[value] = current
+    return attributes, class_keys
+
+def unwrap_class_keys(keybag, password):
+    """ Derives the key from the password and unwraps the keybag's class keys with it. Results
+    are cached for the life of the process
+    @param keybag: the BackupKeyBag from Manifest.plist
+    @param password: the backup password
+    @return: a dict of protection class to class key
+    """
+    check_cryptography()
+    cache_key = hashlib.sha256(keybag + b'\0' + password.encode('utf-8')).digest()
+    with _class_key_cache_lock:
+        if cache_key in _class_key_cache:
+            return _class_key_cache[cache_key]
+
+    attributes, class_keys = parse_keybag(keybag)
+    passcode = password.encode('utf-8')
+    if 'DPSL' in attributes:
+        # iOS 10.2+ runs the password through PBKDF2-SHA256 before the original PBKDF2-SHA1
+        passcode = hashlib.pbkdf2_hmac('sha256', passcode, attributes['DPSL'],
+                                       attributes['DPIC'], 32)
+    passcode_key = hashlib.pbkdf2_hmac('sha1', passcode, attributes['SALT'], attributes['ITER'],
+                                       32)
+    keys = {}
+    try:
+        for protection_class, class_key in class_keys.items():
+            if 'WPKY' in class_key and class_key.get('WRAP', 0) & WRAP_PASSCODE:
+                keys[protection_class] = aes_key_unwrap(passcode_key, class_key['WPKY'])
+    except InvalidUnwrap:
+        raise ValueError('Wrong password for encrypted backup')
+
+    with _class_key_cache_lock:
+        _class_key_cache[cache_key] = keys
+    return keys
+
+def unwrap_file_key(class_keys, wrapped_key):
+    """ Unwraps a file (or Manifest.db) key: 4 bytes of little-endian protection class followed
+    by the key wrapped with that class's key """
+    protection_class, = struct.unpack('<I', wrapped_key[:4])
+    return aes_key_unwrap(class_keys[protection_class], wrapped_key[4:])
+
+def parse_file_info(file_blob):
+    """ Gets the encryption key (still wrapped) and size of a file from its Files.file blob (an
+    NSKeyedArchiver plist of an MBFile)
+    @return: a tuple of (wrapped key, size), or (None, None) if the file isn't encrypted
+    """
+    archive = plistlib.loads(file_blob)
+    objects = archive['$objects']
+    root = objects[archive['$top']['root'].data]
+    if 'EncryptionKey' not in root:
+        return None, None
+    key = objects[root['EncryptionKey'].data]
+    if isinstance(key, dict):
+        key = key['NS.data']
+    return key, root.get('Size')
+
+def decrypt_file(src, dst, key, size=None):
+    """ Decrypts an AES-256-CBC (zero IV) encrypted file chunk by chunk, so even a huge file never
+    has to fit in memory (module-level so it can run in a worker process)
+    @param size: the size of the plaintext, if known (the padding is cut off)
+    """
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(b'\0' * AES_BLOCK_SIZE)).decryptor()
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(DECRYPT_CHUNK_SIZE), b''):
+            fdst.write(decryptor.update(chunk))
+        fdst.write(decryptor.finalize())
+        if size is not None:
+            fdst.truncate(size)
+
+def strip_sqlite_padding(path):
+    """ Removes the PKCS#7 padding from a decrypted SQLite DB (whose size isn't recorded
+    anywhere). A DB is a whole number of pages, so padding is a full block of 0x10 bytes past
+    the last 512 byte boundary """
+    with open(path, 'r+b') as fp:
+        length = fp.seek(0, os.SEEK_END)
+        if length % 512 != AES_BLOCK_SIZE:
+            return
+        fp.seek(length - AES_BLOCK_SIZE)
+        if fp.read() == bytes([AES_BLOCK_SIZE]) * AES_BLOCK_SIZE:
+            fp.truncate(length - AES_BLOCK_SIZE)
+
+def check_cryptography():
+    if Cipher is None:
+        raise ImportError('The cryptography package is required for encrypted backups '
+                          '(pip3 install cryptography)')
+
+
+class EncryptedBackup():
+    """ An encrypted backup opened with its password. Manifest.db is decrypted up front; other
+    files are only decrypted when asked for (see decrypt_files), in parallel worker processes,
+    into a private temp directory that is removed by close(). Nothing else in the backup is ever
+    decrypted
+    """
+
+    def __init__(self, backup_dir, password, workers=None):
+        """
+        @param backup_dir: the path to the backup (where Manifest.plist and Manifest.db are)
+        @param password: the backup password
+        @param workers: the number of processes to decrypt files with (default=number of CPUs)
+        """
+        check_cryptography()
+        self.backup_dir = backup_dir
+        self.workers = workers
+        with open(os.path.join(backup_dir, 'Manifest.plist'), 'rb') as fp:
+            manifest_plist = plistlib.load(fp)
+        self.class_keys = unwrap_class_keys(manifest_plist['BackupKeyBag'], password)
+        self.tmp_dir = tempfile.mkdtemp(prefix='iphone_message_extractor-')
+        # Encrypted path in the backup: decrypted path in tmp_dir
+        self.decrypted = {}
+
+        # Nothing owns tmp_dir until __init__ returns, so it's removed here if anything fails
+        try:
+            try:
+                manifest_key = unwrap_file_key(self.class_keys, manifest_plist['ManifestKey'])
+            except InvalidUnwrap:
+                raise ValueError('Wrong password for encrypted backup')
+            self.manifest_db_path = os.path.join(self.tmp_dir, PhoneDB.MANIFEST_DB_FILENAME)
+            decrypt_file(os.path.join(backup_dir, PhoneDB.MANIFEST_DB_FILENAME),
+                         self.manifest_db_path, manifest_key)
+            strip_sqlite_padding(self.manifest_db_path)
+        except BaseException:
+            self.close()
+            raise
+
+    def decrypt_files(self, paths):
+        """ Decrypts files from the backup (each one only once, however often it's asked for)
+        @param paths: an iterable of physical paths of files in the backup (as resolved through
+        Manifest.db, e.g. by a ManifestResolver)
+        @return: a dict of path in the backup to the path of its decrypted copy
+        """
+        paths = set(paths)
+        pending = [path for path in paths if path not in self.decrypted]
+        if pending:
+            file_keys = self.__file_keys([os.path.basename(path) for path in pending])
+            jobs = [(path, os.path.join(self.tmp_dir, os.path.basename(path))) + \
+                    file_keys[os.path.basename(path)] for path in pending]
+            if len(jobs) == 1:
+                decrypt_file(*jobs[0])
+            else:
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    for future in [executor.submit(decrypt_file, *job) for job in jobs]:
+                        future.result()
+            for job in jobs:
+                self.decrypted[job[0]] = job[1]
+        return dict((path, self.decrypted[path]) for path in paths)
+
+    def __file_keys(self, file_ids):
+        manifest_db = ManifestDB(self.manifest_db_path, **PhoneDB.BACKUP_DB_OPTIONS)
+        manifest_db.connect()
+        try:
+            file_blobs = manifest_db.get_file_blobs(file_ids)
+        finally:
+            manifest_db.close()
+        file_keys = {}
+        for file_id in file_ids:
+            if file_blobs.get(file_id) is None:
+                raise FileNotFoundError('{} is not in the manifest database'.format(file_id))
+            wrapped_key, size = parse_file_info(file_blobs[file_id])
+            if wrapped_key is None:
+                raise ValueError('{} has no encryption key'.format(file_id))
+            file_keys[file_id] = (unwrap_file_key(self.class_keys, wrapped_key), size)
+        return file_keys
+
+    def close(self):
+        """ Removes all of the decrypted files """
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
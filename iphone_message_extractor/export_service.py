@@ -0,0 +1,126 @@
+import asyncio
+import functools
+
+from .message_extractor import extract_messages
+from .progress import ProgressReporter, ExportCancelled
+
+# Exports are mostly SQLite and file I/O, which release the GIL, so a few can usefully overlap
+DEFAULT_MAX_CONCURRENT_EXPORTS = 4
+
+# The stage of jobs waiting for a free slot (see ExportService)
+QUEUED_STAGE = 'queued'
+
+
+class ExportJob():
+    """ An export started by ExportService.start. Iterate over it (async for) to get its
+    ExportProgress events as they happen, until it finishes; await result() for its row count """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.events = asyncio.Queue()
+        self.reporter = ProgressReporter(self.__put_event, output_path)
+        self.loop = asyncio.get_running_loop()
+        self.task = None
+
+    def __put_event(self, event):
+        # Called in the export's thread
+        self.loop.call_soon_threadsafe(self.events.put_nowait, event)
+
+    def cancel(self):
+        """ Asks the export to stop; it raises ExportCancelled once it notices (exports that are
+        still queued never start) """
+        self.reporter.cancel()
+
+    def done(self):
+        return self.task.done()
+
+    async def result(self):
+        """ Waits for the export to finish
+        @return: the number of messages written
+        @raise ExportCancelled: if it was cancelled
+        @raise asyncio.TimeoutError: if it ran for longer than its timeout
+        """
+        return await self.task
+
+    def __aiter__(self):
+        return self.__iter_events()
+
+    async def __iter_events(self):
+        while True:
+            event = await self.events.get()
+            if event is None:
+                return
+            yield event
+
+
+class ExportService():
+    """ Runs exports from asyncio code. Each export (extract_messages, including its SQLite
+    stages) runs in a thread executor so the event loop is never blocked, and at most
+    max_concurrent_exports run at once; the rest wait their turn. For example:
+
+        service = ExportService(max_concurrent_exports=2)
+        job = service.start(backup_dir, output_path, 'US', timeout=600)
+        async for event in job:
+            print(event.stage, event.rows, event.total_rows, event.eta)
+        row_count = await job.result()
+
+    Cancelling is cooperative: the export stops at the next stage or batch of messages, closing
+    its connections and files on the way out
+    """
+
+    def __init__(self, max_concurrent_exports=DEFAULT_MAX_CONCURRENT_EXPORTS, executor=None):
+        """
+        @param max_concurrent_exports: how many exports can run at once
+        @param executor: the concurrent.futures executor to run exports in (default=None, the
+        event loop's default thread pool)
+        """
+        self.max_concurrent_exports = max_concurrent_exports
+        self.semaphore = asyncio.Semaphore(max_concurrent_exports)
+        self.executor = executor
+
+    def start(self, backup_dir, output_path, assumed_country_code, timeout=None, **options):
+        """ Starts an export in the background (must be called from a running event loop)
+        @param backup_dir: see extract_messages
+        @param output_path: see extract_messages
+        @param assumed_country_code: see extract_messages
+        @param timeout: the seconds the export may run for before it's cancelled and raises
+        asyncio.TimeoutError, not counting time queued for a free slot (default=None, no limit)
+        @param options: any other keyword arguments for extract_messages
+        @return: an ExportJob
+        """
+        job = ExportJob(output_path)
+        run = functools.partial(extract_messages, backup_dir, output_path, assumed_country_code,
+                                progress=job.reporter, **options)
+        job.task = asyncio.ensure_future(self.__run(job, run, timeout))
+        return job
+
+    async def export(self, backup_dir, output_path, assumed_country_code, timeout=None,
+                     **options):
+        """ Runs an export and waits for it, e.g. when its progress isn't needed (see start)
+        @return: the number of messages written
+        """
+        return await self.start(backup_dir, output_path, assumed_country_code, timeout,
+                                **options).result()
+
+    async def __run(self, job, run, timeout):
+        try:
+            job.reporter.report(QUEUED_STAGE)
+            async with self.semaphore:
+                if job.reporter.cancelled.is_set():
+                    raise ExportCancelled('Export cancelled while queued')
+                future = asyncio.get_running_loop().run_in_executor(self.executor, run)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    # The thread can't be stopped from here, so ask it to stop and wait until it
+                    # has (and closed its files) before giving up its slot, even if cancelled
+                    # again meanwhile. However it stops, the timeout or cancellation is raised
+                    job.cancel()
+                    while not future.done():
+                        try:
+                            await asyncio.shield(future)
+                        except (Exception, asyncio.CancelledError):
+                            pass
+                    raise
+        finally:
+            job.events.put_nowait(None)
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+
+# Bump whenever the layout of the state file (or the exported rows) changes so that old state
+# files force a full rebuild instead of appending mismatched rows
+STATE_VERSION = 2
+
+def state_path_for_output(output_path):
+    """ The sidecar file that records what has already been exported to output_path """
+    return output_path + '.state.json'
+
+def contacts_snapshot(contacts_dict, handle_dict):
+    """ The names that the handles in sms.db map onto. Only contacts that someone has actually
+    messaged with are included, so address book edits that don't affect any exported row (new
+    contacts, changes to people you've never texted) don't force a full rebuild
+    @param contacts_dict: the dictionary of canonical phone numbers/e-mails to names
+    @param handle_dict: the dictionary of raw handle.id values to canonical phone numbers/e-mails
+    @return: a dict of canonical phone number/e-mail: [first name, last name] (or None if it
+    isn't in the address book), as it's stored in the state file
+    """
+    keys = sorted(set(key for key in handle_dict.values() if key is not None))
+    return dict((key, None if contacts_dict.get(key) is None else list(contacts_dict[key]))
+                for key in keys)
+
+def contacts_snapshot_hash(snapshot):
+    """ Hashes a contacts_snapshot (for settings that have to match exactly, e.g. resuming a split
+    export)
+    @return: a hex digest
+    """
+    return hashlib.sha256(json.dumps(sorted(snapshot.items())).encode('utf-8')).hexdigest()
+
+def names_unchanged(previous_snapshot, snapshot):
+    """ Whether every handle in a previous contacts_snapshot still maps onto the same name. Handles
+    that are new since (e.g. someone who has just messaged for the first time) don't matter, as
+    nothing has been exported for them yet
+    """
+    return all(key in snapshot and snapshot[key] == name
+               for key, name in previous_snapshot.items())
+
+def load_export_state(output_path):
+    """ Loads the state of the previous export to output_path
+    @return: a dict with max_rowid, max_date and contacts, or None if there's no (usable)
+    previous state
+    """
+    try:
+        with open(state_path_for_output(output_path)) as fp:
+            state = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    return state if state.get('version') == STATE_VERSION else None
+
+def save_export_state(output_path, high_water_mark, contacts, header_row,
+                      date_settings=None, filters=None):
+    """ Atomically records the state of a completed export to output_path
+    @param high_water_mark: a tuple of (max message.ROWID, max message.date) that was exported
+    @param contacts: the contacts_snapshot used for the export
+    @param header_row: the columns that were exported
+    @param date_settings: the [timezone, date format] the dates were written with
+    @param filters: the settings of the phone_db.MessageFilter the messages were picked with
+    """
+    state = {'version': STATE_VERSION, 'max_rowid': high_water_mark[0],
+             'max_date': high_water_mark[1], 'contacts': contacts,
+             'header_row': header_row, 'date_settings': date_settings, 'filters': filters}
+    state_path = state_path_for_output(output_path)
+    with open(state_path + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.replace(state_path + '.tmp', state_path)
+
+def clear_export_state(output_path):
+    """ Removes the state of the previous export to output_path (if any) """
+    try:
+        os.remove(state_path_for_output(output_path))
+    except FileNotFoundError:
+        pass
+
+def can_append(state, output_path, high_water_mark, contacts, header_row,
+               date_settings=None, filters=None):
+    """ Decides whether new messages can simply be appended to the previous export or whether it
+    needs to be rebuilt from scratch (no previous export, names of people in it changed or gone,
+    different columns, date settings or filters, or the sms.db has gone backwards, e.g. a device
+    was restored from an older backup). New handles alone don't need a rebuild
+    """
+    if state is None or not os.path.isfile(output_path):
+        return False
+    if state.get('header_row') != header_row or state.get('date_settings') != date_settings or \
+            state.get('filters') != filters:
+        return False
+    if not names_unchanged(state['contacts'], contacts) or state['max_rowid'] is None:
+        return False
+    max_rowid, max_date = high_water_mark
+    return max_rowid is not None and max_rowid >= state['max_rowid'] and \
+        max_date >= state['max_date']
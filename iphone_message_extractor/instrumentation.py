@@ -0,0 +1,222 @@
+import cProfile
+import io
+import json
+import pstats
+import re
+import sqlite3
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Bump whenever the layout of the report changes
+REPORT_VERSION = 1
+
+# How many functions/allocation sites make it into a report
+TOP_COUNT = 20
+
+def report_path_for_output(output_path):
+    """ Where the profile report for an export to output_path is written """
+    return output_path + '.profile.json'
+
+def query_label(sql):
+    """ A short, stable name for a SQL statement (whitespace collapsed, truncated) """
+    sql = re.sub(r"--[^\n]*", " ", sql)
+    sql = re.sub(r"\s+", " ", sql).strip()
+    return sql if len(sql) <= 100 else sql[:97] + '...'
+
+def stage(profiler, name, progress=None):
+    """ profiler.stage(name), or a context manager that does nothing if profiler is None. If a
+    progress.ProgressReporter is given, the stage is reported to it first (raising ExportCancelled
+    if the export has been cancelled) """
+    if progress is not None:
+        progress.report(name)
+    return nullcontext() if profiler is None else profiler.stage(name)
+
+
+class Profiler():
+    """ Collects where an export spends its time: named stages, every SQLite query (see
+    ProfiledConnection), counters (rows, cache hits, etc.) and optionally a cProfile and/or
+    tracemalloc capture of the whole run. Nothing is recorded unless a Profiler is passed in, so
+    normal exports pay nothing for it
+    """
+
+    def __init__(self, cpu=False, memory=False):
+        """
+        @param cpu: capture a cProfile of the run (adds a lot of overhead to Python code)
+        @param memory: capture peak memory use and the top allocation sites with tracemalloc
+        """
+        self.stages = {}
+        self.queries = {}
+        self.counters = {}
+        self.caches = {}
+        self.cpu_profile = cProfile.Profile() if cpu else None
+        self.memory = memory
+        self.memory_report = None
+        self.start_time = None
+        self.seconds = None
+
+    def start(self):
+        """ Starts the clock (and the cProfile/tracemalloc captures) """
+        if self.memory:
+            tracemalloc.start()
+        if self.cpu_profile is not None:
+            self.cpu_profile.enable()
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.start_time
+        if self.cpu_profile is not None:
+            self.cpu_profile.disable()
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            self.memory_report = {
+                'peak_bytes': tracemalloc.get_traced_memory()[1],
+                'top': [{'location': str(stat.traceback), 'bytes': stat.size,
+                         'allocations': stat.count}
+                        for stat in snapshot.statistics('lineno')[:TOP_COUNT]]}
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """ Times a stage of the export (stages that run more than once add up) """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def record_query(self, sql, seconds, rows=0):
+        """ Adds a call to a SQL statement (an execute or a fetch of its results) """
+        stats = self.queries.setdefault(query_label(sql), {'seconds': 0, 'calls': 0, 'rows': 0})
+        stats['seconds'] += seconds
+        stats['calls'] += 1
+        stats['rows'] += rows
+
+    def count(self, name, value):
+        """ Records (or overwrites) a counter, e.g. the number of rows exported """
+        self.counters[name] = value
+
+    def record_cache(self, name, hits, misses):
+        """ Records a cache's hit rate """
+        lookups = hits + misses
+        self.caches[name] = {'hits': hits, 'misses': misses,
+                             'hit_rate': hits / lookups if lookups else None}
+
+    def report(self):
+        """ The report as a dict (see write_report) """
+        rows = self.counters.get('rows')
+        report = {'version': REPORT_VERSION,
+                  'sqlite': sqlite3.sqlite_version,
+                  'seconds': self.seconds,
+                  'rows_per_second': rows / self.seconds if rows and self.seconds else None,
+                  'stages': self.stages,
+                  'queries': sorted(({'sql': sql, **stats} for sql, stats in self.queries.items()),
+                                    key=lambda query: -query['seconds']),
+                  'counters': self.counters,
+                  'caches': self.caches}
+        if self.cpu_profile is not None:
+            stats = pstats.Stats(self.cpu_profile, stream=io.StringIO())
+            stats.sort_stats('cumulative')
+            report['cpu'] = [{'function': '{}:{}({})'.format(*function), 'calls': calls,
+                              'seconds': total_time, 'cumulative_seconds': cumulative_time}
+                             for function, (_, calls, total_time, cumulative_time, _)
+                             in sorted(stats.stats.items(), key=lambda item: -item[1][3])
+                             [:TOP_COUNT]]
+        if self.memory_report is not None:
+            report['memory'] = self.memory_report
+        return report
+
+    def dump_cpu_profile(self, path):
+        """ Saves the raw cProfile data (for pstats, snakeviz, etc.) if there is any """
+        if self.cpu_profile is not None:
+            self.cpu_profile.dump_stats(path)
+
+
+def write_report(path, report):
+    """ Writes a Profiler report to path as JSON """
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+def save_profile(profiler, output_path):
+    """ Writes the report of a (stopped) profiler for an export to output_path next to it, along
+    with the raw cProfile data if there is any
+    @return: the report
+    """
+    report = profiler.report()
+    write_report(report_path_for_output(output_path), report)
+    profiler.dump_cpu_profile(output_path + '.prof')
+    return report
+
+def format_report(report, query_count=5):
+    """ Human-readable summary of a Profiler report """
+    lines = ['Finished in {:.2f}s'.format(report['seconds']) + \
+             (' ({:,.0f} rows/s)'.format(report['rows_per_second'])
+              if report['rows_per_second'] else '')]
+    for name, seconds in report['stages'].items():
+        lines.append('  {:<24} {:>9.3f}s'.format(name, seconds))
+    if report['queries']:
+        lines.append('Slowest queries:')
+        for query in report['queries'][:query_count]:
+            lines.append('  {:>9.3f}s {:>8} rows  {}'.format(query['seconds'], query['rows'],
+                                                             query['sql'][:60]))
+    for name, cache in report['caches'].items():
+        lines.append('{} cache: {} hits, {} misses{}'.format(
+            name.capitalize(), cache['hits'], cache['misses'],
+            '' if cache['hit_rate'] is None else ' ({:.0%})'.format(cache['hit_rate'])))
+    for name, value in report['counters'].items():
+        lines.append('{}: {}'.format(name, value))
+    if 'memory' in report:
+        lines.append('Peak memory (Python): {:.1f} MB'.format(report['memory']['peak_bytes'] / 1e6))
+    if 'cpu' in report:
+        lines.append('Top functions (cumulative):')
+        for function in report['cpu'][:query_count]:
+            lines.append('  {:>9.3f}s  {}'.format(function['cumulative_seconds'],
+                                                 function['function']))
+    return '\n'.join(lines)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """ A cursor that times every execute and fetch and reports them to its connection's
+    profiler, so the PhoneDB subclasses don't need any timing code of their own """
+
+    def execute(self, sql, parameters=()):
+        self.sql = sql
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.profiler.record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.sql = sql
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.profiler.record_query(sql, time.perf_counter() - start,
+                                                  max(self.rowcount, 0))
+
+    def fetchone(self):
+        return self.__timed(super().fetchone, lambda row: int(row is not None))
+
+    def fetchmany(self, size=None):
+        return self.__timed(lambda: super(ProfiledCursor, self).fetchmany(
+            self.arraysize if size is None else size), len)
+
+    def fetchall(self):
+        return self.__timed(super().fetchall, len)
+
+    def __timed(self, fetch, row_count):
+        start = time.perf_counter()
+        result = fetch()
+        self.connection.profiler.record_query(self.sql, time.perf_counter() - start,
+                                              row_count(result))
+        return result
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """ sqlite3 connection whose cursors are ProfiledCursors (pass as the factory to
+    sqlite3.connect and set .profiler) """
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
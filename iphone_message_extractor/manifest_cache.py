@@ -0,0 +1,105 @@
+import json
+import os
+
+from .phone_db import PhoneDB, ManifestDB
+from . import util
+
+# Bump whenever the layout of the cache files changes
+CACHE_VERSION = 1
+
+class ManifestResolver():
+    """ Resolves files in a backup from their (domain, relativePath) on the device to their
+    physical path in the backup, in batches. Resolved fileIDs can be cached on disk per backup
+    (keyed on the Manifest.db mtime and size, so the cache is thrown out whenever the backup
+    changes), which saves repeated runs and attachment lookups from going back to Manifest.db
+    """
+
+    def __init__(self, backup_dir, cache_dir=None, profiler=None, manifest_db_path=None):
+        """
+        @param backup_dir: the path to the backup (where Manifest.db is)
+        @param cache_dir: the directory to keep the cache in (default=None, no on-disk cache)
+        @param profiler: an instrumentation.Profiler to report Manifest.db queries to
+        @param manifest_db_path: the Manifest.db to query, if not the one in backup_dir (e.g. a
+        decrypted copy of it)
+        """
+        self.backup_dir = backup_dir
+        self.profiler = profiler
+        # Lookups answered from the cache vs. ones that had to go to Manifest.db
+        self.stats = {'hits': 0, 'misses': 0}
+        self.manifest_db_path = manifest_db_path or \
+            os.path.join(backup_dir, PhoneDB.MANIFEST_DB_FILENAME)
+        self.cache_path = None
+        if cache_dir is not None:
+            self.cache_path = os.path.join(cache_dir, 'manifest-{}.json'.format(
+                os.path.basename(os.path.normpath(backup_dir))))
+        stat = os.stat(self.manifest_db_path)
+        self.manifest_key = [stat.st_mtime_ns, stat.st_size]
+        # (domain, relativePath): fileID, or None for files known not to be in the backup
+        self.file_ids = self.__load_cache()
+
+    def resolve(self, domain_paths):
+        """ Resolves many files at once (only files not already cached hit Manifest.db)
+        @param domain_paths: an iterable of (domain, relativePath) tuples
+        @return: a dict of (domain, relativePath): full path to the file in the backup, for the
+        files that are in the backup
+        """
+        domain_paths = set(tuple(domain_path) for domain_path in domain_paths)
+        missing = [domain_path for domain_path in domain_paths if domain_path not in self.file_ids]
+        self.stats['hits'] += len(domain_paths) - len(missing)
+        self.stats['misses'] += len(missing)
+        if missing:
+            manifest_db = ManifestDB(self.manifest_db_path, profiler=self.profiler,
+                                     **PhoneDB.BACKUP_DB_OPTIONS)
+            manifest_db.connect()
+            try:
+                found = manifest_db.get_file_ids(missing)
+            finally:
+                manifest_db.close()
+            for domain_path in missing:
+                self.file_ids[domain_path] = found.get(domain_path)
+            self.__save_cache()
+
+        return dict((domain_path, os.path.join(self.backup_dir,
+                                               util.hash_to_path(self.file_ids[domain_path])))
+                    for domain_path in domain_paths if self.file_ids[domain_path] is not None)
+
+    def get_physical_paths(self, domain_paths):
+        """ Like resolve, but every file has to be in the backup
+        @raise FileNotFoundError: if one of them isn't
+        """
+        domain_paths = [tuple(domain_path) for domain_path in domain_paths]
+        paths = self.resolve(domain_paths)
+        for domain_path in domain_paths:
+            if domain_path not in paths:
+                raise FileNotFoundError("Backup is corrupt or in progress. Failed to find {} in \
+                                        the manifest database. Please verify contents are \
+                                        intact.".format('/'.join(domain_path)))
+        return paths
+
+    def get_physical_path(self, domain_path):
+        """ Resolves a single file, raising FileNotFoundError if it isn't in the backup """
+        return self.get_physical_paths([domain_path])[tuple(domain_path)]
+
+    def __load_cache(self):
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if cache.get('version') != CACHE_VERSION or cache.get('manifest') != self.manifest_key:
+            return {}
+        return dict(((domain, relative_path), file_id)
+                    for domain, relative_path, file_id in cache['files'])
+
+    def __save_cache(self):
+        if self.cache_path is None:
+            return
+        cache = {'version': CACHE_VERSION, 'manifest': self.manifest_key,
+                 'files': [[domain, relative_path, file_id]
+                           for (domain, relative_path), file_id in self.file_ids.items()]}
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with open(self.cache_path + '.tmp', 'w') as fp:
+            json.dump(cache, fp)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
@@ -1,21 +1,104 @@
 import os
 import plistlib as pll
 import csv
+import functools
+import itertools
+import json
+import operator
+import re
+import tempfile
 
-from .phone_db import PhoneDB, ManifestDB, AddressDB, MessageDB
-from . import util
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+from .phone_db import PhoneDB, ManifestDB, AddressDB, MessageDB, MessageFilter
+from .contact_store import ContactStore
+from .manifest_cache import ManifestResolver
+from . import attachments, compressed_output, export_state, schema, search_index, shards, \
+    split_output, util
+from .instrumentation import stage
+from .encryption import EncryptedBackup
 
 MANIFEST_PLIST_FILENAME = 'Manifest.plist'
 
-def extract_messages(backup_dir, output_path, assumed_country_code):
+# How messages get matched to contacts: 'python' builds a dict from the address book and looks up
+# each message in Python, 'sql' ATTACHes the address book to sms.db and does the join in SQLite
+ENGINES = ('python', 'sql')
+
+def extract_messages(backup_dir, output_path, assumed_country_code,
+                     batch_size=MessageDB.DEFAULT_BATCH_SIZE, incremental=False,
+                     output_format='csv', engine='python', cache_dir=None,
+                     attachments_dir=None, attachment_workers=None, chats=False,
+                     timezone=None, date_format=util.DEFAULT_DATE_FORMAT, profiler=None,
+                     password=None, decryption_workers=None, fallback_country_codes=None,
+                     query_workers=None, progress=None, compression=None, split_rows=None,
+                     split_bytes=None, split_by=None, resume=False, since=None, until=None,
+                     contacts=None, service=None, from_me=None, tapbacks='keep'):
     """ Primary message extract function that gathers backup info from the Manifest Plist and path data
     (that is, the physical location of the AddressBook.sqlite.db and sms.db files) from the Manifest
     DB, converts the AddressBook to a dict with phone nums as keys, and then maps these onto
     SMS/iMessages before exporting the messages to CSV
     @param backup_dir: the path to the backup/all the goodies (where Manifest.db is)
-    @param output_path: the path to write the CSV (or PSV, etc.) output 
+    @param output_path: the path to write the CSV (or PSV, Parquet, etc.) output 
     @param assumed_country_code: two-letter country code to assume when numbers lack one
-    @return:
+    @param batch_size: the number of messages to pull from sms.db at a time; messages are streamed
+    straight through to the CSV so memory use doesn't grow with the size of the backup
+    @param incremental: if True, only messages newer than the previous export to output_path are
+    appended to it (see export_state.py); the file is rebuilt from scratch when there is no usable
+    previous export or when names of people in the export have changed in the address book
+    (formats that can't be appended to are always rebuilt)
+    @param output_format: one of OUTPUT_FORMATS (default=csv)
+    @param engine: one of ENGINES (default=python); the output is the same either way, but the sql
+    engine avoids most of the per-message Python overhead on large exports
+    @param cache_dir: the directory to cache Manifest.db lookups in (default=None, no cache)
+    @param attachments_dir: if given, attachments (photos, videos, etc.) are copied here (see
+    attachments.py) and the output gets an 'Attachments' column with their paths
+    @param attachment_workers: the number of threads to copy attachments with
+    @param chats: if True, the output is ordered by conversation (including group chats and
+    messages you sent without a handle) and gets 'Chat', 'Chat Name' and 'Participants' columns
+    @param timezone: the timezone to show dates in, e.g. 'UTC' or 'Europe/London' (default=None,
+    the local timezone)
+    @param date_format: the strftime format for dates in text outputs (default=
+    '%Y-%m-%d %H:%M:%S'); columnar outputs always store real timestamps (in timezone, or UTC)
+    @param profiler: an instrumentation.Profiler to record stage and query timings, row counts
+    and cache hit rates in (default=None, nothing is recorded)
+    @param password: the password of an encrypted backup (see encryption.py)
+    @param decryption_workers: the number of processes to decrypt files from an encrypted backup
+    with (default=number of CPUs)
+    @param fallback_country_codes: two-letter country codes to try, in order, for numbers without
+    one that aren't valid in assumed_country_code (see util.NormalizationContext)
+    @param query_workers: the number of processes to query and map messages with, each one taking
+    its own shards of sms.db (see shards.py); python engine only (default=None, just this one)
+    @param progress: a progress.ProgressReporter to report each stage and batch of messages
+    written to, and to cancel the export with (default=None, nothing is reported)
+    @param compression: compress the CSV with one of compressed_output.COMPRESSIONS (gzip, xz or
+    zstd; default=None, uncompressed)
+    @param split_rows: split the CSV into parts of at most this many messages (see
+    SplitMessageWriter)
+    @param split_bytes: split the CSV into parts of about this many bytes (before compression)
+    @param split_by: start a new part for every 'contact' or 'month' (see split_output.SPLIT_BY)
+    @param resume: pick a split export that was interrupted up again after its last complete part,
+    if it was written with the same settings from the same backup (otherwise it's started over)
+    @param since: only export messages from this date on ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS',
+    in timezone)
+    @param until: only export messages up to and including this date (the whole day if it's just
+    a date)
+    @param contacts: only export messages with these contacts: phone numbers/e-mails (along with
+    every other one of the same contact) or parts of names (see find_contact_keys)
+    @param service: only export messages sent over this service (one of MessageFilter.SERVICES)
+    @param from_me: only export messages you sent (True) or only ones you received (False)
+    @param tapbacks: what to do with tapbacks (reactions), which sms.db stores as messages of their
+    own: 'keep' them as they are, 'skip' them or 'fold' them into a 'Reactions' column of the
+    message they react to (see schema.TAPBACKS)
+    @return: the number of messages written
     """
 
     # Ensure that the required manifest files actually exist; otherwise throw an exception
@@ -26,56 +109,763 @@ def extract_messages(backup_dir, output_path, assumed_country_code):
                                  Please verify contents are intact.")
     
     # Determine if this is encrypted before we attempt to read the SQLite DB (this is a value
-    # in the Manifest Plist file). Encrypted backups are not [yet] supported
+    # in the Manifest Plist file)
     with open(manifest_plist_path, 'rb') as fp:
         pl = pll.load(fp)
+
+    # Only the files we need get decrypted (into a temp dir that's removed when we're done)
+    encrypted_backup = None
     if pl['IsEncrypted']:
-        raise ValueError('This backup is encrypted, but encrypted backups are not (yet) supported')
-    
-    # Get the real physical paths of the SMS and AddressBook SQLite3 DBS from the ManifestDB
-    manifest_db = ManifestDB(manifest_db_path)
-    manifest_db.connect()
-    sms_db_path = os.path.join(backup_dir, \
-                               manifest_db.get_physical_path_for_file(PhoneDB.SMS_DB_FILENAME))
-    address_book_db_path = os.path.join(backup_dir, \
-                                        manifest_db.get_physical_path_for_file( \
-                                            PhoneDB.ADDRESS_BOOK_FILENAME))
-    manifest_db.close()
-
-    # Get a dictionary/map of { number/email: [first name, last name] }
-    #
-    # e.g. {'frodo@shire.net': ['Frodo', 'Baggins'], '+1 212-555-1212': ['Samwise', 'Gamgee'], 
-    # '+1 646-555-1212': ['Meriadoc', 'Brandybuck'], '+1 646-400-1212': ['Frodo', 'Baggins']
-    address_db = AddressDB(address_book_db_path)
-    address_db.connect()
-    contacts_dict = address_db.generate_dict_from_address_book()
-    address_db.close()
-    
-    # Retrieve all messages and map on the correct contact name from the contacts_dict above
-    message_db = MessageDB(sms_db_path)
-    message_db.connect()
-    messages = message_db.match_messages_to_contact_dict(contacts_dict)
-    message_db.close()
+        if password is None:
+            raise ValueError('This backup is encrypted; its password is needed to extract it')
+        with stage(profiler, 'decrypt', progress):
+            encrypted_backup = EncryptedBackup(backup_dir, password, decryption_workers)
+
+    try:
+        normalize_cache_start = util.normalize_cache_info()
+
+        # Get the real physical paths of the SMS and AddressBook SQLite3 DBS from the ManifestDB
+        # (both in one lookup)
+        with stage(profiler, 'manifest', progress):
+            if encrypted_backup is None:
+                manifest_resolver = ManifestResolver(backup_dir, cache_dir, profiler)
+            else:
+                # Paths in the manifest are as sensitive as anything else in the backup, so
+                # they're never cached on disk in the clear
+                manifest_resolver = ManifestResolver(backup_dir, None, profiler,
+                                                     encrypted_backup.manifest_db_path)
+            db_paths = manifest_resolver.get_physical_paths([ManifestDB.SMS_DB_DOMAIN_PATH,
+                                                             ManifestDB.ADDRESS_BOOK_DOMAIN_PATH])
+            sms_db_path = db_paths[ManifestDB.SMS_DB_DOMAIN_PATH]
+            address_book_db_path = db_paths[ManifestDB.ADDRESS_BOOK_DOMAIN_PATH]
+
+        if encrypted_backup is not None:
+            # Decrypt both DBs at once (in parallel)
+            with stage(profiler, 'decrypt', progress):
+                decrypted_paths = encrypted_backup.decrypt_files([sms_db_path,
+                                                                  address_book_db_path])
+            sms_db_path = decrypted_paths[sms_db_path]
+            address_book_db_path = decrypted_paths[address_book_db_path]
+
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine: {}'.format(engine))
+        if query_workers is not None and query_workers > 1 and engine != 'python':
+            raise ValueError('Parallel queries need the python engine')
+        split = split_rows is not None or split_bytes is not None or split_by is not None
+        if (compression is not None or split) and output_format != 'csv':
+            raise ValueError('Only csv output can be compressed or split')
+        if resume and not split:
+            raise ValueError('Only split exports can be resumed')
+        if tapbacks not in schema.TAPBACKS:
+            raise ValueError('Unknown tapbacks option: {}'.format(tapbacks))
+
+        if output_format != 'csv':
+            # Writers that store real timestamps are given the dates as they are
+            date_format = None if writer_takes_raw_dates(output_format) \
+                else util.DEFAULT_DATE_FORMAT
+        tz = util.get_timezone(timezone)
+        date_converter = util.DateConverter(tz, date_format)
+        date_settings = [timezone, date_format]
+        since_timestamp = None if since is None else util.parse_date_bound(since, tz)
+        until_timestamp = None if until is None else util.parse_date_bound(until, tz, end=True)
+        normalization_context = util.NormalizationContext(assumed_country_code,
+                                                          fallback_country_codes)
+
+        # Get a dictionary/map of { number/email: [first name, last name] }
+        #
+        # e.g. {'frodo@shire.net': ['Frodo', 'Baggins'], '+1 212-555-1212': ['Samwise', 'Gamgee'], 
+        # '+1 646-555-1212': ['Meriadoc', 'Brandybuck'], '+1 646-400-1212': ['Frodo', 'Baggins']
+        if engine == 'python':
+            with stage(profiler, 'contacts', progress):
+                address_db = AddressDB(address_book_db_path, profiler=profiler,
+                                       **PhoneDB.BACKUP_DB_OPTIONS)
+                address_db.connect()
+                contacts_dict = address_db.generate_dict_from_address_book(normalization_context)
+                address_db.close()
     
-    # Dump the messages to the desired output path with a header row
-    header_row = ['Last Name', 'First Name', 'Phone #', 'Date & Time', 'Is from me?', \
-                  'Message', 'Service']
-    write_messages_to_csv(output_path, messages, header_row)
+        # Stream all messages (mapping on the correct contact name from the contacts_dict above)
+        # straight to the desired output path with a header row
+        header_row = ['Last Name', 'First Name', 'Phone #', 'Date & Time', 'Is from me?', \
+                      'Message', 'Service']
+        if chats:
+            header_row.extend(['Chat', 'Chat Name', 'Participants'])
+        if attachments_dir is not None:
+            header_row.append('Attachments')
+        if tapbacks == 'fold':
+            header_row.append('Reactions')
+        message_db = MessageDB(sms_db_path, profiler=profiler, **PhoneDB.BACKUP_DB_OPTIONS)
+        message_db.connect()
+        try:
+            with stage(profiler, 'handles', progress):
+                handle_dict = message_db.generate_handle_dict(normalization_context)
+                high_water_mark = message_db.get_high_water_mark()
+            if engine == 'sql':
+                # Load the address book into sms.db's connection instead; the only contacts we
+                # still need in Python are the ones for the incremental snapshot and chats
+                with stage(profiler, 'contacts', progress):
+                    message_db.attach_address_book(address_book_db_path, normalization_context,
+                                                   handle_dict)
+                    contacts_dict = message_db.get_attached_contacts_dict() \
+                        if incremental or chats or split or contacts or tapbacks == 'fold' \
+                        else None
+
+            # Filters are resolved to handles and timestamps up front and go into the WHERE of
+            # every query, so only the messages that are wanted are ever read
+            message_filter = None
+            if since is not None or until is not None or contacts or service is not None or \
+                    from_me is not None or tapbacks != 'keep':
+                handle_rowids = None
+                if contacts:
+                    handle_rowids = message_db.get_handle_rowids(
+                        find_contact_keys(contacts, contacts_dict, normalization_context),
+                        handle_dict)
+                message_filter = MessageFilter(since_timestamp, until_timestamp, handle_rowids,
+                                               service, from_me, tapbacks != 'keep', chats)
+            filter_settings = None if message_filter is None else message_filter.settings()
+
+            # Resolve every conversation and its participants once up front
+            chat_dict = None
+            if chats:
+                with stage(profiler, 'chats', progress):
+                    chat_dict = message_db.generate_chat_dict(contacts_dict, handle_dict)
+
+            # ...and the tapbacks on every message, when they're folded into them
+            reaction_dict = None
+            if tapbacks == 'fold':
+                with stage(profiler, 'reactions', progress):
+                    reaction_dict = message_db.generate_reaction_dict(contacts_dict, handle_dict)
+
+            # For incremental exports, only pick up messages added since the last run (if the
+            # previous export is still valid)
+            rowid_range, append = None, False
+            contacts_snapshot = export_state.contacts_snapshot(contacts_dict, handle_dict) \
+                if incremental or split else None
+            if incremental:
+                state = export_state.load_export_state(output_path)
+                if writer_supports_append(output_format) and not split and \
+                        export_state.can_append(state, output_path, high_water_mark,
+                                                contacts_snapshot, header_row, date_settings,
+                                                filter_settings):
+                    rowid_range, append = (state['max_rowid'], high_water_mark[0]), True
+                # If this export dies part way through, the next one has to start over
+                export_state.clear_export_state(output_path)
+
+            # Copy the attachments of the messages being exported out of the backup first, so that
+            # rows can reference where they ended up
+            attachment_dict = None
+            if attachments_dir is not None:
+                with stage(profiler, 'attachments', progress):
+                    attachment_dict, attachment_stats = attachments.export_attachments(
+                        message_db, manifest_resolver, attachments_dir, rowid_range,
+                        attachment_workers, encrypted_backup, message_filter)
+                if profiler is not None:
+                    for name, value in attachment_stats.items():
+                        profiler.count('attachments_' + name, value)
+
+            if engine == 'sql':
+                with stage(profiler, 'temp_tables', progress):
+                    if attachment_dict is not None:
+                        message_db.load_attachment_dict(attachment_dict)
+                    if chat_dict is not None:
+                        message_db.load_chat_dict(chat_dict)
+                    if reaction_dict is not None:
+                        message_db.load_reaction_dict(reaction_dict)
+                # SQLite formats dates itself unless they need another timezone or format
+                messages = message_db.iter_messages_joined_in_sql(
+                    batch_size, rowid_range, attachment_dict is not None, chat_dict is not None,
+                    None if date_settings == [None, util.DEFAULT_DATE_FORMAT] else date_converter,
+                    message_filter, reaction_dict is not None)
+            elif query_workers is not None and query_workers > 1:
+                # Every worker opens sms.db itself and takes its own shards of the messages
+                min_rowid, max_rowid = message_db.get_rowid_bounds()
+                messages = shards.iter_messages_in_parallel(
+                    sms_db_path, rowid_range or ((min_rowid or 1) - 1, max_rowid or 0),
+                    query_workers, contacts_dict, handle_dict, attachment_dict, chat_dict,
+                    timezone, date_format, batch_size, message_filter, reaction_dict)
+            else:
+                messages = message_db.iter_messages_matched_to_contact_dict(
+                    contacts_dict, batch_size, normalization_context, handle_dict, rowid_range,
+                    attachment_dict, chat_dict, date_converter, message_filter=message_filter,
+                    reaction_dict=reaction_dict)
+            if progress is not None:
+                messages = progress.iter_rows(
+                    messages, message_db.count_messages(rowid_range, chats, message_filter),
+                    batch_size)
+            # Querying, mapping and writing are all interleaved as the messages stream through
+            with stage(profiler, 'export', progress):
+                if split:
+                    # A rerun can only pick up the parts of one from the same backup
+                    writer = SplitMessageWriter(
+                        output_path, header_row, compression=compression, split_rows=split_rows,
+                        split_bytes=split_bytes, split_by=split_by, date_format=date_format,
+                        resume=resume, fingerprint=[high_water_mark,
+                                     export_state.contacts_snapshot_hash(contacts_snapshot),
+                                     date_settings, filter_settings])
+                else:
+                    writer = open_message_writer(output_format, output_path, header_row, append,
+                                                 compression, timezone)
+                if progress is not None:
+                    progress.writer = writer
+                with writer:
+                    row_count = writer.write_rows(messages)
+        finally:
+            message_db.close()
+
+        normalize_warnings = util.report_normalize_warnings()
+        if profiler is not None:
+            profiler.count('rows', row_count)
+            profiler.count('normalize_warnings', normalize_warnings)
+            profiler.count('appended', append)
+            profiler.count('query_workers', query_workers or 1)
+            normalize_cache = util.normalize_cache_info()
+            profiler.record_cache('normalize', normalize_cache.hits - normalize_cache_start.hits,
+                                  normalize_cache.misses - normalize_cache_start.misses)
+            profiler.record_cache('manifest', manifest_resolver.stats['hits'],
+                                  manifest_resolver.stats['misses'])
+
+        if incremental:
+            export_state.save_export_state(output_path, high_water_mark, contacts_snapshot,
+                                           header_row, date_settings, filter_settings)
+        if progress is not None:
+            progress.finish()
+        return row_count
+    finally:
+        if encrypted_backup is not None:
+            encrypted_backup.close()
+
+
+class MessageWriter():
+    """ Base class for output backends. A writer is opened on an output path with a header row,
+    fed rows (in as many calls to write_rows as you like) and then closed. Use it as a context
+    manager:
+
+        with CSVMessageWriter(output_path, header_row) as writer:
+            writer.write_rows(rows)
+    """
+
+    # Whether rows can be appended to an existing output (used for incremental exports)
+    SUPPORTS_APPEND = False
+    # Whether dates are given to the writer unformatted, as microseconds since 1970-01-01 UTC
+    # (see util.DateConverter), rather than as text. Such writers take a timezone argument
+    RAW_DATES = False
+
+    def __init__(self, output_path, header_row, append=False):
+        """
+        @param output_path: the path to write to
+        @param header_row: a list of column names
+        @param append: append rows to an existing output instead of overwriting it (only valid if
+        SUPPORTS_APPEND)
+        """
+        if append and not self.SUPPORTS_APPEND:
+            raise ValueError('{} does not support appending'.format(type(self).__name__))
+        self.output_path = output_path
+        self.header_row = header_row
+        self.append = append
+
+    def write_rows(self, rows):
+        """ Writes rows as they are consumed, so a generator is never materialized in full
+        @param rows: an iterable (list, generator, etc.) of rows
+        @return: the number of rows written
+        """
+        raise NotImplementedError
+
+    def bytes_written(self):
+        """ The size of the output so far (for progress reports; see progress.py) """
+        if os.path.isfile(self.output_path):
+            return os.path.getsize(self.output_path)
+        return 0
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CSVMessageWriter(MessageWriter):
+    """ Writes a CSV file (or other delimited file), optionally compressed on a background
+    thread (see compressed_output.py) """
+
+    SUPPORTS_APPEND = True
+
+    def __init__(self, output_path, header_row=None, append=False, delimiter=',',
+                 compression=None):
+        super().__init__(output_path, header_row, append)
+        if compression is None:
+            self.csv_file = open(output_path, 'a' if append else 'w', encoding='utf-8-sig',
+                                 newline='')
+        else:
+            # Appends go in a stream of their own at the end of the file
+            self.csv_file, _ = compressed_output.open_text(output_path, compression, append)
+        self.csv_writer = csv.writer(self.csv_file, delimiter=delimiter, \
+                                     quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        if header_row is not None and not append:
+            self.csv_writer.writerow(header_row)
+
+    def write_rows(self, rows):
+        # Count rows as writerows consumes them without dropping into a per-row Python loop
+        # (zip stops before pulling from the counter once rows is exhausted)
+        counter = itertools.count()
+        self.csv_writer.writerows(map(operator.itemgetter(0), zip(rows, counter)))
+        return next(counter)
+
+    def close(self):
+        self.csv_file.close()
+
+
+class SplitMessageWriter(MessageWriter):
+    """ Writes a CSV export as a series of parts, each a complete CSV with its own header
+    (optionally compressed), plus a manifest listing them (see split_output.py). A new part is
+    started every split_rows messages, every split_bytes of CSV (before compression; checked every
+    ROWS_PER_CHECK messages, so parts can go a little over) and/or whenever the split_by key
+    changes. Only one part is open at a time.
+
+    Messages don't come in date order, so when split by month they're first spooled, uncompressed,
+    to a temp file per month (next to the output); each month is then written out in turn when
+    the writer is closed.
+
+    With resume=True, an interrupted export with the same settings is picked up after its last
+    complete part (or month): the messages already in the parts are skipped rather than written
+    again
+    """
+
+    SUPPORTS_APPEND = False
+
+    ROWS_PER_CHECK = 1000
+
+    def __init__(self, output_path, header_row, append=False, compression=None, split_rows=None,
+                 split_bytes=None, split_by=None, date_format=util.DEFAULT_DATE_FORMAT,
+                 resume=False, fingerprint=None):
+        """
+        @param output_path: the path the parts and manifest are named after
+        @param header_row: a list of column names
+        @param compression: one of compressed_output.COMPRESSIONS (default=None, uncompressed)
+        @param split_rows: the most messages in a part
+        @param split_bytes: about the most bytes of CSV in a part
+        @param split_by: one of split_output.SPLIT_BY
+        @param date_format: the strftime format of the dates in the rows (to split by month)
+        @param resume: pick up the parts of an interrupted export with the same settings
+        @param fingerprint: anything (JSON) else that has to match to resume, e.g. what the rows
+        were exported from
+        """
+        super().__init__(output_path, header_row, append)
+        self.compression = compression
+        self.split_rows = split_rows
+        self.split_bytes = split_bytes
+        self.by_month = split_by == 'month'
+        self.split_key = split_output.split_key(header_row, split_by, date_format)
+        # Round-tripped through JSON so that it compares equal to the one in a manifest
+        self.settings = json.loads(json.dumps({
+            'header_row': header_row, 'compression': compression, 'split_rows': split_rows,
+            'split_bytes': split_bytes, 'split_by': split_by, 'date_format': date_format,
+            'fingerprint': fingerprint}))
+        manifest = split_output.load_manifest(output_path)
+        if resume and split_output.check_parts(output_path, manifest, self.settings):
+            self.parts, self.rows = manifest['parts'], manifest['rows']
+        else:
+            split_output.remove_parts(output_path, manifest)
+            self.parts, self.rows = [], 0
+        # Parts are only ever complete in the order the messages come in, except by month
+        self.skip_rows = 0 if self.by_month else self.rows
+        self.done_keys = set(part['key'] for part in self.parts) if self.by_month else set()
+        self.part = None
+        self.spool_dir = None
+        self.spooled_keys = set()
+        if self.by_month:
+            self.spool_dir = tempfile.TemporaryDirectory(
+                prefix='.' + os.path.basename(output_path) + '-',
+                dir=os.path.dirname(os.path.abspath(output_path)))
+
+    def write_rows(self, rows):
+        rows, row_count = iter(rows), 0
+        if self.skip_rows:
+            # These are already in the parts being resumed
+            skipped = sum(1 for _ in itertools.islice(rows, self.skip_rows))
+            self.skip_rows -= skipped
+            row_count += skipped
+        if self.split_key is None:
+            return row_count + self.__write_run(None, rows)
+        for key, run in itertools.groupby(rows, self.split_key):
+            if key in self.done_keys:
+                row_count += sum(1 for _ in run)
+            elif self.by_month:
+                row_count += self.__spool_run(key, run)
+            else:
+                row_count += self.__write_run(key, run)
+        return row_count
+
+    def __write_run(self, key, run):
+        """ Writes consecutive rows with the same key to the open part (or new ones) """
+        if self.part is not None and self.part['key'] != key:
+            self.__close_part()
+        row_count = 0
+        for row in run:
+            if self.part is None:
+                self.__open_part(key)
+            chunk = [row]
+            chunk.extend(itertools.islice(run, self.__chunk_size() - 1))
+            self.csv_writer.writerows(chunk)
+            self.part['rows'] += len(chunk)
+            row_count += len(chunk)
+            if self.split_bytes is not None:
+                self.text_file.flush()
+                self.part['csv_bytes'] = self.raw_file.bytes_in
+            if self.__is_full():
+                self.__close_part()
+        return row_count
+
+    def __spool_run(self, key, run):
+        with open(self.__spool_path(key), 'a', encoding='utf-8', newline='') as fp:
+            counter = itertools.count()
+            csv.writer(fp).writerows(map(operator.itemgetter(0), zip(run, counter)))
+        self.spooled_keys.add(key)
+        return next(counter)
+
+    def __spool_path(self, key):
+        return os.path.join(self.spool_dir.name, key + '.csv')
+
+    def __chunk_size(self):
+        if self.split_rows is None:
+            return self.ROWS_PER_CHECK
+        return min(self.ROWS_PER_CHECK, self.split_rows - self.part['rows'])
+
+    def __is_full(self):
+        return (self.split_rows is not None and self.part['rows'] >= self.split_rows) or \
+            (self.split_bytes is not None and self.part['csv_bytes'] >= self.split_bytes)
+
+    def __open_part(self, key):
+        if self.by_month:
+            count = sum(1 for part in self.parts if part['key'] == key)
+            name = key if count == 0 else '{}.{}'.format(key, count + 1)
+        else:
+            name = '{:05d}'.format(len(self.parts) + 1)
+        self.part = {'path': os.path.basename(split_output.part_path(self.output_path, name,
+                                                                     self.compression)),
+                     'key': key, 'rows': 0, 'bytes': 0, 'csv_bytes': 0, 'sha256': None}
+        self.parts.append(self.part)
+        self.text_file, self.raw_file = compressed_output.open_text(
+            os.path.join(os.path.dirname(self.output_path), self.part['path']), self.compression)
+        self.csv_writer = csv.writer(self.text_file, quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self.csv_writer.writerow(self.header_row)
+
+    def __close_part(self):
+        self.text_file.close()
+        self.part['bytes'] = self.raw_file.size
+        self.part['csv_bytes'] = self.raw_file.bytes_in
+        self.part['sha256'] = self.raw_file.sha256.hexdigest()
+        self.rows += self.part['rows']
+        self.part = None
+        # Months are only done once all of their parts are
+        if not self.by_month:
+            self.__save_manifest()
+
+    def __save_manifest(self, complete=False):
+        split_output.save_manifest(self.output_path, self.settings, self.rows, self.parts,
+                                   complete)
+
+    def bytes_written(self):
+        """ The size of the parts so far, plus that of the months spooled but not yet written to
+        parts (there's nothing at output_path itself) """
+        written = sum(part['bytes'] for part in self.parts)
+        if self.part is not None:
+            written += self.raw_file.size
+        for key in self.spooled_keys:
+            written += os.path.getsize(self.__spool_path(key))
+        return written
+
+    def close(self):
+        for key in sorted(self.spooled_keys):
+            with open(self.__spool_path(key), encoding='utf-8', newline='') as fp:
+                self.__write_run(key, csv.reader(fp))
+            self.__close_part()
+            self.__save_manifest()
+        self.spooled_keys = set()
+        if self.part is not None:
+            self.__close_part()
+        self.__save_manifest(complete=True)
+        if self.spool_dir is not None:
+            self.spool_dir.cleanup()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # Leave the manifest at the last complete part, for a rerun to resume from
+        if self.part is not None:
+            self.text_file.close()
+        if self.spool_dir is not None:
+            self.spool_dir.cleanup()
+
+
+class ColumnarMessageWriter(MessageWriter):
+    """ Writes typed columns to a Parquet file with pyarrow (or an Arrow IPC/Feather file if
+    pyarrow was built without Parquet support or use_parquet=False). Unlike the CSV, dates are real
+    timestamps (to the microsecond, with their timezone), 'Is from me?' is a boolean and the
+    service is dictionary encoded. Rows are buffered and flushed one row group at a time, so
+    memory use is bounded by row_group_size
+    """
+
+    RAW_DATES = True
+    DEFAULT_ROW_GROUP_SIZE = 65536
+
+    # Columns (by header name) that get a type other than string
+    TIMESTAMP_COLUMNS = {'Date & Time'}
+    BOOLEAN_COLUMNS = {'Is from me?': 'Yes'}
+    CATEGORY_COLUMNS = {'Service'}
+
+    def __init__(self, output_path, header_row, append=False, use_parquet=True,
+                 row_group_size=DEFAULT_ROW_GROUP_SIZE, timezone=None):
+        """
+        @param timezone: the name of the timezone the timestamps are shown in, e.g.
+        'Europe/London' (default=None, UTC); either way they're the same instants
+        """
+        super().__init__(output_path, header_row, append)
+        if pa is None:
+            raise ImportError('pyarrow is required for columnar output (pip3 install pyarrow)')
+        if use_parquet and pq is None:
+            print('Warning: pyarrow was built without Parquet support; writing an Arrow IPC file')
+        self.use_parquet = use_parquet and pq is not None
+        self.row_group_size = row_group_size
+        self.timezone = 'UTC' if timezone is None or timezone.upper() == 'UTC' else timezone
+        self.column_names = [ColumnarMessageWriter.column_name(name) for name in header_row]
+        self.schema = pa.schema([(column_name, self.__column_type(header))
+                                 for column_name, header in zip(self.column_names, header_row)])
+        # Categories seen so far per dictionary column; the dictionary only ever grows so that
+        # each row group's dictionary is a superset of the last (needed for Arrow IPC files)
+        self.categories = dict((header, {}) for header in header_row
+                               if header in self.CATEGORY_COLUMNS)
+        self.buffer = []
+        if self.use_parquet:
+            self.writer = pq.ParquetWriter(output_path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(output_path, self.schema,
+                                          options=pa.ipc.IpcWriteOptions(
+                                              emit_dictionary_deltas=True))
+
+    @staticmethod
+    def column_name(header):
+        """ Turns a header like 'Is from me?' into a column name like 'is_from_me' """
+        return '_'.join(re.findall(r"[a-z0-9]+", header.lower()))
+
+    def __column_type(self, header):
+        if header in self.TIMESTAMP_COLUMNS:
+            return pa.timestamp('us', tz=self.timezone)
+        elif header in self.BOOLEAN_COLUMNS:
+            return pa.bool_()
+        elif header in self.CATEGORY_COLUMNS:
+            return pa.dictionary(pa.int32(), pa.string())
+        return pa.string()
+
+    def write_rows(self, rows):
+        row_count = 0
+        for row in rows:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.row_group_size:
+                row_count += self.__flush()
+        return row_count + self.__flush()
+
+    def __flush(self):
+        if not self.buffer:
+            return 0
+        columns = [self.__to_array(header, list(values))
+                   for header, values in zip(self.header_row, zip(*self.buffer))]
+        row_count = len(self.buffer)
+        self.buffer = []
+        batch = pa.RecordBatch.from_arrays(columns, schema=self.schema)
+        if self.use_parquet:
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+        return row_count
+
+    def __to_array(self, header, values):
+        if header in self.TIMESTAMP_COLUMNS:
+            return pa.array(values, pa.timestamp('us', tz=self.timezone))
+        strings = pa.array(values, pa.string())
+        if header in self.BOOLEAN_COLUMNS:
+            return pc.equal(strings, self.BOOLEAN_COLUMNS[header])
+        elif header in self.CATEGORY_COLUMNS:
+            categories = self.categories[header]
+            indices = [None if value is None else categories.setdefault(value, len(categories))
+                       for value in values]
+            return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()),
+                                                  pa.array(list(categories), pa.string()))
+        return strings
+
+    def close(self):
+        self.__flush()
+        self.writer.close()
+
+
+class SQLiteMessageWriter(MessageWriter):
+    """ Writes a standalone, searchable SQLite database (see search_index.py): contacts, handles
+    and chats are each stored once and messages reference them, with a full-text index over the
+    message text. Rows are loaded chunk_size at a time with executemany, all in one transaction,
+    and the indexes are only built once everything is in (when the writer is closed)
+    """
+
+    DEFAULT_CHUNK_SIZE = 10000
+
+    def __init__(self, output_path, header_row, append=False, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(output_path, header_row, append)
+        self.chunk_size = chunk_size
+        # Where the columns that are only there for some exports are (if they are)
+        self.chat_columns = [header_row.index(header) if header in header_row else None
+                             for header in ('Chat', 'Chat Name', 'Participants')]
+        self.attachments_column = header_row.index('Attachments') \
+            if 'Attachments' in header_row else None
+        # (first name, last name)/handle/chat identifier: id, for everything written so far
+        self.contact_ids, self.handle_ids, self.chat_ids = {}, {}, {}
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        self.conn = search_index.create_index_db(output_path)
+        self.conn.execute("BEGIN")
+
+    def write_rows(self, rows):
+        rows, row_count = iter(rows), 0
+        for chunk in iter(lambda: list(itertools.islice(rows, self.chunk_size)), []):
+            self.__write_chunk(chunk)
+            row_count += len(chunk)
+        return row_count
+
+    def __write_chunk(self, rows):
+        contacts, handles, chats, messages = [], [], [], []
+        for row in rows:
+            last_name, first_name, handle, date, is_from_me, text, service = row[:7]
+            handle_id = None
+            if handle:
+                handle_id = self.handle_ids.get(handle)
+                if handle_id is None:
+                    contact_id = None
+                    if first_name or last_name:
+                        contact_id = self.contact_ids.get((first_name, last_name))
+                        if contact_id is None:
+                            contact_id = len(self.contact_ids) + 1
+                            self.contact_ids[(first_name, last_name)] = contact_id
+                            contacts.append((contact_id, first_name, last_name))
+                    handle_id = len(self.handle_ids) + 1
+                    self.handle_ids[handle] = handle_id
+                    handles.append((handle_id, handle, contact_id))
+            chat_id = None
+            if self.chat_columns[0] is not None and row[self.chat_columns[0]]:
+                identifier = row[self.chat_columns[0]]
+                chat_id = self.chat_ids.get(identifier)
+                if chat_id is None:
+                    chat_id = len(self.chat_ids) + 1
+                    self.chat_ids[identifier] = chat_id
+                    chats.append((chat_id, identifier, row[self.chat_columns[1]],
+                                  row[self.chat_columns[2]]))
+            messages.append((handle_id, chat_id, date or None, is_from_me == 'Yes', text,
+                             service, None if self.attachments_column is None
+                             else row[self.attachments_column] or None))
+        self.conn.executemany(search_index.INSERT_CONTACT_SQL, contacts)
+        self.conn.executemany(search_index.INSERT_HANDLE_SQL, handles)
+        self.conn.executemany(search_index.INSERT_CHAT_SQL, chats)
+        self.conn.executemany(search_index.INSERT_MESSAGE_SQL, messages)
+
+    def bytes_written(self):
+        """ The size of the database so far, including the pages of the open transaction that
+        SQLite hasn't written to the file yet """
+        if self.conn is None:
+            return super().bytes_written()
+        page_count, = self.conn.execute("PRAGMA page_count").fetchone()
+        page_size, = self.conn.execute("PRAGMA page_size").fetchone()
+        return page_count * page_size
+
+    def close(self):
+        self.conn.execute("COMMIT")
+        search_index.create_indexes(self.conn)
+        self.conn.close()
+        self.conn = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # A partial export would look like a complete one, so it's thrown away (there's no
+        # journal to roll back with; see search_index.create_index_db)
+        self.conn.close()
+        os.remove(self.output_path)
+
+
+# Output backends by format name (as passed to extract_messages/-f on the CLI)
+OUTPUT_FORMATS = {
+    'csv': CSVMessageWriter,
+    'parquet': ColumnarMessageWriter,
+    'arrow': functools.partial(ColumnarMessageWriter, use_parquet=False),
+    'sqlite': SQLiteMessageWriter,
+}
+
+def open_message_writer(output_format, output_path, header_row, append=False, compression=None,
+                        timezone=None):
+    """ Opens the writer for the given output format (see OUTPUT_FORMATS), compressed with
+    one of compressed_output.COMPRESSIONS (csv only). timezone is the name of the timezone that
+    writers which store real timestamps show them in (see MessageWriter.RAW_DATES) """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format: {}'.format(output_format))
+    if writer_takes_raw_dates(output_format):
+        return OUTPUT_FORMATS[output_format](output_path, header_row, append=append,
+                                             timezone=timezone)
+    if compression is None:
+        return OUTPUT_FORMATS[output_format](output_path, header_row, append=append)
+    if output_format != 'csv':
+        raise ValueError('Only csv output can be compressed')
+    return CSVMessageWriter(output_path, header_row, append, compression=compression)
+
+def writer_supports_append(output_format):
+    """ Whether the given output format can be appended to (see MessageWriter.SUPPORTS_APPEND) """
+    writer_class = OUTPUT_FORMATS[output_format]
+    return getattr(writer_class, 'func', writer_class).SUPPORTS_APPEND
+
+def writer_takes_raw_dates(output_format):
+    """ Whether the given output format stores real timestamps (see MessageWriter.RAW_DATES) """
+    writer_class = OUTPUT_FORMATS[output_format]
+    return getattr(writer_class, 'func', writer_class).RAW_DATES
+
+def find_contact_keys(contacts, contacts_dict, assumed_country_code='US'):
+    """ Resolves the contacts an export is filtered on to canonical phone numbers/e-mails. Phone
+    numbers and e-mails are normalized the same way as handles and the address book are, and
+    bring in every other phone number/e-mail of the same contact; anything else is matched against
+    names, as in the search subcommand (e.g. 'Frodo' or 'Frodo Baggins')
+    @param contacts: a list of phone numbers, e-mails and/or names
+    @param contacts_dict: the dictionary of phone numbers to names
+    @param assumed_country_code: two-letter country code to assume when numbers lack one (or a
+    util.NormalizationContext)
+    @return: a set of canonical phone numbers/e-mails
+    @raise ValueError: if a name doesn't match anyone in the address book
+    """
+    store = ContactStore.from_mapping(contacts_dict)
+    keys = set()
+    for contact in contacts:
+        key = None
+        if util.CONTACT_VALUE_SCANNER.match(contact):
+            key = util.normalize_contact_values([contact], assumed_country_code)[0]
+        if key is not None:
+            keys |= store.contact_keys(key)
+            continue
+        found = store.find_keys(contact)
+        if not found:
+            raise ValueError("No contact matches '{}'".format(contact))
+        keys |= found
+    return keys
 
 
-def write_messages_to_csv(output_path, rows, header_row=None, delimiter=','):
+def write_messages_to_csv(output_path, rows, header_row=None, delimiter=',', append=False,
+                          compression=None):
     """ Writes a CSV file (or other delimited file) at output_path with given rows and header
     @param output_path: a fully qualified path ending in .csv
-    @param rows: a list of 1 or more rows to write to the CSV
+    @param rows: an iterable (list, generator, etc.) of rows to write to the CSV; rows are written
+    as they are consumed, so a generator is never materialized in full
     @param header_row: a list of row headers (default=None)
     @param delimiter: the delimiter for file (default=,)
-    @return:
+    @param append: append rows to an existing file instead of overwriting it (the header is
+    skipped since the file already has one)
+    @param compression: compress the file with one of compressed_output.COMPRESSIONS on a
+    background thread (default=None, uncompressed)
+    @return: the number of rows written (excluding the header)
     """
-    with open(output_path, 'w', encoding='utf-8-sig', newline='') as csv_file:
-        csv_writer = csv.writer(csv_file, delimiter=',', \
-                                quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        if header_row is not None:
-            csv_writer.writerow(header_row)
-                
-        csv_writer.writerows(rows)
-        
+    with CSVMessageWriter(output_path, header_row, append, delimiter, compression) as writer:
+        return writer.write_rows(rows)
@@ -1,7 +1,9 @@
-import itertools
+import pathlib
 import sqlite3
 from sqlite3 import Error
-from . import util
+from . import attributed_body, schema, util
+from .contact_store import ContactStore
+from .instrumentation import ProfiledConnection
 
 class PhoneDB():
     """ Very basic base class for working with the iPhone SQLite DB """
@@ -9,20 +11,60 @@ class PhoneDB():
     MANIFEST_DB_FILENAME = 'Manifest.db'
     SMS_DB_FILENAME = 'sms.db'
     ADDRESS_BOOK_FILENAME = 'AddressBook.sqlitedb'
+
+    # Options for opening DBs inside a backup, which we only ever read, usually in one big
+    # sequential scan: read-only and immutable (no journal or locking, and no chance of ever
+    # writing to the backup), memory mapped so the OS page cache serves reads, a bigger page
+    # cache and temp tables/sorts kept in memory
+    BACKUP_DB_OPTIONS = {'read_only': True, 'mmap_size': 1 << 30, 'cache_size': -65536,
+                         'temp_store_memory': True}
     
-    def __init__(self, db_file):
+    def __init__(self, db_file, read_only=False, mmap_size=None, cache_size=None,
+                 temp_store_memory=False, profiler=None):
+        """
+        @param db_file: the path to the SQLite DB (or :memory:)
+        @param read_only: open the DB read-only and immutable (see sqlite_uri)
+        @param mmap_size: the max number of bytes of the DB to memory map (PRAGMA mmap_size)
+        @param cache_size: the page cache size, in pages or if negative KiB (PRAGMA cache_size)
+        @param temp_store_memory: keep temp tables and indices in memory (PRAGMA temp_store)
+        @param profiler: an instrumentation.Profiler to report the time of every query to
+        """
         self.db_file = db_file
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.temp_store_memory = temp_store_memory
+        self.profiler = profiler
         self.conn = None
     
     def connect(self):
         """ Opens DB connection to SQLite DB """
+        factory = sqlite3.Connection if self.profiler is None else ProfiledConnection
         try:
-            self.conn = sqlite3.connect(self.db_file)
+            if self.read_only:
+                self.conn = sqlite3.connect(PhoneDB.sqlite_uri(self.db_file), uri=True,
+                                            factory=factory)
+            else:
+                self.conn = sqlite3.connect(self.db_file, factory=factory)
+            if self.profiler is not None:
+                self.conn.profiler = self.profiler
+            if self.mmap_size is not None:
+                self.conn.execute("PRAGMA mmap_size = {:d}".format(self.mmap_size))
+            if self.cache_size is not None:
+                self.conn.execute("PRAGMA cache_size = {:d}".format(self.cache_size))
+            if self.temp_store_memory:
+                self.conn.execute("PRAGMA temp_store = MEMORY")
             return self.conn
         except Error as e:
             print(e)
  
         return None
+
+    @staticmethod
+    def sqlite_uri(db_file):
+        """ The URI to open db_file read-only and immutable. immutable tells SQLite the file can't
+        change underneath it, so it skips locking and change detection entirely """
+        return pathlib.Path(db_file).absolute().as_uri() + '?mode=ro&immutable=1'
     
     def connection(self):
         return self.conn
@@ -33,6 +75,15 @@ class PhoneDB():
 
 class ManifestDB(PhoneDB):
     """ Class that extends PhoneDB with methods that relate to Manifest.db """
+
+    # Where the files we know about live on the device, as (domain, relativePath)
+    SMS_DB_DOMAIN_PATH = ('HomeDomain', 'Library/SMS/sms.db')
+    ADDRESS_BOOK_DOMAIN_PATH = ('HomeDomain', 'Library/AddressBook/AddressBook.sqlitedb')
+    KNOWN_DOMAIN_PATHS = {PhoneDB.SMS_DB_FILENAME: SMS_DB_DOMAIN_PATH,
+                          PhoneDB.ADDRESS_BOOK_FILENAME: ADDRESS_BOOK_DOMAIN_PATH}
+
+    # Max number of paths looked up per query (well under SQLite's limit on bound parameters)
+    LOOKUP_CHUNK_SIZE = 500
     
     def get_physical_path_for_file(self, file_path):
         """ Gets the physical path in the backup from a filename
@@ -41,19 +92,60 @@ class ManifestDB(PhoneDB):
         @param file_path: the path you're looking for (e.g. sms.db)
         @return: the fully-qualified path to the file in the backup
         """
+        if file_path in ManifestDB.KNOWN_DOMAIN_PATHS:
+            domain_path = ManifestDB.KNOWN_DOMAIN_PATHS[file_path]
+            file_id = self.get_file_ids([domain_path]).get(domain_path)
+        else:
+            with self.conn:
+                file_id = self.__get_file_id_from_manifest(self.conn.cursor(), file_path)
+
+        if file_id is None:
+            raise FileNotFoundError("Backup is corrupt or in progress. Failed to find required \
+                                    entry in the manifest database. Please verify contents are \
+                                    intact.")
+        return util.hash_to_path(file_id)        
+
+    def get_file_ids(self, domain_paths):
+        """ Looks up the fileIDs (the hashes files are stored under in the backup) of many files
+        at once by their exact domain and relativePath, which (unlike a LIKE) can use the index
+        on relativePath instead of scanning the whole Files table
+        @param domain_paths: an iterable of (domain, relativePath) tuples
+        @return: a dict of (domain, relativePath): fileID for the files that were found
+        """
+        wanted = set(tuple(domain_path) for domain_path in domain_paths)
+        relative_paths = sorted(set(relative_path for _, relative_path in wanted))
+        file_ids = {}
         with self.conn:
             cur = self.conn.cursor()
-            
-            file_id = self.__get_file_id_from_manifest(cur, file_path)
-            if file_id is None:
-                raise FileNotFoundError("Backup is corrupt or in progress. Failed to find required \
-                                        entry in the manifest database. Please verify contents are \
-                                        intact.")
-            return util.hash_to_path(file_id)        
+            for i in range(0, len(relative_paths), ManifestDB.LOOKUP_CHUNK_SIZE):
+                chunk = relative_paths[i:i + ManifestDB.LOOKUP_CHUNK_SIZE]
+                sql = "SELECT fileID, domain, relativePath FROM Files WHERE relativePath IN ({})"
+                cur.execute(sql.format(', '.join('?' * len(chunk))), chunk)
+                for file_id, domain, relative_path in cur.fetchall():
+                    if (domain, relative_path) in wanted:
+                        file_ids[(domain, relative_path)] = file_id
+        return file_ids
+
+    def get_file_blobs(self, file_ids):
+        """ Looks up the Files.file column (an archived MBFile with the file's size, encryption
+        key, etc.) of many files at once
+        @param file_ids: an iterable of fileIDs
+        @return: a dict of fileID: file blob for the files that were found
+        """
+        file_ids = sorted(set(file_ids))
+        file_blobs = {}
+        with self.conn:
+            cur = self.conn.cursor()
+            for i in range(0, len(file_ids), ManifestDB.LOOKUP_CHUNK_SIZE):
+                chunk = file_ids[i:i + ManifestDB.LOOKUP_CHUNK_SIZE]
+                sql = "SELECT fileID, file FROM Files WHERE fileID IN ({})"
+                cur.execute(sql.format(', '.join('?' * len(chunk))), chunk)
+                file_blobs.update(cur.fetchall())
+        return file_blobs
 
     def __get_file_id_from_manifest(self, cur, file_path):
-        # TODO: fix the assumption that there will only one path ending in sms.db or AddressBook.sqlitedb,
-        # which is currently correct, but could easily be broken
+        # Fallback for files we don't know the exact location of (slow: LIKE '%...' means a
+        # full table scan, and only the first match is used)
         sql = "SELECT fileID, domain, relativePath FROM Files WHERE relativePath LIKE ?"
         cur.execute(sql, ('%' + file_path,))
         result = cur.fetchone()
@@ -62,73 +154,709 @@ class ManifestDB(PhoneDB):
 
 class AddressDB(PhoneDB):
     """ Class that extends PhoneDB with methods that relate to AddressBook.sqlite.db """
+
+    # Every phone number/e-mail in the address book along with the name it belongs to ({schema}
+    # is the prefix of the DB to query, e.g. 'address_book.' when it is ATTACHed elsewhere)
+    CONTACTS_SQL = '''
+                    SELECT ABPerson.First, ABPerson.Last, ABMultiValue.value,
+                           ABMultiValue.record_id
+                    FROM {schema}ABMultiValue
+                    LEFT JOIN {schema}ABPerson
+                        ON ABMultiValue.record_id = ABPerson.ROWID
+                    WHERE value IS NOT NULL
+                   '''
     
-    def generate_dict_from_address_book(self):
+    def generate_dict_from_address_book(self, assumed_country_code='US'):
         """ Creates a dictionary from address book entries with *canonicalized* phone numbers
         (or e-mail addresses) as the keys and a tuple with first and last names
+        @param assumed_country_code: two-letter country code to assume when numbers lack one (or a
+        util.NormalizationContext)
+        @return: a ContactStore (which works like a dict)
         """
         with self.conn:
             cur = self.conn.cursor()
         
-            sql = '''
-                    SELECT ABPerson.First, ABPerson.Last, ABMultiValue.value
-                    FROM ABMultiValue
-                    LEFT JOIN ABPerson
-                        ON ABMultiValue.record_id = ABPerson.ROWID
-                    WHERE value IS NOT NULL
-                  '''
-            res = cur.execute(sql)
+            res = cur.execute(AddressDB.CONTACTS_SQL.format(schema=''))
             # col_name_list = [tuple[0] for tuple in res.description]
             
             rows = cur.fetchall()
         
-            key_function = lambda r: util.normalize_contact_value(r[2])
-            contact_dict = dict((key_function(row), (row[0], row[1])) for row in rows)
-            # remove None: [Random Name] since that doesn't make any sense
-            if None in contact_dict:
-                del contact_dict[None]
-            return contact_dict
+            keys = util.normalize_contact_values([row[2] for row in rows], assumed_country_code)
+            contacts = ContactStore()
+            for key, row in zip(keys, rows):
+                # skip None: [Random Name] since that doesn't make any sense
+                if key is not None:
+                    contacts.add(key, row[0], row[1], row[3])
+            return contacts
+
+class MessageFilter():
+    """ Restricts an export to some of the messages in sms.db. Every condition is pushed down into
+    the WHERE of the message queries as a predicate on message.date or message.handle_id, which
+    sms.db has indexes on, so that e.g. one contact's last month of messages is read straight off
+    the index instead of by scanning (and throwing away) the whole message table.
+
+    In exports with chats, the contact and service filters are applied at chat level for your own
+    messages, which have no handle in group chats: they're kept if the chat has someone who
+    passes the filter in it """
+
+    # The services messages can be filtered on (handle.service)
+    SERVICES = ('iMessage', 'SMS')
+
+    # The bounds of an INTEGER in SQLite, for the open ends of date ranges
+    MIN_DATE = -(1 << 63)
+    MAX_DATE = (1 << 63) - 1
+
+    def __init__(self, since=None, until=None, handle_rowids=None, service=None, from_me=None,
+                 skip_tapbacks=False, chats=False):
+        """
+        @param since: only messages from this Unix timestamp (in whole seconds) on
+        @param until: only messages from before this Unix timestamp (in whole seconds)
+        @param handle_rowids: only messages with one of these handles (handle.ROWIDs)
+        @param service: only messages sent over this service (one of SERVICES)
+        @param from_me: only messages you sent (True) or only ones you received (False)
+        @param skip_tapbacks: leave out tapbacks (reactions), which are stored as messages
+        @param chats: whether the export is by chat (see above)
+        """
+        if service is not None and service not in MessageFilter.SERVICES:
+            raise ValueError('Unknown service: {}'.format(service))
+        self.since = since
+        self.until = until
+        self.handle_rowids = None if handle_rowids is None else sorted(set(handle_rowids))
+        self.service = service
+        self.from_me = from_me
+        self.skip_tapbacks = skip_tapbacks
+        self.chats = chats
+
+    def settings(self):
+        """ What the filter selects, as JSON-friendly values (e.g. for export_state.py) """
+        return {'since': self.since, 'until': self.until, 'handle_rowids': self.handle_rowids,
+                'service': self.service, 'from_me': self.from_me,
+                'skip_tapbacks': self.skip_tapbacks, 'chats': self.chats}
+
+    def where(self, message_schema=None):
+        """ The conditions on the message (and handle) tables
+        @param message_schema: the schema.MessageSchema of the DB (default=None, one with
+        tapbacks is assumed)
+        @return: a tuple of (a list of SQL conditions to AND together, a list of params)
+        """
+        conditions, params = [], []
+        if self.since is not None or self.until is not None:
+            # message.date is in seconds on older iOS versions and nanoseconds on newer ones
+            # (see MessageDB.UNIX_TIMESTAMP_SQL), so the range is given in both units, each one
+            # on its own side of the threshold. Both are plain ranges on message.date, which
+            # SQLite answers with two seeks on the index rather than a computed value per row
+            threshold = util.NANOSECOND_DATE_THRESHOLD
+            since = None if self.since is None else self.since - util.APPLE_EPOCH_OFFSET
+            until = None if self.until is None else self.until - util.APPLE_EPOCH_OFFSET
+            conditions.append('((message.date >= ? AND message.date < ?) OR '
+                              '(message.date >= ? AND message.date < ?))')
+            params.extend([MessageFilter.MIN_DATE if since is None else since,
+                           threshold + 1 if until is None else min(until, threshold + 1),
+                           threshold + 1 if since is None else max(since * 10 ** 9,
+                                                                   threshold + 1),
+                           MessageFilter.MAX_DATE if until is None else min(
+                               until * 10 ** 9, MessageFilter.MAX_DATE)])
+        if message_schema is None:
+            message_schema = schema.MessageSchema({'message': ['associated_message_type']})
+        if self.handle_rowids is not None:
+            self.__add_handle_condition(conditions, params, message_schema, 'IN ({})'.format(
+                ', '.join('?' * len(self.handle_rowids)) or 'NULL'), self.handle_rowids)
+        if self.service is not None:
+            # handle is tiny; this still lets SQLite go by the index on message.handle_id
+            self.__add_handle_condition(conditions, params, message_schema,
+                                        'IN (SELECT ROWID FROM handle WHERE service = ?)',
+                                        [self.service])
+        if self.from_me is not None:
+            # The same test as the 'Is from me?' column, so a NULL counts as received
+            conditions.append('(CASE WHEN message.is_from_me THEN 1 ELSE 0 END) = ?')
+            params.append(1 if self.from_me else 0)
+        if self.skip_tapbacks:
+            tapback_where = message_schema.tapback_where()
+            if tapback_where is not None:
+                conditions.append(tapback_where)
+        return conditions, params
+
+    def __add_handle_condition(self, conditions, params, message_schema, handle_sql,
+                               handle_params):
+        if not self.chats or not message_schema.has_chats or \
+                not message_schema.has_chat_participants:
+            conditions.append('message.handle_id ' + handle_sql)
+            params.extend(handle_params)
+            return
+        conditions.append('''(message.handle_id {handles}
+                              OR (IFNULL(message.handle_id, 0) = 0 AND message.ROWID IN (
+                                  SELECT chat_message_join.message_id
+                                  FROM chat_handle_join
+                                  INNER JOIN chat_message_join
+                                      ON chat_message_join.chat_id = chat_handle_join.chat_id
+                                  WHERE chat_handle_join.handle_id {handles})))'''.format(
+                              handles=handle_sql))
+        params.extend(handle_params)
+        params.extend(handle_params)
 
 class MessageDB(PhoneDB):
     """ Class that extends PhoneDB with methods that relate to sms.db """
+
+    # Number of rows pulled from the cursor at a time when streaming messages
+    DEFAULT_BATCH_SIZE = 5000
+
+    # See here https://stackoverflow.com/questions/10746562/parsing-date-field-of-iphone-sms-file-from-backup
+    # for an explanation of the iPhone date handling
+    UNIX_TIMESTAMP_SQL = '''
+                           -- message.date is in seconds on older iOS versions and nanoseconds on
+                           -- newer ones (decided per row, so mixed DBs work), and the offset is
+                           -- from 2001-01-01 instead of 1970-01-01. The result is a REAL so
+                           -- messages sent within the same second still sort in order
+                           ((CASE WHEN message.date > {threshold}
+                                  THEN message.date / 1000000000.0
+                                  ELSE message.date END) + {offset})
+                         '''.format(threshold=util.NANOSECOND_DATE_THRESHOLD,
+                                     offset=util.APPLE_EPOCH_OFFSET)
+    # The same in whole seconds (integer division, so it never rounds up into the next second)
+    UNIX_SECONDS_SQL = '''
+                         ((CASE WHEN message.date > {threshold}
+                                THEN message.date / 1000000000
+                                ELSE CAST(message.date AS INTEGER) END) + {offset})
+                       '''.format(threshold=util.NANOSECOND_DATE_THRESHOLD,
+                                   offset=util.APPLE_EPOCH_OFFSET)
+
+    # The name the address book is ATTACHed under by attach_address_book
+    ADDRESS_BOOK_SCHEMA = 'address_book'
+
+    # The chat columns for a message that isn't part of any chat
+    NO_CHAT = ('', '', '')
+
+    # The name and phone number/e-mail columns for a message without a handle
+    NO_CONTACT = ('', '', None)
+
+    def __init__(self, db_file, **options):
+        """ See PhoneDB """
+        super().__init__(db_file, **options)
+        self.schema = None
+
+    def get_schema(self):
+        """ The schema.MessageSchema of this DB (probed the first time it's asked for) """
+        if self.schema is None:
+            self.schema = schema.get_message_schema(self.conn)
+        return self.schema
     
-    def match_messages_to_contact_dict(self, contact_dict):
+    def generate_handle_dict(self, assumed_country_code='US'):
+        """ Normalizes every distinct handle (phone number/e-mail) in the handle table exactly
+        once, so that mapping messages to contacts is a dict lookup rather than a phone number
+        parse per message
+        @param assumed_country_code: two-letter country code to assume when numbers lack one (or a
+        util.NormalizationContext)
+        @return: a dictionary of raw handle.id values to their *canonicalized* form
+        """
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT DISTINCT id FROM handle WHERE id IS NOT NULL")
+            handles = [row[0] for row in cur.fetchall()]
+            return dict(zip(handles, util.normalize_contact_values(handles, assumed_country_code)))
+
+    def get_high_water_mark(self):
+        """ Gets the newest message in the DB, which incremental exports use to tell which
+        messages they have already written
+        @return: a tuple of (max message.ROWID, max message.date), both None if there are no
+        messages
+        """
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT MAX(ROWID), MAX(date) FROM message")
+            return cur.fetchone()
+
+    def get_rowid_bounds(self):
+        """ Gets the lowest and highest message.ROWID (e.g. to split the messages into shards)
+        @return: a tuple of (min message.ROWID, max message.ROWID), both None if there are no
+        messages
+        """
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT MIN(ROWID), MAX(ROWID) FROM message")
+            return cur.fetchone()
+
+    def get_handle_rowids(self, keys, handle_dict):
+        """ Finds the handles of some phone numbers/e-mails (e.g. to filter on them)
+        @param keys: an iterable of *canonicalized* phone numbers/e-mails
+        @param handle_dict: the output of generate_handle_dict
+        @return: a list of the handle.ROWIDs whose handle.id has one of keys as its canonical form
+        """
+        keys = set(keys)
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT ROWID, id FROM handle WHERE id IS NOT NULL")
+            return [rowid for rowid, handle_id in cur.fetchall()
+                    if handle_dict.get(handle_id) in keys]
+
+    def count_messages(self, rowid_range=None, chats=False, message_filter=None):
+        """ Counts the messages an export will write (e.g. to estimate how long it will take)
+        @param rowid_range: an optional (exclusive min, inclusive max) tuple of message.ROWIDs
+        @param chats: count the rows of an export with chats instead: messages with no handle are
+        included, and a message in several chats is counted once per chat
+        @param message_filter: an optional MessageFilter
+        @return: the number of messages (rows the export will write)
+        """
+        message_schema = self.get_schema()
+        where_sql, params = MessageDB.__where(rowid_range, message_filter, message_schema)
+        # The same joins as the export's own query, so that the count matches what it writes
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM {} {}".format(
+                MessageDB.__from_sql(message_schema, chats), where_sql), params)
+            return cur.fetchone()[0]
+
+    def get_attachments(self, rowid_range=None, message_filter=None):
+        """ Gets the attachments of every message (or just those with a message.ROWID in
+        rowid_range)
+        @param rowid_range: an optional (exclusive min, inclusive max) tuple of message.ROWIDs
+        @param message_filter: an optional MessageFilter
+        @return: a list of (message.ROWID, attachment.filename) tuples, where the filename is the
+        path on the device (e.g. ~/Library/SMS/Attachments/0a/10/.../IMG_0001.jpeg)
+        """
+        message_schema = self.get_schema()
+        if not message_schema.has_attachments:
+            return []
+        where_sql, params = MessageDB.__where(rowid_range, message_filter, message_schema)
+        with self.conn:
+            cur = self.conn.cursor()
+            sql = '''
+                    SELECT message.ROWID, attachment.filename
+                    FROM message
+                    INNER JOIN message_attachment_join
+                        ON message_attachment_join.message_id = message.ROWID
+                    INNER JOIN attachment
+                        ON attachment.ROWID = message_attachment_join.attachment_id
+                    {where}
+                    ORDER BY message.ROWID, attachment.ROWID
+                  '''.format(where=where_sql)
+            cur.execute(sql, params)
+            return [row for row in cur.fetchall() if row[1] is not None]
+
+    def match_messages_to_contact_dict(self, contact_dict, assumed_country_code='US'):
         """ Maps the phone number/e-mail of each message (the "handle.id") to an address book
         entry from the contact_dict dictionary/hash
         @param contact_dict: the dictionary of phone numbers to names
+        @param assumed_country_code: two-letter country code to assume when numbers lack one (or a
+        util.NormalizationContext)
         @return: a list of messages with names appended
         """
+        return list(self.iter_messages_matched_to_contact_dict(contact_dict,
+                        assumed_country_code=assumed_country_code))
+
+    def iter_messages_matched_to_contact_dict(self, contact_dict, batch_size=DEFAULT_BATCH_SIZE,
+                                              assumed_country_code='US', handle_dict=None,
+                                              rowid_range=None, attachment_dict=None,
+                                              chat_dict=None, date_converter=None,
+                                              sort_keys=False, message_filter=None,
+                                              reaction_dict=None):
+        """ Streaming version of match_messages_to_contact_dict: rows are pulled from the cursor
+        batch_size at a time with fetchmany, so only one batch is ever held in memory
+        @param contact_dict: the dictionary of phone numbers to names
+        @param batch_size: the number of rows to fetch from SQLite per round trip
+        @param assumed_country_code: two-letter country code to assume when numbers lack one (or a
+        util.NormalizationContext)
+        @param handle_dict: the output of generate_handle_dict, if the caller already has it
+        @param rowid_range: an optional (exclusive min, inclusive max) tuple of message.ROWIDs
+        to restrict the export to (e.g. only messages newer than the last export)
+        @param attachment_dict: if given, a dict of message.ROWID to the exported paths of its
+        attachments; rows then get an extra column with those paths (or '' if none)
+        @param chat_dict: if given, the output of generate_chat_dict; rows then get the chat
+        identifier, name and participants of their conversation and are ordered by conversation,
+        and messages without a handle (e.g. ones you sent to a group) are included
+        @param date_converter: the util.DateConverter used to format dates (default=local time,
+        '%Y-%m-%d %H:%M:%S')
+        @param sort_keys: if True, (sort key, message) tuples are generated instead, where the
+        sort key is the value of the ORDER BY of the query (see sort_key), e.g. to merge the
+        output of several queries over different rowid_ranges in order
+        @param message_filter: an optional MessageFilter to only export some of the messages
+        @param reaction_dict: if given, the output of generate_reaction_dict; rows then get an
+        extra column with the tapbacks on them (or '' if none)
+        @return: a generator of messages with names appended
+        """
+        message_schema = self.get_schema()
+        # Normalize each distinct handle up front rather than once per message
+        if handle_dict is None:
+            handle_dict = self.generate_handle_dict(assumed_country_code)
+        # ...and look up the names of everyone once, too
+        handle_columns = ContactStore.from_mapping(contact_dict).handle_columns(handle_dict)
+        if date_converter is None:
+            date_converter = util.DateConverter()
+
+        columns = ['''handle.id as handle,
+                      message.date,
+                      (CASE WHEN message.is_from_me THEN 'Yes' ELSE 'No' END) as is_from_me,
+                      {text}, handle.service as service
+                   '''.format(text=message_schema.text_sql)]
+        if chat_dict is not None:
+            columns.append(message_schema.chat_id_sql)
+        if attachment_dict is not None:
+            columns.append('message.ROWID')
+        if reaction_dict is not None:
+            columns.append('message.guid')
+        if sort_keys:
+            columns.extend(MessageDB.__order_by_columns(message_schema, chat_dict is not None))
+        sql, params = MessageDB.__message_sql(message_schema, columns, rowid_range=rowid_range,
+                                              chats=chat_dict is not None,
+                                              message_filter=message_filter)
         with self.conn:
             cur = self.conn.cursor()
-        
-            # See here https://stackoverflow.com/questions/10746562/parsing-date-field-of-iphone-sms-file-from-backup
-            # for an explanation of the iPhone date handling
-            sql = '''
-                    SELECT handle.id as handle,
-                           -- as recorded, message.date has 9 extra zeros and the offset
-                           -- is from 2001-01-01 instead of 1970-01-01
-                           CAST(substr(message.date, 1, 9) as INTEGER) + 
-                               strftime('%s', '2001-01-01 00:00:00')
-                               as unix_timestamp,
-                           (CASE WHEN message.is_from_me THEN 'Yes' ELSE 'No' END) as is_from_me,
-                           message.text, handle.service as service
-                    FROM message
-                    INNER JOIN handle
-                        ON handle.ROWID = message.handle_id
-                    ORDER BY handle.id, unix_timestamp
-                  '''
-            res = cur.execute(sql)
+            cur.execute(sql, params)
             # col_name_list = [tuple[0] for tuple in res.description]
+            for rows in MessageDB.__iter_batches(cur, batch_size):
+                rows = attributed_body.decode_text_column(rows, 3)
+                if sort_keys:
+                    yield from zip(map(MessageDB.sort_key, rows), MessageDB.__map_batch(
+                        [row[:-3] for row in rows], handle_columns, attachment_dict, chat_dict,
+                        date_converter, reaction_dict))
+                    continue
+                yield from MessageDB.__map_batch(rows, handle_columns, attachment_dict, chat_dict,
+                                                 date_converter, reaction_dict)
+
+    def __map_batch(rows, handle_columns, attachment_dict, chat_dict, date_converter,
+                    reaction_dict=None):
+        # Dates are converted a whole batch at a time
+        dates = date_converter.convert([row[1] for row in rows])
+        if chat_dict is None and attachment_dict is None and reaction_dict is None:
+            for row, date in zip(rows, dates):
+                yield MessageDB.__map_message_to_contact(row, date, handle_columns)
+            return
+        # The extra columns come after the first five, in the order they were selected in
+        attachment_index = 5 + (chat_dict is not None)
+        reaction_index = attachment_index + (attachment_dict is not None)
+        for row, date in zip(rows, dates):
+            message = MessageDB.__map_message_to_contact(row[:5], date, handle_columns)
+            if chat_dict is not None:
+                message += chat_dict.get(row[5], MessageDB.NO_CHAT)
+            if attachment_dict is not None:
+                message += (attachment_dict.get(row[attachment_index], ''),)
+            if reaction_dict is not None:
+                message += (reaction_dict.get(row[reaction_index], ''),)
+            yield message
+
+    def generate_chat_dict(self, contact_dict, handle_dict):
+        """ Resolves every conversation (1:1 or group) once, including the names of everyone in
+        it, so that each message only needs a dict lookup on its chat
+        @param contact_dict: the dictionary of phone numbers to names
+        @param handle_dict: the output of generate_handle_dict
+        @return: a dictionary of chat.ROWID to a tuple of (chat identifier, display name,
+        participants), where participants is a '; ' separated list of names (or phone
+        numbers/e-mails for people not in the address book)
+        """
+        message_schema = self.get_schema()
+        if not message_schema.has_chat_info:
+            return {}
+        with self.conn:
+            cur = self.conn.cursor()
+            participants = {}
+            if message_schema.has_chat_participants:
+                cur.execute('''
+                              SELECT chat_handle_join.chat_id, handle.id
+                              FROM chat_handle_join
+                              INNER JOIN handle
+                                  ON handle.ROWID = chat_handle_join.handle_id
+                              ORDER BY chat_handle_join.chat_id, handle.ROWID
+                            ''')
+                for chat_id, handle_id in cur.fetchall():
+                    participants.setdefault(chat_id, []).append(
+                        MessageDB.__participant_name(handle_id, contact_dict, handle_dict))
+
+            cur.execute("SELECT ROWID, chat_identifier, {} FROM chat".format(
+                message_schema.chat_name_sql))
+            return dict((chat_id, (chat_identifier or '', display_name or '',
+                                   '; '.join(participants.get(chat_id, []))))
+                        for chat_id, chat_identifier, display_name in cur.fetchall())
+
+    def generate_reaction_dict(self, contact_dict, handle_dict):
+        """ Works out the tapbacks (reactions) on every message, so that they can be folded into
+        the message they react to instead of being exported as messages of their own. A tapback
+        that was taken back again no longer counts, and nor does one that was changed to another
+        (Loved and then Liked by the same person is just Liked)
+        @param contact_dict: the dictionary of phone numbers to names
+        @param handle_dict: the output of generate_handle_dict
+        @return: a dictionary of message.guid to its tapbacks, e.g. 'Loved by Samwise Gamgee;
+        Laughed at by me' (empty if the schema doesn't record which message tapbacks react to)
+        """
+        message_schema = self.get_schema()
+        if not message_schema.can_fold_tapbacks:
+            return {}
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute('''
+                          SELECT message.associated_message_guid, message.associated_message_type,
+                                 {emoji}, message.is_from_me, handle.id
+                          FROM message
+                          LEFT JOIN handle
+                              ON handle.ROWID = message.handle_id
+                          WHERE message.associated_message_type IN ({types})
+                              AND message.associated_message_guid IS NOT NULL
+                          ORDER BY message.ROWID
+                        '''.format(emoji=message_schema.tapback_emoji_sql,
+                                   types=', '.join(map(str, schema.TAPBACK_TYPES))))
+            # message.guid: {(who, slot): (tapback type, what it says)}, in the order they were
+            # sent. Everyone has one slot for the tapbacks that replace each other and one for
+            # emoji reactions
+            tapbacks = {}
+            for associated_guid, tapback_type, emoji, is_from_me, handle_id in cur.fetchall():
+                removed = tapback_type - schema.TAPBACK_REMOVED_OFFSET \
+                    if tapback_type not in schema.TAPBACK_VERBS else None
+                slot = 'tapback' if (removed or tapback_type) in schema.EXCLUSIVE_TAPBACK_TYPES \
+                    else removed or tapback_type
+                who = 'me' if is_from_me else \
+                    MessageDB.__participant_name(handle_id, contact_dict, handle_dict)
+                message_tapbacks = tapbacks.setdefault(schema.parent_guid(associated_guid), {})
+                if removed is None:
+                    message_tapbacks.pop((who, slot), None)
+                    verb = emoji or schema.TAPBACK_VERBS[tapback_type]
+                    message_tapbacks[(who, slot)] = (tapback_type, '{} by {}'.format(verb, who))
+                elif message_tapbacks.get((who, slot), (None,))[0] == removed:
+                    # Taking back one that has since been replaced leaves the new one alone
+                    del message_tapbacks[(who, slot)]
+            return dict((guid, '; '.join(text for _, text in message_tapbacks.values()))
+                        for guid, message_tapbacks in tapbacks.items() if message_tapbacks)
+
+    def attach_address_book(self, address_book_path, assumed_country_code='US', handle_dict=None):
+        """ Sets up the "SQL engine": ATTACHes the address book to this connection and
+        materializes the normalized contacts and handles into indexed temp tables, so that
+        iter_messages_joined_in_sql can match messages to names in SQLite instead of in Python.
+        Each address book value and handle is still normalized (in Python) exactly once. Call
+        detach_address_book when done
+        @param address_book_path: the path to AddressBook.sqlitedb
+        @param assumed_country_code: two-letter country code to assume when numbers lack one (or a
+        util.NormalizationContext)
+        @param handle_dict: the output of generate_handle_dict, if the caller already has it
+        """
+        if handle_dict is None:
+            handle_dict = self.generate_handle_dict(assumed_country_code)
+
+        if self.read_only:
+            address_book_path = PhoneDB.sqlite_uri(address_book_path)
+        cur = self.conn.cursor()
+        cur.execute("ATTACH DATABASE ? AS {}".format(MessageDB.ADDRESS_BOOK_SCHEMA),
+                    (address_book_path,))
+        with self.conn:
+            cur.execute(AddressDB.CONTACTS_SQL.format(
+                schema=MessageDB.ADDRESS_BOOK_SCHEMA + '.'))
             rows = cur.fetchall()
-            
-            return list(map(MessageDB.__map_message_to_contact, rows, \
-                                itertools.repeat(contact_dict, len(rows)) ))
-    
-    def __map_message_to_contact(row, contacts_dict):
-        contact_key = util.normalize_contact_value(row[0])
-        name_tuple = contacts_dict[contact_key] if contact_key in contacts_dict else None 
+            keys = util.normalize_contact_values([row[2] for row in rows], assumed_country_code)
+            contact_rows = [(key, row[0], row[1], row[3]) for key, row in zip(keys, rows)]
+
+            # Later values win, same as generate_dict_from_address_book (hence INSERT OR REPLACE)
+            cur.execute('''CREATE TEMP TABLE contact (key TEXT PRIMARY KEY, first TEXT, last TEXT,
+                                                     contact_id INTEGER)''')
+            cur.executemany("INSERT OR REPLACE INTO temp.contact VALUES (?, ?, ?, ?)",
+                            (row for row in contact_rows if row[0] is not None))
+            cur.execute("CREATE TEMP TABLE handle_key (id TEXT PRIMARY KEY, key TEXT)")
+            cur.executemany("INSERT INTO temp.handle_key VALUES (?, ?)", handle_dict.items())
+
+    def detach_address_book(self):
+        """ Undoes attach_address_book """
+        cur = self.conn.cursor()
+        with self.conn:
+            cur.execute("DROP TABLE IF EXISTS temp.contact")
+            cur.execute("DROP TABLE IF EXISTS temp.handle_key")
+        cur.execute("DETACH DATABASE {}".format(MessageDB.ADDRESS_BOOK_SCHEMA))
+
+    def get_attached_contacts_dict(self):
+        """ The contacts (as in generate_dict_from_address_book) of everyone with a handle in
+        sms.db, from the temp tables set up by attach_address_book """
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute('''
+                          SELECT key, first, last, contact_id FROM temp.contact
+                          WHERE key IN (SELECT key FROM temp.handle_key)
+                        ''')
+            contacts = ContactStore()
+            for row in cur.fetchall():
+                contacts.add(*row)
+            return contacts
+
+    def load_attachment_dict(self, attachment_dict):
+        """ Loads the exported attachment paths into a temp table for iter_messages_joined_in_sql
+        @param attachment_dict: a dict of message.ROWID to the exported paths of its attachments
+        """
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("DROP TABLE IF EXISTS temp.message_attachment")
+            cur.execute('''CREATE TEMP TABLE message_attachment (
+                             message_id INTEGER PRIMARY KEY, paths TEXT)''')
+            cur.executemany("INSERT INTO temp.message_attachment VALUES (?, ?)",
+                            attachment_dict.items())
+
+    def load_chat_dict(self, chat_dict):
+        """ Loads the output of generate_chat_dict into a temp table for
+        iter_messages_joined_in_sql """
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("DROP TABLE IF EXISTS temp.chat_info")
+            cur.execute('''CREATE TEMP TABLE chat_info (
+                             chat_id INTEGER PRIMARY KEY, identifier TEXT, name TEXT,
+                             participants TEXT)''')
+            cur.executemany("INSERT INTO temp.chat_info VALUES (?, ?, ?, ?)",
+                            ((chat_id,) + chat for chat_id, chat in chat_dict.items()))
+
+    def load_reaction_dict(self, reaction_dict):
+        """ Loads the output of generate_reaction_dict into a temp table for
+        iter_messages_joined_in_sql """
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("DROP TABLE IF EXISTS temp.message_reaction")
+            cur.execute('''CREATE TEMP TABLE message_reaction (
+                             guid TEXT PRIMARY KEY, reactions TEXT)''')
+            cur.executemany("INSERT INTO temp.message_reaction VALUES (?, ?)",
+                            reaction_dict.items())
+
+    def iter_messages_joined_in_sql(self, batch_size=DEFAULT_BATCH_SIZE, rowid_range=None,
+                                    with_attachments=False, with_chats=False,
+                                    date_converter=None, message_filter=None,
+                                    with_reactions=False):
+        """ Same output as iter_messages_matched_to_contact_dict, but the join to the address book,
+        ordering and date formatting all happen inside SQLite so Python only streams the final
+        rows. Requires attach_address_book to have been called first
+        @param batch_size: the number of rows to fetch from SQLite per round trip
+        @param rowid_range: an optional (exclusive min, inclusive max) tuple of message.ROWIDs
+        @param with_attachments: add a column with the paths loaded by load_attachment_dict
+        @param with_chats: add the chat columns loaded by load_chat_dict (and order by chat)
+        @param date_converter: if given, a util.DateConverter to format dates with (for another
+        timezone or format); by default SQLite formats them in local time
+        @param message_filter: an optional MessageFilter to only export some of the messages
+        @param with_reactions: add a column with the tapbacks loaded by load_reaction_dict
+        @return: a generator of messages with names appended
+        """
+        message_schema = self.get_schema()
+        if date_converter is None:
+            date_sql = "strftime('%Y-%m-%d %H:%M:%S', {}, 'unixepoch', 'localtime')".format(
+                MessageDB.UNIX_SECONDS_SQL)
+        else:
+            date_sql = 'message.date'
+        # Messages from handles that aren't in the address book get empty names
+        columns = ['''(CASE WHEN contact.key IS NULL THEN '' ELSE contact.last END),
+                      (CASE WHEN contact.key IS NULL THEN '' ELSE contact.first END),
+                      handle_key.key,
+                      {date},
+                      (CASE WHEN message.is_from_me THEN 'Yes' ELSE 'No' END) as is_from_me,
+                      {text}, handle.service as service
+                   '''.format(date=date_sql, text=message_schema.text_sql)]
+        joins = ['''LEFT JOIN temp.handle_key
+                        ON handle_key.id = handle.id
+                    LEFT JOIN temp.contact
+                        ON contact.key = handle_key.key''']
+        if with_chats:
+            columns.append('''COALESCE(chat_info.identifier, ''), COALESCE(chat_info.name, ''),
+                              COALESCE(chat_info.participants, '')''')
+            joins.append('''LEFT JOIN temp.chat_info
+                             ON chat_info.chat_id = {}'''.format(message_schema.chat_id_sql))
+        if with_attachments:
+            columns.append("COALESCE(message_attachment.paths, '')")
+            joins.append('''LEFT JOIN temp.message_attachment
+                             ON message_attachment.message_id = message.ROWID''')
+        if with_reactions:
+            columns.append("COALESCE(message_reaction.reactions, '')")
+            joins.append('''LEFT JOIN temp.message_reaction
+                             ON message_reaction.guid = message.guid''')
+        sql, params = MessageDB.__message_sql(message_schema, columns, joins, rowid_range,
+                                              with_chats, message_filter)
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute(sql, params)
+            for rows in MessageDB.__iter_batches(cur, batch_size):
+                rows = attributed_body.decode_text_column(rows, 5)
+                if date_converter is None:
+                    yield from rows
+                    continue
+                dates = date_converter.convert([row[3] for row in rows])
+                for row, date in zip(rows, dates):
+                    yield row[:3] + (date,) + row[4:]
+
+    def __message_sql(message_schema, columns, joins=(), rowid_range=None, chats=False,
+                      message_filter=None):
+        """ Builds the query both engines use to pull messages (each distinct query is put
+        together once per schema and then reused while it's in use; see MessageSchema.query)
+        @param message_schema: the schema.MessageSchema of the DB
+        @param columns: the list of column expressions to select
+        @param joins: extra joins (the message, handle and chat tables are already joined)
+        @param rowid_range: an optional (exclusive min, inclusive max) tuple of message.ROWIDs
+        @param chats: join through chat_message_join and order by conversation, keeping messages
+        with no handle (otherwise messages are ordered by handle)
+        @param message_filter: an optional MessageFilter
+        @return: a tuple of (sql, params)
+        """
+        where_sql, params = MessageDB.__where(rowid_range, message_filter, message_schema)
+        return message_schema.query(
+            ('messages', tuple(columns), tuple(joins), chats, where_sql),
+            lambda: MessageDB.__build_message_sql(message_schema, columns, joins, chats,
+                                                  where_sql)), params
+
+    def __from_sql(message_schema, chats):
+        # The tables messages are pulled from (see __build_message_sql and count_messages)
+        if not chats:
+            return '''message
+                      INNER JOIN handle
+                          ON handle.ROWID = message.handle_id'''
+        from_sql = '''message
+                      LEFT JOIN handle
+                          ON handle.ROWID = message.handle_id'''
+        if message_schema.has_chats:
+            from_sql += '''
+                      LEFT JOIN chat_message_join
+                          ON chat_message_join.message_id = message.ROWID'''
+        return from_sql
+
+    def __build_message_sql(message_schema, columns, joins, chats, where_sql):
+        from_sql = MessageDB.__from_sql(message_schema, chats)
+        sql = '''
+                SELECT {columns}
+                FROM {from_sql}
+                {joins}
+                {where}
+                ORDER BY {order_by}
+              '''.format(columns=', '.join(columns), from_sql=from_sql, joins='\n'.join(joins),
+                         where=where_sql,
+                         order_by=', '.join(MessageDB.__order_by_columns(message_schema, chats)))
+        return sql
+
+    def __order_by_columns(message_schema, chats=False):
+        # By conversation (or handle), then date; ties (e.g. messages in the same second on older
+        # iOS versions) go by ROWID so the order is always the same. NULLs are swapped for values
+        # that sort first so that these columns also work as a sort key in Python (see sort_key)
+        return ['IFNULL({}, -1)'.format(message_schema.chat_id_sql) if chats
+                else "IFNULL(handle.id, '')",
+                'IFNULL({}, 0)'.format(MessageDB.UNIX_TIMESTAMP_SQL), 'message.ROWID']
+
+    @staticmethod
+    def sort_key(row):
+        """ The sort key of a row from iter_messages_matched_to_contact_dict(sort_keys=True): its
+        last three columns, the ORDER BY of the query """
+        return row[-3:]
+
+    def __where(rowid_range, message_filter, message_schema):
+        conditions, params = [], []
+        if rowid_range is not None:
+            conditions.append('message.ROWID > ? AND message.ROWID <= ?')
+            params.extend(rowid_range)
+        if message_filter is not None:
+            filter_conditions, filter_params = message_filter.where(message_schema)
+            conditions.extend(filter_conditions)
+            params.extend(filter_params)
+        if not conditions:
+            return '', ()
+        return 'WHERE ' + ' AND '.join(conditions), params
+
+    def __iter_batches(cur, batch_size):
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
     
-        if name_tuple is None:
-            name_tuple = ['', '']
-        return [name_tuple[1], name_tuple[0], contact_key,
-                util.convert_timestamp_to_date(row[1])] + list(row[2:])
\ No newline at end of file
+    def __participant_name(handle_id, contacts_dict, handle_dict):
+        contact_key = handle_dict.get(handle_id)
+        name_tuple = contacts_dict.get(contact_key)
+        if name_tuple is not None:
+            name = ' '.join(name for name in name_tuple if name)
+            if name:
+                return name
+        return contact_key or handle_id
+
+    def __map_message_to_contact(row, date, handle_columns):
+        # The name/key columns are shared by every message from the handle
+        return handle_columns.get(row[0], MessageDB.NO_CONTACT) + (date,) + row[2:]
@@ -0,0 +1,105 @@
+import itertools
+import os
+import threading
+import time
+from collections import namedtuple
+
+# A snapshot of how far an export has got: the stage it's in (see message_extractor.py; 'done'
+# once it has finished), the messages written so far out of total_rows (an estimate, None until
+# the export stage), the size of the output so far, the seconds since the export started and the
+# estimated seconds left (None until some messages have been written)
+ExportProgress = namedtuple('ExportProgress', ['stage', 'rows', 'total_rows', 'bytes_written',
+                                               'seconds', 'eta'])
+
+
+class ExportCancelled(Exception):
+    """ Raised in an export that was cancelled (see ProgressReporter.cancel) """
+
+
+class ProgressReporter():
+    """ Passes ExportProgress snapshots of an export to a callback: one as each stage starts and
+    then one per batch of messages written. It's also how an export gets cancelled: once cancel()
+    is called (from any thread), the export raises ExportCancelled the next time it reports in,
+    which unwinds it like any other error (closing its connections and files). Pass one to
+    extract_messages:
+
+        extract_messages(backup_dir, output_path, 'US', progress=ProgressReporter(print))
+    """
+
+    def __init__(self, callback=None, output_path=None):
+        """
+        @param callback: called with an ExportProgress every time the export reports in (in the
+        export's thread; default=None, nothing is called)
+        @param output_path: the path being written to, to report its size until the export has
+        opened its writer (default=None, sizes are 0 until then)
+        """
+        self.callback = callback
+        self.output_path = output_path
+        # The message_extractor.MessageWriter being written to, which knows the size of the output
+        # so far (split parts, uncommitted pages, ...); set by extract_messages
+        self.writer = None
+        self.stage = None
+        self.rows = 0
+        self.total_rows = None
+        self.start_time = time.perf_counter()
+        self.export_start_time = None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """ Asks the export to stop the next time it reports in """
+        self.cancelled.set()
+
+    def report(self, stage=None):
+        """ Reports where the export is to the callback
+        @param stage: the name of the stage that is starting (default=None, still the same one)
+        @raise ExportCancelled: if cancel() has been called
+        """
+        if self.cancelled.is_set():
+            raise ExportCancelled('Export cancelled{}'.format(
+                '' if self.stage is None else ' during ' + self.stage))
+        if stage is not None:
+            self.stage = stage
+        if self.callback is not None:
+            self.callback(self.snapshot())
+
+    def finish(self):
+        """ Reports that the export is done (it's too late to cancel it by then) """
+        self.stage = 'done'
+        if self.callback is not None:
+            self.callback(self.snapshot())
+
+    def snapshot(self):
+        """ The current ExportProgress """
+        now = time.perf_counter()
+        eta = None
+        if self.total_rows is not None and self.rows:
+            # Assumes the rest of the messages go as quickly as the ones so far
+            eta = max(0, (now - self.export_start_time) * (self.total_rows - self.rows) /
+                      self.rows)
+        bytes_written = 0
+        if self.writer is not None:
+            bytes_written = self.writer.bytes_written()
+        elif self.output_path is not None and os.path.isfile(self.output_path):
+            bytes_written = os.path.getsize(self.output_path)
+        return ExportProgress(self.stage, self.rows, self.total_rows, bytes_written,
+                              now - self.start_time, eta)
+
+    def iter_rows(self, rows, total_rows, batch_size):
+        """ Passes rows through, reporting in after every batch_size of them
+        @param rows: an iterable of the messages being written
+        @param total_rows: the number of messages expected (used for the ETA)
+        @param batch_size: how many messages to pass through between reports
+        @return: a generator of the same rows
+        """
+        self.total_rows = total_rows
+        self.export_start_time = time.perf_counter()
+        rows = iter(rows)
+        try:
+            for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+                yield from batch
+                self.rows += len(batch)
+                self.report()
+        finally:
+            # Close the query generator now (e.g. when cancelled), while its connection is open
+            if hasattr(rows, 'close'):
+                rows.close()
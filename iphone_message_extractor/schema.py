@@ -0,0 +1,142 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# sms.db has changed shape over the years: attributedBody only turned up in newer iOS versions,
+# tapbacks (reactions) are stored as messages of their own with an associated_message_type and
+# associated_message_guid since iOS 10, emoji reactions got an associated_message_emoji column in
+# iOS 17, and so on. Rather than assuming one schema, the columns of a DB are probed once (with
+# PRAGMA table_info) and the queries are put together from what is actually there. Everything
+# that depends on the schema is worked out once per distinct schema (see get_message_schema), so
+# exporting many backups of the same iOS version probes each DB but only plans the queries once
+
+# The tables of sms.db whose columns are probed
+MESSAGE_TABLES = ('message', 'handle', 'chat', 'chat_message_join', 'chat_handle_join',
+                  'attachment', 'message_attachment_join')
+
+# What an export can do with tapbacks: keep them as messages of their own (like older versions of
+# the extractor), skip them or fold them into a 'Reactions' column of the message they react to
+TAPBACKS = ('keep', 'skip', 'fold')
+
+# associated_message_type values of tapbacks, by what they say about the message they react to.
+# Taking a tapback back again is recorded as a message of its own too, with the same type + 1000
+TAPBACK_VERBS = {2000: 'Loved', 2001: 'Liked', 2002: 'Disliked', 2003: 'Laughed at',
+                 2004: 'Emphasized', 2005: 'Questioned', 2006: 'Reacted to'}
+TAPBACK_REMOVED_OFFSET = 1000
+# The tapbacks a person can only leave one of on a message: a new one replaces theirs (emoji
+# reactions, 2006, are kept apart from these)
+EXCLUSIVE_TAPBACK_TYPES = frozenset(range(2000, 2006))
+# Every associated_message_type that is a tapback (or a tapback taken back). Other types in the
+# same range (e.g. 2007 for stickers) are messages in their own right and are left alone
+TAPBACK_TYPES = tuple(sorted(TAPBACK_VERBS)) + \
+    tuple(sorted(tapback_type + TAPBACK_REMOVED_OFFSET for tapback_type in TAPBACK_VERBS))
+
+# Shared MessageSchemas by fingerprint (see get_message_schema)
+_message_schemas = {}
+
+def probe_columns(conn, tables, schema_name='main'):
+    """ Gets the columns of some tables of a DB
+    @param conn: a connection to the DB
+    @param tables: the names of the tables
+    @param schema_name: the name the DB is attached under (default=main)
+    @return: a dict of table name: tuple of column names (empty for tables that don't exist)
+    """
+    return dict((table, tuple(row[1] for row in conn.execute(
+                    'PRAGMA {}.table_info({})'.format(schema_name, table))))
+                for table in tables)
+
+def schema_fingerprint(columns):
+    """ Hashes the output of probe_columns; DBs with the same tables and columns (e.g. from the
+    same iOS version) have the same fingerprint """
+    return hashlib.sha1(json.dumps(sorted(columns.items())).encode('utf-8')).hexdigest()
+
+def get_message_schema(conn):
+    """ Probes sms.db and gets the MessageSchema for it (the same one for every DB with the same
+    fingerprint)
+    @param conn: a connection to sms.db
+    @return: a MessageSchema
+    """
+    columns = probe_columns(conn, MESSAGE_TABLES)
+    fingerprint = schema_fingerprint(columns)
+    message_schema = _message_schemas.get(fingerprint)
+    if message_schema is None:
+        message_schema = _message_schemas.setdefault(fingerprint,
+                                                     MessageSchema(columns, fingerprint))
+    return message_schema
+
+def parent_guid(associated_message_guid):
+    """ The guid of the message a tapback reacts to, from its associated_message_guid ('p:0/<guid>'
+    for a part of a message, 'bp:<guid>' for a whole one) """
+    guid = associated_message_guid.rsplit('/', 1)[-1]
+    return guid[3:] if guid.startswith('bp:') else guid
+
+
+class MessageSchema():
+    """ What the queries on one schema of sms.db can rely on, along with the queries themselves
+    once they've been put together (see query) """
+
+    # The most queries kept per schema. Keys include things like the number of handles filtered
+    # on, so a long-running process would otherwise keep every variation it has ever seen
+    MAX_QUERIES = 128
+
+    def __init__(self, columns, fingerprint=None):
+        """
+        @param columns: the output of probe_columns
+        @param fingerprint: its schema_fingerprint (worked out if not given)
+        """
+        self.columns = dict((table, frozenset(names)) for table, names in columns.items())
+        self.fingerprint = fingerprint or schema_fingerprint(columns)
+        # The body of a message: its text, or its attributedBody where it has no text (decoded in
+        # Python a batch at a time; see attributed_body.py)
+        self.text_sql = 'COALESCE(message.text, message.attributedBody)' \
+            if self.has_column('message', 'attributedBody') else 'message.text'
+        self.has_tapbacks = self.has_column('message', 'associated_message_type')
+        # Folding tapbacks needs to know which message each one reacts to
+        self.can_fold_tapbacks = self.has_tapbacks and \
+            self.has_column('message', 'associated_message_guid') and \
+            self.has_column('message', 'guid')
+        self.tapback_emoji_sql = 'message.associated_message_emoji' \
+            if self.has_column('message', 'associated_message_emoji') else 'NULL'
+        # Which conversation each message is in; without chat_message_join every message is
+        # treated as being in no chat at all
+        self.has_chats = self.has_column('chat_message_join', 'chat_id') and \
+            self.has_column('chat_message_join', 'message_id')
+        self.chat_id_sql = 'chat_message_join.chat_id' if self.has_chats else 'NULL'
+        self.has_chat_info = self.has_column('chat', 'chat_identifier')
+        self.has_chat_participants = self.has_column('chat_handle_join', 'chat_id') and \
+            self.has_column('chat_handle_join', 'handle_id')
+        self.chat_name_sql = 'display_name' if self.has_column('chat', 'display_name') else 'NULL'
+        self.has_attachments = self.has_column('message_attachment_join', 'message_id') and \
+            self.has_column('message_attachment_join', 'attachment_id') and \
+            self.has_column('attachment', 'filename')
+        # Key: SQL, least recently used first (schemas are shared between threads)
+        self.queries = OrderedDict()
+        self.queries_lock = threading.Lock()
+
+    def has_column(self, table, column):
+        return column in self.columns.get(table, ())
+
+    def tapback_where(self):
+        """ The condition that leaves tapbacks out, or None if this schema doesn't have any """
+        if not self.has_tapbacks:
+            return None
+        return 'IFNULL(message.associated_message_type, 0) NOT IN ({})'.format(
+            ', '.join(map(str, TAPBACK_TYPES)))
+
+    def query(self, key, build):
+        """ A query on this schema, only put together the first time it's asked for
+        @param key: what the query depends on besides the schema (hashable)
+        @param build: a function that puts the query together
+        """
+        with self.queries_lock:
+            sql = self.queries.get(key)
+            if sql is not None:
+                self.queries.move_to_end(key)
+                return sql
+        sql = build()
+        with self.queries_lock:
+            self.queries[key] = sql
+            while len(self.queries) > self.MAX_QUERIES:
+                self.queries.popitem(last=False)
+        return sql
@@ -0,0 +1,124 @@
+import sqlite3
+
+from .phone_db import PhoneDB
+
+# A searchable export (-f sqlite) is a standalone SQLite database: the people, phone numbers/
+# e-mails and conversations in the export each get a table of their own, messages point at them,
+# and an FTS5 index over the message text makes text searches an index lookup instead of a scan
+# of every message. See message_extractor.SQLiteMessageWriter for how it's written
+
+SCHEMA_SQL = '''
+    CREATE TABLE contacts (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT);
+    CREATE TABLE handles (id INTEGER PRIMARY KEY, value TEXT NOT NULL,
+                          contact_id INTEGER REFERENCES contacts (id));
+    CREATE TABLE chats (id INTEGER PRIMARY KEY, identifier TEXT NOT NULL, name TEXT,
+                        participants TEXT);
+    CREATE TABLE messages (id INTEGER PRIMARY KEY, handle_id INTEGER REFERENCES handles (id),
+                           chat_id INTEGER REFERENCES chats (id), date TEXT,
+                           is_from_me INTEGER NOT NULL, text TEXT, service TEXT,
+                           attachments TEXT);
+    -- External content table: the text is only stored once, in messages
+    CREATE VIRTUAL TABLE messages_fts USING fts5(text, content='messages', content_rowid='id');
+    -- The same columns as a CSV export, for browsing with any SQLite client
+    CREATE VIEW messages_view AS
+        SELECT messages.id, contacts.last_name, contacts.first_name, handles.value AS handle,
+               messages.date, messages.is_from_me, messages.text, messages.service,
+               chats.identifier AS chat, chats.name AS chat_name, chats.participants,
+               messages.attachments
+        FROM messages
+        LEFT JOIN handles ON handles.id = messages.handle_id
+        LEFT JOIN contacts ON contacts.id = handles.contact_id
+        LEFT JOIN chats ON chats.id = messages.chat_id;
+'''
+
+# Created once everything is loaded (much faster than keeping them up to date row by row)
+INDEX_SQL = '''
+    BEGIN;
+    CREATE INDEX contacts_name ON contacts (last_name, first_name);
+    CREATE UNIQUE INDEX handles_value ON handles (value);
+    CREATE INDEX handles_contact ON handles (contact_id);
+    CREATE UNIQUE INDEX chats_identifier ON chats (identifier);
+    CREATE INDEX messages_date ON messages (date);
+    CREATE INDEX messages_handle_date ON messages (handle_id, date);
+    CREATE INDEX messages_chat_date ON messages (chat_id, date);
+    INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+    COMMIT;
+'''
+
+INSERT_CONTACT_SQL = "INSERT INTO contacts (id, first_name, last_name) VALUES (?, ?, ?)"
+INSERT_HANDLE_SQL = "INSERT INTO handles (id, value, contact_id) VALUES (?, ?, ?)"
+INSERT_CHAT_SQL = "INSERT INTO chats (id, identifier, name, participants) VALUES (?, ?, ?, ?)"
+INSERT_MESSAGE_SQL = '''INSERT INTO messages (handle_id, chat_id, date, is_from_me, text, service,
+                                              attachments)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)'''
+
+# Columns of search results
+SEARCH_HEADER_ROW = ['Date & Time', 'Last Name', 'First Name', 'Phone #', 'Is from me?',
+                     'Message', 'Service', 'Chat Name']
+
+def create_index_db(db_path):
+    """ Creates an empty searchable export at db_path (which must not exist yet). Durability is
+    traded for speed while it's written, since a failed export is thrown away anyway
+    @return: the sqlite3 connection (in autocommit mode; see SQLiteMessageWriter)
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executescript(SCHEMA_SQL)
+    return conn
+
+def create_indexes(conn):
+    """ Adds the indexes (including the full-text index) to a fully loaded searchable export """
+    conn.executescript(INDEX_SQL)
+
+def search_messages(db_path, text=None, contact=None, since=None, until=None, limit=None):
+    """ Searches a searchable export (-f sqlite). Every criterion given has to match
+    @param db_path: the path to the export
+    @param text: an FTS5 query on the message text, e.g. 'ring' or '"mount doom" OR mordor'
+    @param contact: part of a contact's name ('Frodo', 'Frodo Baggins') or of their phone
+    number/e-mail
+    @param since: only messages from this date on ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS')
+    @param until: only messages up to and including this date (a whole day if only a date is
+    given)
+    @param limit: the maximum number of messages to return (default=None, all)
+    @return: a list of rows (see SEARCH_HEADER_ROW) in date order
+    """
+    joins, where, params = [], [], []
+    if text is not None:
+        joins.append("JOIN messages_fts ON messages_fts.rowid = messages.id")
+        where.append("messages_fts MATCH ?")
+        params.append(text)
+    if contact is not None:
+        # Either part of the name can be missing (NULL)
+        where.append('''(TRIM(COALESCE(contacts.first_name, '') || ' ' ||
+                               COALESCE(contacts.last_name, '')) LIKE ?
+                          OR TRIM(COALESCE(contacts.last_name, '') || ' ' ||
+                                  COALESCE(contacts.first_name, '')) LIKE ?
+                          OR handles.value LIKE ?)''')
+        params.extend(['%{}%'.format(contact)] * 3)
+    if since is not None:
+        where.append("messages.date >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("messages.date <= ?")
+        # '2011-12-19' takes in the whole day
+        params.append(until if len(until) > 10 else until + ' 23:59:59')
+    sql = '''SELECT messages.date, contacts.last_name, contacts.first_name, handles.value,
+                    (CASE WHEN messages.is_from_me THEN 'Yes' ELSE 'No' END), messages.text,
+                    messages.service, chats.name
+             FROM messages
+             {joins}
+             LEFT JOIN handles ON handles.id = messages.handle_id
+             LEFT JOIN contacts ON contacts.id = handles.contact_id
+             LEFT JOIN chats ON chats.id = messages.chat_id
+             {where}
+             ORDER BY messages.date, messages.id
+             {limit}
+          '''.format(joins=' '.join(joins),
+                     where='WHERE ' + ' AND '.join(where) if where else '',
+                     limit='' if limit is None else 'LIMIT {:d}'.format(limit))
+    conn = sqlite3.connect(PhoneDB.sqlite_uri(db_path), uri=True)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
@@ -0,0 +1,114 @@
+import heapq
+import itertools
+import os
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .phone_db import PhoneDB, MessageDB
+from . import util
+
+# Parallel exports split sms.db's messages into shards (contiguous ranges of message.ROWID). Each
+# worker process opens its own read-only connection and queries, maps and serializes whole shards
+# (each one in the export's order) to temp files, which are then merged back into one ordered
+# stream for the writer
+
+# Shards per worker; more, smaller shards even out ROWID ranges that are denser than others
+SHARDS_PER_WORKER = 4
+
+# What every shard in a worker process needs, set once per process by init_worker (rather than
+# being pickled along with every shard)
+_worker_state = {}
+
+def split_rowid_range(rowid_range, shard_count):
+    """ Splits a range of message.ROWIDs into contiguous shards of about the same size
+    @param rowid_range: an (exclusive min, inclusive max) tuple of message.ROWIDs
+    @param shard_count: the number of shards to split it into (fewer if the range is smaller)
+    @return: a list of (exclusive min, inclusive max) tuples
+    """
+    low, high = rowid_range
+    shard_count = max(1, min(shard_count, high - low))
+    bounds = [low + (high - low) * i // shard_count for i in range(shard_count + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+def init_worker(sms_db_path, contacts_dict, handle_dict, attachment_dict, chat_dict, timezone,
+                date_format, batch_size, message_filter=None, reaction_dict=None):
+    _worker_state.update(sms_db_path=sms_db_path, contacts_dict=contacts_dict,
+                         handle_dict=handle_dict, attachment_dict=attachment_dict,
+                         chat_dict=chat_dict, timezone=timezone, date_format=date_format,
+                         batch_size=batch_size, message_filter=message_filter,
+                         reaction_dict=reaction_dict)
+
+def export_shard(rowid_range, shard_path):
+    """ Queries and maps the messages in one shard and pickles them to shard_path, a batch at a
+    time, as (sort key, message) tuples in order (runs in a worker; see init_worker)
+    @return: the number of messages in the shard
+    """
+    state = _worker_state
+    message_db = MessageDB(state['sms_db_path'], **PhoneDB.BACKUP_DB_OPTIONS)
+    message_db.connect()
+    try:
+        date_converter = util.DateConverter(util.get_timezone(state['timezone']),
+                                            state['date_format'])
+        messages = message_db.iter_messages_matched_to_contact_dict(
+            state['contacts_dict'], state['batch_size'], handle_dict=state['handle_dict'],
+            rowid_range=rowid_range, attachment_dict=state['attachment_dict'],
+            chat_dict=state['chat_dict'], date_converter=date_converter, sort_keys=True,
+            message_filter=state['message_filter'], reaction_dict=state['reaction_dict'])
+        row_count = 0
+        with open(shard_path, 'wb') as fp:
+            for batch in iter(lambda: list(itertools.islice(messages, state['batch_size'])), []):
+                pickle.dump(batch, fp, pickle.HIGHEST_PROTOCOL)
+                row_count += len(batch)
+        return row_count
+    finally:
+        message_db.close()
+
+def iter_shard(shard_path):
+    """ The (sort key, message) tuples written by export_shard """
+    with open(shard_path, 'rb') as fp:
+        while True:
+            try:
+                batch = pickle.load(fp)
+            except EOFError:
+                return
+            yield from batch
+
+def iter_messages_in_parallel(sms_db_path, rowid_range, workers, contacts_dict, handle_dict,
+                              attachment_dict=None, chat_dict=None, timezone=None,
+                              date_format=util.DEFAULT_DATE_FORMAT,
+                              batch_size=MessageDB.DEFAULT_BATCH_SIZE, message_filter=None,
+                              reaction_dict=None):
+    """ Same output as MessageDB.iter_messages_matched_to_contact_dict, but the querying and
+    mapping is spread over worker processes, one shard of rowid_range at a time. Nothing is
+    generated until every shard is done; the shards are then merged (k-way, on the ORDER BY of the
+    query) as they are read back
+    @param sms_db_path: the path to sms.db
+    @param rowid_range: the (exclusive min, inclusive max) tuple of message.ROWIDs to export
+    @param workers: the number of processes to use
+    @param contacts_dict: the dictionary of phone numbers to names
+    @param handle_dict: the output of MessageDB.generate_handle_dict
+    @param attachment_dict: see MessageDB.iter_messages_matched_to_contact_dict
+    @param chat_dict: see MessageDB.iter_messages_matched_to_contact_dict
+    @param timezone: the timezone to show dates in (default=None, local time)
+    @param date_format: the strftime format for dates
+    @param batch_size: the number of rows to fetch from SQLite (and pickle) at a time
+    @param message_filter: an optional phone_db.MessageFilter, applied in every shard
+    @param reaction_dict: see MessageDB.iter_messages_matched_to_contact_dict
+    @return: a generator of messages with names appended
+    """
+    shard_ranges = split_rowid_range(rowid_range, workers * SHARDS_PER_WORKER)
+    with tempfile.TemporaryDirectory(prefix='iphone_message_extractor-') as tmp_dir:
+        shard_paths = [os.path.join(tmp_dir, '{}.pickle'.format(i))
+                       for i in range(len(shard_ranges))]
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(sms_db_path, contacts_dict, handle_dict,
+                                           attachment_dict, chat_dict, timezone, date_format,
+                                           batch_size, message_filter,
+                                           reaction_dict)) as executor:
+            for future in [executor.submit(export_shard, shard_range, shard_path)
+                           for shard_range, shard_path in zip(shard_ranges, shard_paths)]:
+                future.result()
+        # Sort keys end in the ROWID, so no two are equal and messages themselves never get compared
+        for _, message in heapq.merge(*map(iter_shard, shard_paths)):
+            yield message
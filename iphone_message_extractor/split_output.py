@@ -0,0 +1,108 @@
+import json
+import os
+from datetime import datetime
+
+from .compressed_output import COMPRESSIONS, file_sha256
+from . import util
+
+# Split exports are written as a series of parts next to the output path (messages.00001.csv,
+# messages.00002.csv, ... or messages.2011-12.csv, ... when split by month), each a complete CSV
+# with its own header, plus a manifest listing every part with its row count, size and SHA-256.
+# The manifest is rewritten every time a part (or month) is done, so a rerun can pick up after
+# the last complete one (see SplitMessageWriter in message_extractor.py)
+
+# Bump whenever the layout of the manifest changes
+MANIFEST_VERSION = 1
+
+# What a new part can be started on (besides a number of rows or bytes): every handle (or
+# conversation, in exports with chats) or every month
+SPLIT_BY = ('contact', 'month')
+
+# The part name of messages without a date, when split by month
+NO_MONTH = 'undated'
+
+def manifest_path_for_output(output_path):
+    """ Where the manifest of a split export to output_path is written """
+    return output_path + '.manifest.json'
+
+def part_path(output_path, part_name, compression=None):
+    """ The path of a part of a split export, e.g. messages.00001.csv.gz for messages.csv """
+    root, ext = os.path.splitext(output_path)
+    return '{}.{}{}{}'.format(root, part_name, ext, COMPRESSIONS.get(compression, ''))
+
+def split_key(header_row, split_by, date_format=util.DEFAULT_DATE_FORMAT):
+    """ The function that gives the part key of a row: messages with different keys never share a
+    part (and consecutive runs of messages with the same key do)
+    @param header_row: the columns of the export
+    @param split_by: one of SPLIT_BY (or None)
+    @param date_format: the strftime format of the dates in the export
+    @return: a function of a row, or None when split_by is None
+    """
+    if split_by is None:
+        return None
+    elif split_by == 'contact':
+        column = header_row.index('Chat' if 'Chat' in header_row else 'Phone #')
+        return lambda row: row[column]
+    elif split_by == 'month':
+        column = header_row.index('Date & Time')
+        if date_format == util.DEFAULT_DATE_FORMAT:
+            return lambda row: row[column][:7] if row[column] else NO_MONTH
+        return lambda row: datetime.strptime(row[column], date_format).strftime('%Y-%m') \
+            if row[column] else NO_MONTH
+    raise ValueError('Unknown split: {}'.format(split_by))
+
+def load_manifest(output_path):
+    """ Loads the manifest of the previous split export to output_path
+    @return: a dict with settings, rows, complete and parts, or None if there's no (usable) manifest
+    """
+    try:
+        with open(manifest_path_for_output(output_path)) as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+def save_manifest(output_path, settings, rows, parts, complete=False):
+    """ Atomically writes the manifest of a split export to output_path
+    @param settings: what the parts were written with (see SplitMessageWriter); a rerun can only
+    resume if they're the same
+    @param rows: the number of messages in all of the parts together
+    @param parts: a list of dicts with the path (relative to the manifest), key, rows, bytes and
+    sha256 of each part
+    @param complete: whether the export has finished
+    """
+    manifest = {'version': MANIFEST_VERSION, 'settings': settings, 'rows': rows,
+                'complete': complete, 'parts': parts}
+    manifest_path = manifest_path_for_output(output_path)
+    with open(manifest_path + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def remove_parts(output_path, manifest):
+    """ Removes the parts listed in a manifest of an export to output_path (and the manifest) """
+    if manifest is not None:
+        for part in manifest['parts']:
+            try:
+                os.remove(os.path.join(os.path.dirname(output_path), part['path']))
+            except FileNotFoundError:
+                pass
+    try:
+        os.remove(manifest_path_for_output(output_path))
+    except FileNotFoundError:
+        pass
+
+def check_parts(output_path, manifest, settings):
+    """ Checks whether a previous, interrupted, export to output_path can be picked up again:
+    it was written with the same settings and all of its parts are still there, unchanged
+    @param manifest: the manifest of the previous export (see load_manifest)
+    @param settings: the settings of the new export
+    @return: True if it can be resumed
+    """
+    if manifest is None or manifest['settings'] != settings:
+        return False
+    for part in manifest['parts']:
+        path = os.path.join(os.path.dirname(output_path), part['path'])
+        if not os.path.isfile(path) or os.path.getsize(path) != part['bytes'] or \
+                file_sha256(path).hexdigest() != part['sha256']:
+            return False
+    return True
@@ -0,0 +1,188 @@
+import hashlib
+import itertools
+import os
+import plistlib
+import random
+import sqlite3
+
+from .phone_db import PhoneDB, ManifestDB
+
+# Synthetic data for benchmarking: a backup with as many contacts, handles and messages as you
+# like, laid out exactly like a real (unencrypted) iTunes/Finder backup. Only the columns the
+# extractor reads are created
+
+FIRST_NAMES = ['Frodo', 'Samwise', 'Meriadoc', 'Peregrin', 'Bilbo', 'Gandalf', 'Aragorn',
+               'Legolas', 'Gimli', 'Boromir', 'Faramir', 'Eowyn', 'Arwen', 'Galadriel', 'Elrond',
+               'Theoden', 'Eomer', 'Rosie', 'Lobelia', 'Fredegar']
+LAST_NAMES = ['Baggins', 'Gamgee', 'Brandybuck', 'Took', 'Cotton', 'Sackville', 'Bolger',
+              'Proudfoot', 'Greenleaf', 'Oakenshield', 'of Rohan', 'of Gondor', 'Underhill', None]
+WORDS = ['ring', 'mordor', 'shire', 'second', 'breakfast', 'elevenses', 'mushrooms', 'road',
+         'goes', 'ever', 'on', 'precious', 'fly', 'you', 'fools', 'taters', 'boil', 'mash', 'stew',
+         'one', 'does', 'not', 'simply', 'walk', 'into', 'the', 'a', 'is', 'to', 'of', 'we']
+SERVICES = ['iMessage', 'iMessage', 'iMessage', 'SMS']
+
+# (format for a number as stored in the address book, format for the same number as stored in
+# handle.id, number of random digits in {area} and {number}). US area codes can't start with 0/1
+PHONE_FORMATS = [('({area}) 555-{number}', '+1{area}555{number}', 3, 4),
+                 ('+44 20 7946 {number}', '+44207946{number}', 0, 4),
+                 ('+49 30 {number}', '+4930{number}', 0, 8),
+                 ('+33 1 {number}', '+331{number}', 0, 8),
+                 ('+61 2 {number}', '+612{number}', 0, 8),
+                 ('+91 98{number}', '+9198{number}', 0, 8)]
+
+INSERT_CHUNK_SIZE = 10000
+
+# 2019-01-01 in seconds since 2001-01-01 (Apple's epoch)
+START_DATE = 567993600
+
+def file_id(domain, relative_path):
+    """ The fileID a file is stored under in a backup (SHA1 of '<domain>-<relativePath>') """
+    return hashlib.sha1('{}-{}'.format(domain, relative_path).encode('utf-8')).hexdigest()
+
+def backup_file_path(backup_dir, domain_path):
+    """ The physical path of the file with the given (domain, relativePath) in a backup """
+    fid = file_id(*domain_path)
+    return os.path.join(backup_dir, fid[:2], fid)
+
+def random_phone(rng):
+    """ A random (valid) phone number
+    @return: a tuple of (how it's written in the address book, how it's written in handle.id)
+    """
+    book_format, handle_format, area_digits, number_digits = rng.choice(PHONE_FORMATS)
+    area = ''.join(rng.choice('23456789' if i == 0 else '0123456789') for i in range(area_digits))
+    number = ''.join(rng.choice('0123456789') for _ in range(number_digits))
+    return book_format.format(area=area, number=number), \
+        handle_format.format(area=area, number=number)
+
+def create_synthetic_backup(backup_dir, contacts=1000, handles=1500, messages=100000,
+                            group_chats=50, seed=0):
+    """ Creates an on-disk backup at backup_dir (Manifest.plist, Manifest.db and the hashed sms.db
+    and AddressBook.sqlitedb) filled with random data
+    @param backup_dir: the device hash directory to create
+    @param contacts: the number of people in the address book (each has 1-3 phone numbers and/or
+    e-mail addresses, with numbers from a mix of countries)
+    @param handles: the number of handles (people messaged) in sms.db; at least 1 in 5 is someone
+    who isn't in the address book
+    @param messages: the number of messages
+    @param group_chats: the number of group chats (every handle also gets a 1:1 chat)
+    @param seed: the random seed, so the same arguments always make the same backup
+    @return: a dict with the number of contacts, handles, messages and chats created
+    """
+    rng = random.Random(seed)
+    os.makedirs(backup_dir)
+    with open(os.path.join(backup_dir, 'Manifest.plist'), 'wb') as fp:
+        plistlib.dump({'IsEncrypted': False}, fp)
+
+    # Address book: each contact value is remembered with the way it would appear as a handle
+    people, values, known_handles = [], [], []
+    for rowid in range(1, contacts + 1):
+        people.append((rowid, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)))
+        for _ in range(rng.randint(1, 3)):
+            if rng.random() < 0.25:
+                email = '{}.{}@example.{}'.format(people[-1][1].lower(), rowid,
+                                                  rng.choice(['com', 'net', 'org']))
+                values.append((rowid, email))
+                known_handles.append(email)
+            else:
+                book_value, handle_value = random_phone(rng)
+                values.append((rowid, book_value))
+                known_handles.append(handle_value)
+
+    # Most handles are people in the address book, the rest are strangers
+    known_handles = list(dict.fromkeys(known_handles))
+    handle_ids = rng.sample(known_handles, min(len(known_handles), handles * 4 // 5))
+    seen = set(handle_ids)
+    while len(handle_ids) < handles:
+        handle_id = random_phone(rng)[1]
+        if handle_id not in seen:
+            seen.add(handle_id)
+            handle_ids.append(handle_id)
+
+    chats = [(rowid, handle_id, '', [rowid]) for rowid, handle_id in enumerate(handle_ids, 1)]
+    for i in range(group_chats):
+        if len(handle_ids) < 2:
+            break
+        members = rng.sample(range(1, len(handle_ids) + 1), min(len(handle_ids),
+                                                                 rng.randint(2, 6)))
+        chats.append((len(chats) + 1, 'chat{:010d}'.format(i),
+                      rng.choice(['', 'Fellowship', 'Second breakfast', 'Council of Elrond']),
+                      members))
+
+    def message_rows():
+        date = START_DATE * 10 ** 9
+        for rowid in range(1, messages + 1):
+            # Messages are a few seconds to a few hours apart, with nanosecond precision
+            date += rng.randint(10 ** 9, 3600 * 10 ** 9)
+            chat_id, _, _, members = rng.choice(chats) if chats else (None, None, None, [None])
+            is_from_me = rng.random() < 0.4
+            # Messages you send to a group have no handle
+            handle_id = 0 if is_from_me and len(members) > 1 else rng.choice(members)
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))
+            yield rowid, handle_id, date, is_from_me, text, chat_id
+
+    # sms.db
+    sms_db_path = backup_file_path(backup_dir, ManifestDB.SMS_DB_DOMAIN_PATH)
+    os.makedirs(os.path.dirname(sms_db_path), exist_ok=True)
+    conn = sqlite3.connect(sms_db_path)
+    with conn:
+        cur = conn.cursor()
+        cur.execute('''CREATE TABLE message (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT,
+                         text TEXT, handle_id INTEGER, date INTEGER, is_from_me INTEGER,
+                         attributedBody BLOB, associated_message_type INTEGER)''')
+        cur.execute('''CREATE TABLE handle (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT,
+                         country TEXT, service TEXT, uncanonicalized_id TEXT)''')
+        cur.execute('''CREATE TABLE chat (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT,
+                         chat_identifier TEXT, service_name TEXT, display_name TEXT)''')
+        cur.execute("CREATE TABLE chat_handle_join (chat_id INTEGER, handle_id INTEGER)")
+        cur.execute('''CREATE TABLE chat_message_join (chat_id INTEGER, message_id INTEGER,
+                         message_date INTEGER, PRIMARY KEY (chat_id, message_id))''')
+        cur.execute('''CREATE TABLE attachment (ROWID INTEGER PRIMARY KEY AUTOINCREMENT,
+                         guid TEXT, filename TEXT, transfer_name TEXT, total_bytes INTEGER)''')
+        cur.execute('''CREATE TABLE message_attachment_join (message_id INTEGER,
+                         attachment_id INTEGER)''')
+        cur.executemany("INSERT INTO handle(ROWID, id, service) VALUES(?, ?, ?)",
+                        ((rowid, handle_id, rng.choice(SERVICES))
+                         for rowid, handle_id in enumerate(handle_ids, 1)))
+        cur.executemany("INSERT INTO chat(ROWID, chat_identifier, display_name) VALUES(?, ?, ?)",
+                        (chat[:3] for chat in chats))
+        cur.executemany("INSERT INTO chat_handle_join VALUES(?, ?)",
+                        ((chat[0], member) for chat in chats for member in chat[3]))
+        rows = message_rows()
+        while True:
+            chunk = list(itertools.islice(rows, INSERT_CHUNK_SIZE))
+            if not chunk:
+                break
+            cur.executemany('''INSERT INTO message(ROWID, handle_id, date, is_from_me, text)
+                               VALUES(?, ?, ?, ?, ?)''', (row[:5] for row in chunk))
+            cur.executemany("INSERT INTO chat_message_join VALUES(?, ?, ?)",
+                            ((row[5], row[0], row[2]) for row in chunk if row[5] is not None))
+        # The indexes iOS keeps on message (built after the inserts, which is quicker)
+        cur.execute("CREATE INDEX message_idx_handle ON message (handle_id, date)")
+        cur.execute("CREATE INDEX message_idx_date ON message (date)")
+    conn.close()
+
+    # AddressBook.sqlitedb
+    address_book_path = backup_file_path(backup_dir, ManifestDB.ADDRESS_BOOK_DOMAIN_PATH)
+    os.makedirs(os.path.dirname(address_book_path), exist_ok=True)
+    conn = sqlite3.connect(address_book_path)
+    with conn:
+        conn.execute("CREATE TABLE ABPerson (ROWID INTEGER PRIMARY KEY, First TEXT, Last TEXT)")
+        conn.execute('''CREATE TABLE ABMultiValue (UID INTEGER PRIMARY KEY, record_id INTEGER,
+                          property INTEGER, label INTEGER, value TEXT)''')
+        conn.executemany("INSERT INTO ABPerson VALUES(?, ?, ?)", people)
+        conn.executemany("INSERT INTO ABMultiValue(record_id, value) VALUES(?, ?)", values)
+    conn.close()
+
+    # Manifest.db
+    conn = sqlite3.connect(os.path.join(backup_dir, PhoneDB.MANIFEST_DB_FILENAME))
+    with conn:
+        conn.execute('''CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT,
+                          relativePath TEXT, flags INTEGER, file BLOB)''')
+        conn.executemany("INSERT INTO Files(fileID, domain, relativePath) VALUES(?, ?, ?)",
+                         ((file_id(*domain_path),) + domain_path
+                          for domain_path in [ManifestDB.SMS_DB_DOMAIN_PATH,
+                                              ManifestDB.ADDRESS_BOOK_DOMAIN_PATH]))
+    conn.close()
+
+    return {'contacts': contacts, 'handles': handles, 'messages': messages,
+            'chats': len(chats)}
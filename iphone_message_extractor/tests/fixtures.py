@@ -1,4 +1,8 @@
 import csv, os
+import hashlib
+import plistlib
+import sqlite3
+import struct
 
 from iphone_message_extractor.phone_db import PhoneDB, ManifestDB, AddressDB, MessageDB
 
@@ -6,13 +10,48 @@ from iphone_message_extractor.phone_db import PhoneDB, ManifestDB, AddressDB, Me
 #   Helper methods to create in-memory SQLite3 fixtures:
 #
 
-def create_db(klass, func):
+# attachment.ROWID, message_id, attachment.filename and the contents of the file (None for
+# attachments that aren't in the backup, e.g. because they were offloaded to iCloud)
+ATTACHMENTS = [(1, 1, '~/Library/SMS/Attachments/0a/10/AAA/mount_doom.jpg', b'volcano'),
+               (2, 6, '~/Library/SMS/Attachments/1b/11/BBB/ring.png', b'precious'),
+               (3, 7, '~/Library/SMS/Attachments/2c/12/CCC/ring copy.png', b'precious'),
+               (4, 7, '~/Library/SMS/Attachments/3d/13/DDD/offloaded.mov', None)]
+
+def attachment_file_id(filename):
+    ''' The fileID an attachment is stored under (a SHA1 of its domain and path, like iTunes) '''
+    return hashlib.sha1('MediaDomain-{}'.format(filename[2:]).encode('utf-8')).hexdigest()
+
+def encode_attributed_body(text, links=()):
+    ''' Archives text the way iOS stores message.attributedBody (an NSAttributedString in a
+    typedstream), with a link attribute per URL in links '''
+    def encode_int(value):
+        return bytes([value]) if value < 0x80 else b'\x81' + struct.pack('<h', value)
+
+    def encode_string(value):
+        data = value.encode('utf-8')
+        return encode_int(len(data)) + data
+
+    blob = b'\x04\x0bstreamtyped\x81\xe8\x03\x84\x01@\x84\x84\x84\x12NSAttributedString\x00' + \
+           b'\x84\x84\x08NSObject\x00\x85\x92\x84\x84\x84\x08NSString\x01\x94\x84\x01+' + \
+           encode_string(text) + b'\x86\x84\x02iI\x01' + encode_int(len(text)) + \
+           b'\x92\x84\x84\x84\x0cNSDictionary\x00\x94\x84\x01i' + bytes([1 + len(links)]) + \
+           b'\x92\x84\x96\x96' + encode_string('__kIMMessagePartAttributeName') + \
+           b'\x86\x92\x84\x84\x84\x08NSNumber\x00\x84\x84\x07NSValue\x00\x94\x84\x01*' + \
+           b'\x84\x9b\x9b\x00\x86'
+    for link in links:
+        blob += b'\x92\x84\x96\x96' + encode_string('__kIMLinkAttributeName') + \
+                b'\x86\x92\x84\x84\x84\x05NSURL\x00\x94\x84\x01c\x00\x92\x84\x96\x96' + \
+                encode_string(link) + b'\x86'
+    return blob + b'\x86\x86'
+
+def create_db(klass, func, db_file=':memory:'):
     '''' Wrapper method that takes and creates the right type of PhoneDB and runs SQL on it
     @param klass: the class that should be instantiated with the methods needed
     @param func: a function to execute the SQL
+    @param db_file: where to create the DB (default=in memory)
     @returns: the db connection
     '''
-    db = klass(':memory:')
+    db = klass(db_file)
     conn = db.connect()
     with conn:
         cursor = conn.cursor()
@@ -21,7 +60,7 @@ def create_db(klass, func):
     
     return db
 
-def create_manifest_db():
+def create_manifest_db(db_file=':memory:'):
     # Create in-memory ManifestDB
     def manifest_sql(cur):
         # Create Files table
@@ -34,11 +73,14 @@ def create_manifest_db():
                               'HomeDomain', 'Library/AddressBook/AddressBook.sqlitedb')
               '''
         cur.execute(sql)
+        cur.executemany("INSERT INTO Files(fileID, domain, relativePath) VALUES(?, 'MediaDomain', ?)",
+                        [(attachment_file_id(filename), filename[2:])
+                         for _, _, filename, contents in ATTACHMENTS if contents is not None])
     
-    return create_db(ManifestDB, manifest_sql)
+    return create_db(ManifestDB, manifest_sql, db_file)
     
     
-def create_address_book_db():
+def create_address_book_db(db_file=':memory:'):
     # Create in-memory AddressDB
     def address_sql(cur):
         # Create ABPerson table
@@ -81,10 +123,10 @@ def create_address_book_db():
                                             (4, '415 555 1212'),  (5, 'mithrandir@gondor.net')'''
         cur.execute(populate_people_sql)
     
-    return create_db(AddressDB, address_sql)
+    return create_db(AddressDB, address_sql, db_file)
     
     
-def create_message_db():
+def create_message_db(db_file=':memory:'):
     # Create in-memory MessageDB
     def message_sql(cur):
         
@@ -149,10 +191,146 @@ def create_message_db():
             cur.execute(''' INSERT INTO message(handle_id, date, is_from_me, text)
                             VALUES(?, ?, ?, ?)
                         ''', message)
+        # Newer iOS versions only store the body of some messages in attributedBody
+        cur.execute("UPDATE message SET text = NULL, attributedBody = ? WHERE ROWID = 7",
+                    (encode_attributed_body(messages[6][3]),))
+
+        cur.execute(''' CREATE TABLE attachment (
+                          ROWID	INTEGER PRIMARY KEY AUTOINCREMENT, guid	TEXT, created_date	INTEGER,
+                          start_date	INTEGER, filename	TEXT, uti	TEXT, mime_type	TEXT,
+                          transfer_state	INTEGER, is_outgoing	INTEGER, user_info	BLOB,
+                          transfer_name	TEXT, total_bytes	INTEGER) ''')
+        cur.execute(''' CREATE TABLE message_attachment_join (
+                          message_id	INTEGER, attachment_id	INTEGER) ''')
+        # A 1:1 chat with Sam and a group chat with Sam and Gandalf
+        cur.execute(''' CREATE TABLE chat (
+                          ROWID	INTEGER PRIMARY KEY AUTOINCREMENT, guid	TEXT, style	INTEGER,
+                          state	INTEGER, account_id	TEXT, properties	BLOB,
+                          chat_identifier	TEXT, service_name	TEXT, room_name	TEXT,
+                          account_login	TEXT, is_archived	INTEGER, last_addressed_handle	TEXT,
+                          display_name	TEXT, group_id	TEXT, is_filtered	INTEGER,
+                          successful_query	INTEGER) ''')
+        cur.execute(''' CREATE TABLE chat_handle_join (chat_id	INTEGER, handle_id	INTEGER) ''')
+        cur.execute(''' CREATE TABLE chat_message_join (
+                          chat_id	INTEGER, message_id	INTEGER, message_date	INTEGER,
+                          PRIMARY KEY (chat_id, message_id)) ''')
+        cur.execute(''' INSERT INTO chat(ROWID, chat_identifier, display_name)
+                        VALUES(1, '+12125551212', ''), (2, 'chat1234567890', 'Fellowship') ''')
+        cur.execute("INSERT INTO chat_handle_join VALUES(1, 3), (2, 3), (2, 6)")
+        cur.executemany("INSERT INTO chat_message_join(chat_id, message_id) VALUES(?, ?)",
+                        [(1, message_id) for message_id in range(1, 6)] + [(2, 6), (2, 7)])
+
+        for attachment_id, message_id, filename, _ in ATTACHMENTS:
+            cur.execute("INSERT INTO attachment(ROWID, filename, transfer_name) VALUES(?, ?, ?)",
+                        (attachment_id, filename, os.path.basename(filename)))
+            cur.execute("INSERT INTO message_attachment_join VALUES(?, ?)",
+                        (message_id, attachment_id))
         
     
-    return create_db(MessageDB, message_sql)
+    return create_db(MessageDB, message_sql, db_file)
     
+SMS_DB_FILE_ID = '469af719d01883a826c1bb5e834aafde3e8d5c33'
+ADDRESS_BOOK_FILE_ID = 'c18c568fb88c22ab4a6b464aba8474edd2586ad4'
+
+def create_backup(backup_dir, is_encrypted=False):
+    ''' Creates an on-disk (unencrypted) backup at backup_dir laid out the way iTunes does it:
+    Manifest.plist and Manifest.db at the top and files stored under their hashed paths
+    @param backup_dir: the device hash directory to create
+    @param is_encrypted: the IsEncrypted value to write to Manifest.plist
+    '''
+    os.makedirs(backup_dir)
+    with open(os.path.join(backup_dir, 'Manifest.plist'), 'wb') as fp:
+        plistlib.dump({'IsEncrypted': is_encrypted}, fp)
+
+    for file_id, create_func in [(None, create_manifest_db),
+                                 (SMS_DB_FILE_ID, create_message_db),
+                                 (ADDRESS_BOOK_FILE_ID, create_address_book_db)]:
+        if file_id is None:
+            db_file = os.path.join(backup_dir, PhoneDB.MANIFEST_DB_FILENAME)
+        else:
+            os.makedirs(os.path.join(backup_dir, file_id[:2]), exist_ok=True)
+            db_file = os.path.join(backup_dir, file_id[:2], file_id)
+        create_func(db_file).close()
+
+    for _, _, filename, contents in ATTACHMENTS:
+        if contents is not None:
+            file_id = attachment_file_id(filename)
+            os.makedirs(os.path.join(backup_dir, file_id[:2]), exist_ok=True)
+            with open(os.path.join(backup_dir, file_id[:2], file_id), 'wb') as fp:
+                fp.write(contents)
+
+BACKUP_PASSWORD = 'speak friend and enter'
+
+def create_encrypted_backup(backup_dir, password=BACKUP_PASSWORD):
+    ''' Creates the same backup as create_backup, but encrypted with password the way iOS 10.2+
+    does it (see encryption.py), with cheap key derivation so the tests stay quick
+    '''
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.keywrap import aes_key_wrap
+
+    def encrypt(data, key):
+        padder = padding.PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(key), modes.CBC(b'\0' * 16)).encryptor()
+        return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+    def record(tag, value):
+        if isinstance(value, int):
+            value = struct.pack('>I', value)
+        return tag.encode('ascii') + struct.pack('>I', len(value)) + value
+
+    def wrapped_file_key(protection_class, key):
+        return struct.pack('<I', protection_class) + aes_key_wrap(class_keys[protection_class], key)
+
+    create_backup(backup_dir, is_encrypted=True)
+
+    salt, dpsl = os.urandom(20), os.urandom(20)
+    passcode = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), dpsl, 10, 32)
+    passcode_key = hashlib.pbkdf2_hmac('sha1', passcode, salt, 10, 32)
+    class_keys = dict((protection_class, os.urandom(32)) for protection_class in range(1, 5))
+    keybag = b''.join([record('VERS', 3), record('TYPE', 1), record('UUID', os.urandom(16)),
+                       record('WRAP', 1), record('SALT', salt), record('ITER', 10),
+                       record('DPWT', 1), record('DPIC', 10), record('DPSL', dpsl)])
+    for protection_class, class_key in class_keys.items():
+        keybag += b''.join([record('UUID', os.urandom(16)), record('CLAS', protection_class),
+                            record('WRAP', 3), record('KTYP', 0),
+                            record('WPKY', aes_key_wrap(passcode_key, class_key))])
+
+    # Encrypt every file in place, recording its key in Manifest.db
+    manifest_db_path = os.path.join(backup_dir, PhoneDB.MANIFEST_DB_FILENAME)
+    conn = sqlite3.connect(manifest_db_path)
+    with conn:
+        conn.execute("ALTER TABLE Files ADD COLUMN file BLOB")
+        for file_id, in conn.execute("SELECT fileID FROM Files").fetchall():
+            path = os.path.join(backup_dir, file_id[:2], file_id)
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            key = os.urandom(32)
+            with open(path, 'wb') as fp:
+                fp.write(encrypt(data, key))
+            archive = {'$archiver': 'NSKeyedArchiver', '$version': 100000,
+                       '$top': {'root': plistlib.UID(1)},
+                       '$objects': ['$null',
+                                    {'$class': plistlib.UID(3), 'ProtectionClass': 3,
+                                     'EncryptionKey': plistlib.UID(2), 'Size': len(data)},
+                                    {'$class': plistlib.UID(4),
+                                     'NS.data': wrapped_file_key(3, key)},
+                                    {'$classname': 'MBFile', '$classes': ['MBFile', 'NSObject']},
+                                    {'$classname': 'NSMutableData',
+                                     '$classes': ['NSMutableData', 'NSData', 'NSObject']}]}
+            conn.execute("UPDATE Files SET file = ? WHERE fileID = ?",
+                         (plistlib.dumps(archive, fmt=plistlib.FMT_BINARY), file_id))
+    conn.close()
+
+    manifest_key = os.urandom(32)
+    with open(manifest_db_path, 'rb') as fp:
+        data = fp.read()
+    with open(manifest_db_path, 'wb') as fp:
+        fp.write(encrypt(data, manifest_key))
+    with open(os.path.join(backup_dir, 'Manifest.plist'), 'wb') as fp:
+        plistlib.dump({'IsEncrypted': True, 'BackupKeyBag': keybag,
+                       'ManifestKey': wrapped_file_key(4, manifest_key)}, fp)
+
 def read_expected_output():
     ''' Reads the expected output and returns as an array of arrays '''
     rows = []
@@ -166,4 +344,9 @@ def read_expected_output():
                 saw_header = True
             else:
                 rows.append(row)
-    return rows
\ No newline at end of file
+    return rows
+
+def read_csv_output(path):
+    ''' Reads a CSV written by the extractor (skipping the header) as an array of arrays '''
+    with open(path, encoding='utf-8-sig', newline='') as csv_file:
+        return list(csv.reader(csv_file))[1:]
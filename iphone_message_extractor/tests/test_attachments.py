@@ -0,0 +1,91 @@
+import os
+import tempfile
+from unittest import TestCase, main
+
+from iphone_message_extractor import attachments, instrumentation
+from iphone_message_extractor.message_extractor import extract_messages
+from . import fixtures
+
+class TestAttachments(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        self.output_path = os.path.join(self.tmp_dir.name, 'messages.csv')
+        self.attachments_dir = os.path.join(self.tmp_dir.name, 'attachments')
+        fixtures.create_backup(self.backup_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_attachment_domain_path(self):
+        self.assertEqual(attachments.attachment_domain_path('~/Library/SMS/Attachments/a/IMG.jpg'),
+                         ('MediaDomain', 'Library/SMS/Attachments/a/IMG.jpg'))
+        self.assertEqual(attachments.attachment_domain_path(
+                            '/var/mobile/Library/SMS/Attachments/a/IMG.jpg'),
+                         ('MediaDomain', 'Library/SMS/Attachments/a/IMG.jpg'))
+        self.assertIsNone(attachments.attachment_domain_path('/tmp/IMG.jpg'))
+
+    def test_copy_file(self):
+        src = os.path.join(self.tmp_dir.name, 'src')
+        dst = os.path.join(self.tmp_dir.name, 'dst')
+        with open(src, 'wb') as fp:
+            fp.write(os.urandom(3 * attachments.HASH_CHUNK_SIZE + 7))
+        digest = attachments.copy_file(src, dst)
+        self.assertEqual(attachments.hash_file(src), attachments.hash_file(dst))
+        self.assertEqual(digest, attachments.hash_file(src))
+
+    def __exported_files(self):
+        return sorted(name for _, _, names in os.walk(self.attachments_dir) for name in names
+                      if name != attachments.INDEX_FILENAME)
+
+    def test_extract_messages_with_attachments(self):
+        for engine in ('python', 'sql'):
+            extract_messages(self.backup_dir, self.output_path, 'US', engine=engine,
+                             attachments_dir=self.attachments_dir, attachment_workers=4)
+            rows = fixtures.read_csv_output(self.output_path)
+            expected_output = fixtures.read_expected_output()
+            self.assertEqual([row[:-1] for row in rows], expected_output)
+
+            # The two copies of the ring are stored once, and the offloaded video is skipped
+            paths = [row[-1] for row in rows]
+            self.assertEqual(paths[1:5], [''] * 4)
+            self.assertEqual(len(self.__exported_files()), 2)
+            with open(paths[0], 'rb') as fp:
+                self.assertEqual(fp.read(), b'volcano')
+            self.assertEqual(paths[5], paths[6])
+            self.assertTrue(paths[5].endswith('.png'))
+
+    def test_file_missing_from_backup(self):
+        ''' A file that Manifest.db lists but the backup doesn't have is skipped, not fatal '''
+        file_id = fixtures.attachment_file_id(fixtures.ATTACHMENTS[0][2])
+        missing_path = os.path.join(self.backup_dir, file_id[:2], file_id)
+        os.remove(missing_path)
+        exporter = attachments.AttachmentExporter(self.attachments_dir)
+        self.assertEqual(exporter.export([(missing_path, 'mount_doom.jpg')]), {})
+        self.assertEqual(exporter.stats['missing'], 1)
+
+        profiler = instrumentation.Profiler()
+        extract_messages(self.backup_dir, self.output_path, 'US',
+                         attachments_dir=self.attachments_dir, profiler=profiler)
+        rows = fixtures.read_csv_output(self.output_path)
+        self.assertEqual(rows[0][-1], '')
+        self.assertEqual(len(self.__exported_files()), 1)
+        # Counted once each: the deleted file and the video that was offloaded to iCloud
+        self.assertEqual(profiler.counters['attachments_missing'], 2)
+        self.assertEqual(profiler.counters['attachments_copied'], 1)
+
+    def test_rerun_skips_exported_files(self):
+        extract_messages(self.backup_dir, self.output_path, 'US',
+                         attachments_dir=self.attachments_dir)
+        exporter = attachments.AttachmentExporter(self.attachments_dir)
+        self.assertEqual(len(exporter.index), 3)
+
+        sources = [(os.path.join(self.backup_dir, file_id[:2], file_id), 'x.jpg')
+                   for file_id in exporter.index]
+        exporter.export(sources)
+        self.assertEqual(exporter.stats['previously_exported'], 3)
+        self.assertEqual(exporter.stats['copied'], 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+from unittest import TestCase, main
+
+from iphone_message_extractor import attributed_body
+from . import fixtures
+
+class TestAttributedBody(TestCase):
+    '''
+    Tests for decoding message.attributedBody (see fixtures.encode_attributed_body)
+    '''
+
+    def test_decode_attributed_body(self):
+        for text in ['Hi', 'Mordor! ' * 20, 'Émoji 🧙‍♂️ and ünïcödé', '']:
+            self.assertEqual(attributed_body.decode_attributed_body(
+                fixtures.encode_attributed_body(text)), text)
+
+    def test_decode_invalid_attributed_body(self):
+        blob = fixtures.encode_attributed_body('Speak, friend, and enter')
+        for invalid in [None, b'', b'bplist00', blob[:20], blob[:blob.index(b'+') + 5]]:
+            self.assertIsNone(attributed_body.decode_attributed_body(invalid))
+
+    def test_links_and_attributes(self):
+        blob = fixtures.encode_attributed_body('See https://example.com and tel:+12125551212',
+                                               ['https://example.com', 'tel:+12125551212'])
+        self.assertEqual(attributed_body.attributed_body_links(blob),
+                         ['https://example.com', 'tel:+12125551212'])
+        self.assertEqual(attributed_body.attributed_body_attributes(blob),
+                         ['__kIMLinkAttributeName', '__kIMMessagePartAttributeName'])
+        self.assertEqual(attributed_body.attributed_body_links(
+            fixtures.encode_attributed_body('No links')), [])
+
+    def test_decode_text_column(self):
+        rows = [('a', 'Hi'), ('b', fixtures.encode_attributed_body('Hello')), ('c', None)]
+        self.assertEqual(attributed_body.decode_text_column(rows, 1),
+                         [('a', 'Hi'), ('b', 'Hello'), ('c', None)])
+        # Batches that don't need decoding are passed through as they are
+        rows = rows[:1]
+        self.assertIs(attributed_body.decode_text_column(rows, 1), rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os
+import plistlib
+import tempfile
+from datetime import datetime
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from iphone_message_extractor import backup_index
+from . import fixtures
+
+class TestBackupIndex(TestCase):
+    '''
+    Tests for finding backups under a backup root and caching what's known about them (see
+    backup_index.py)
+    '''
+
+    FRODO_HASH = '1111111111111111111111111111111111111111'
+    SAM_HASH = '2222222222222222222222222222222222222222'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, 'Backup')
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        fixtures.create_backup(os.path.join(self.backup_dir, TestBackupIndex.FRODO_HASH))
+        self.__write_info(TestBackupIndex.FRODO_HASH, "Frodo's iPhone", datetime(2019, 1, 2, 3, 4, 5))
+        # No Info.plist: the name and version come from Manifest.plist instead
+        os.makedirs(os.path.join(self.backup_dir, TestBackupIndex.SAM_HASH))
+        with open(os.path.join(self.backup_dir, TestBackupIndex.SAM_HASH, 'Manifest.plist'),
+                  'wb') as fp:
+            plistlib.dump({'IsEncrypted': True, 'Date': datetime(2018, 5, 6),
+                           'Lockdown': {'DeviceName': "Sam's iPhone", 'ProductVersion': '12.3'}},
+                          fp)
+        os.makedirs(os.path.join(self.backup_dir, 'not-a-backup'))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def __write_info(self, device_hash, device_name, last_backup_date):
+        backup_path = os.path.join(self.backup_dir, device_hash)
+        with open(os.path.join(backup_path, 'Info.plist'), 'wb') as fp:
+            plistlib.dump({'Device Name': device_name, 'Product Type': 'iPhone10,3',
+                           'Product Version': '12.1.2', 'Last Backup Date': last_backup_date},
+                          fp)
+        # Make sure the directory looks changed, however coarse the filesystem's mtimes are
+        mtime = os.stat(backup_path).st_mtime_ns + 10 ** 9
+        os.utime(backup_path, ns=(mtime, mtime))
+
+    def test_discover_backups(self):
+        backups = backup_index.discover_backups(self.backup_dir)
+        self.assertEqual(backups, [
+            backup_index.BackupInfo(TestBackupIndex.FRODO_HASH, "Frodo's iPhone", 'iPhone10,3',
+                                    '12.1.2', '2019-01-02T03:04:05', False),
+            backup_index.BackupInfo(TestBackupIndex.SAM_HASH, "Sam's iPhone", None, '12.3',
+                                    '2018-05-06T00:00:00', True)])
+
+        self.assertEqual(backup_index.find_backups_by_device_name(backups, "FRODO'S IPHONE"),
+                         backups[:1])
+        self.assertEqual(backup_index.find_backups_by_device_name(backups, 'Frodo'), [])
+        listing = backup_index.format_backup_list(backups).splitlines()
+        self.assertIn(TestBackupIndex.FRODO_HASH, listing[1])
+        self.assertIn('2019-01-02 03:04:05', listing[1])
+        self.assertEqual(listing[-1], '2 backups')
+
+    def test_unchanged_backups_are_not_reread(self):
+        backups = backup_index.discover_backups(self.backup_dir, self.cache_dir)
+        with patch.object(backup_index, 'read_backup_info',
+                          wraps=backup_index.read_backup_info) as read_backup_info:
+            self.assertEqual(backup_index.discover_backups(self.backup_dir, self.cache_dir),
+                             backups)
+            self.assertEqual(read_backup_info.call_count, 0)
+
+            # Only the backup that changed is read again
+            self.__write_info(TestBackupIndex.FRODO_HASH, "Frodo's iPhone",
+                              datetime(2019, 2, 3))
+            backups = backup_index.discover_backups(self.backup_dir, self.cache_dir)
+            self.assertEqual(read_backup_info.call_count, 1)
+            self.assertEqual(backups[0].last_backup_date, '2019-02-03T00:00:00')
+
+            # Backups that have gone are dropped from the index
+            os.rename(os.path.join(self.backup_dir, TestBackupIndex.SAM_HASH),
+                      os.path.join(self.tmp_dir.name, TestBackupIndex.SAM_HASH))
+            self.assertEqual(backup_index.discover_backups(self.backup_dir, self.cache_dir),
+                             backups[:1])
+            self.assertEqual(read_backup_info.call_count, 1)
+
+if __name__ == '__main__':
+    main()
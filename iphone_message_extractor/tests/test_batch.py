@@ -0,0 +1,57 @@
+import json, os
+import tempfile
+from unittest import TestCase, main
+
+from iphone_message_extractor import batch
+from . import fixtures
+
+class TestBatch(TestCase):
+    '''
+    End-to-end tests for extracting several on-disk backups at once
+    '''
+
+    GOOD_HASHES = ['1111111111111111111111111111111111111111',
+                   '2222222222222222222222222222222222222222']
+    BAD_HASH = '3333333333333333333333333333333333333333'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, 'Backup')
+        self.output_dir = os.path.join(self.tmp_dir.name, 'out')
+        for device_hash in TestBatch.GOOD_HASHES:
+            fixtures.create_backup(os.path.join(self.backup_dir, device_hash))
+        # An encrypted backup fails, but shouldn't take the rest of the batch down with it
+        fixtures.create_backup(os.path.join(self.backup_dir, TestBatch.BAD_HASH),
+                               is_encrypted=True)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_find_device_hashes(self):
+        os.makedirs(os.path.join(self.backup_dir, 'not-a-backup'))
+        self.assertEqual(batch.find_device_hashes(self.backup_dir),
+                         TestBatch.GOOD_HASHES + [TestBatch.BAD_HASH])
+
+    def test_extract_messages_batch(self):
+        device_hashes = batch.find_device_hashes(self.backup_dir)
+        results = batch.extract_messages_batch(self.backup_dir, device_hashes, self.output_dir,
+                                               'US', workers=2)
+
+        self.assertEqual([r.device_hash for r in results], device_hashes)
+        expected_output = fixtures.read_expected_output()
+        for result in results[:2]:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.row_count, len(expected_output))
+            self.assertEqual(fixtures.read_csv_output(result.output_path), expected_output)
+
+        self.assertIsNone(results[2].row_count)
+        self.assertTrue(results[2].error.startswith('ValueError'))
+        self.assertIn('2 succeeded, 1 failed', batch.format_batch_summary(results))
+
+        summary_path = os.path.join(self.output_dir, 'summary.json')
+        batch.write_batch_summary(summary_path, results)
+        with open(summary_path) as fp:
+            self.assertEqual(len(json.load(fp)), 3)
+
+if __name__ == '__main__':
+    main()
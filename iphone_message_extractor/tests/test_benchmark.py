@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase, main
+
+from iphone_message_extractor import benchmark, synthetic
+from iphone_message_extractor.message_extractor import extract_messages
+from iphone_message_extractor.phone_db import ManifestDB
+from . import fixtures
+
+class TestBenchmark(TestCase):
+    '''
+    Tests for the synthetic backup generator and the benchmark harness
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, 'backup')
+        self.counts = synthetic.create_synthetic_backup(self.backup_dir, contacts=50, handles=40,
+                                                        messages=500, group_chats=5)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_synthetic_backup(self):
+        self.assertEqual(self.counts, {'contacts': 50, 'handles': 40, 'messages': 500,
+                                       'chats': 45})
+        conn = sqlite3.connect(synthetic.backup_file_path(self.backup_dir,
+                                                          ManifestDB.SMS_DB_DOMAIN_PATH))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM message").fetchone()[0], 500)
+        self.assertEqual(conn.execute("SELECT COUNT(DISTINCT id) FROM handle").fetchone()[0], 40)
+        conn.close()
+
+        output_path = os.path.join(self.tmp_dir.name, 'messages.csv')
+        self.assertEqual(extract_messages(self.backup_dir, output_path, 'US', chats=True), 500)
+        rows = fixtures.read_csv_output(output_path)
+        # Most handles are people in the address book
+        self.assertGreater(sum(1 for row in rows if row[1]), len(rows) // 2)
+
+    def test_synthetic_backup_is_reproducible(self):
+        other_dir = os.path.join(self.tmp_dir.name, 'other')
+        synthetic.create_synthetic_backup(other_dir, contacts=50, handles=40, messages=500,
+                                          group_chats=5)
+        outputs = []
+        for backup_dir in (self.backup_dir, other_dir):
+            outputs.append(os.path.join(backup_dir, 'messages.csv'))
+            extract_messages(backup_dir, outputs[-1], 'US')
+        self.assertEqual(fixtures.read_csv_output(outputs[0]), fixtures.read_csv_output(outputs[1]))
+
+    def test_run_benchmark(self):
+        results = benchmark.run_benchmark(self.backup_dir, self.tmp_dir.name, trace_memory=True,
+                                          engine='sql')
+        self.assertEqual(list(results['stages']), benchmark.STAGES)
+        for stage in results['stages'].values():
+            self.assertGreaterEqual(stage['seconds'], 0)
+            self.assertIn('peak_memory_bytes', stage)
+        self.assertEqual(results['options'], {'engine': 'sql'})
+
+        results_path = os.path.join(self.tmp_dir.name, 'results.json')
+        benchmark.save_results(results_path, results)
+        baseline = benchmark.load_results(results_path)
+        baseline['stages']['map']['seconds'] /= 2
+        summary = benchmark.format_results(results, baseline)
+        self.assertIn('SLOWER', [line for line in summary.splitlines()
+                                 if line.startswith('map')][0])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import gzip
+import hashlib
+import lzma
+import os
+import tempfile
+from unittest import TestCase, main, skipIf
+
+from iphone_message_extractor import compressed_output
+from iphone_message_extractor.message_extractor import write_messages_to_csv
+
+class TestCompressedOutput(TestCase):
+    '''
+    Tests for compressing output on a background thread (see compressed_output.py)
+    '''
+
+    ROWS = [['Baggins', 'Frodo', '+1 646-400-1212', '2011-12-19 07:00:10', 'Yes',
+             'Mordor! 🌋', 'iMessage']] * 5000
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def __path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_compressed_file(self):
+        for compression, decompress in [('gzip', gzip.decompress), ('xz', lzma.decompress),
+                                        (None, bytes)]:
+            path = self.__path('out.{}'.format(compression))
+            text_file, raw_file = compressed_output.open_text(path, compression)
+            for i in range(20000):
+                text_file.write('line {}\n'.format(i))
+            text_file.close()
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            expected = ''.join('line {}\n'.format(i) for i in range(20000))
+            self.assertEqual(decompress(data).decode('utf-8-sig'), expected)
+            self.assertEqual(raw_file.size, len(data))
+            self.assertEqual(raw_file.sha256.hexdigest(), hashlib.sha256(data).hexdigest())
+            self.assertEqual(raw_file.bytes_in, len(expected.encode('utf-8-sig')))
+
+    def test_append(self):
+        path = self.__path('out.csv.gz')
+        write_messages_to_csv(path, TestCompressedOutput.ROWS[:10], ['a'] * 7, compression='gzip')
+        write_messages_to_csv(path, TestCompressedOutput.ROWS[10:], ['a'] * 7, append=True,
+                              compression='gzip')
+        with gzip.open(path, 'rt', encoding='utf-8-sig', newline='') as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(len(lines), len(TestCompressedOutput.ROWS) + 1)
+        # No BOM in the middle of the file
+        self.assertNotIn('\ufeff', ''.join(lines))
+
+    def test_file_sha256(self):
+        path = self.__path('data')
+        with open(path, 'wb') as fp:
+            fp.write(b'x' * 3000000)
+        self.assertEqual(compressed_output.file_sha256(path).hexdigest(),
+                         hashlib.sha256(b'x' * 3000000).hexdigest())
+
+    def test_compression_errors(self):
+        with self.assertRaises(ValueError):
+            compressed_output.new_compressor('rar')
+        # Errors on the compression thread come back out of the export
+        raw_file = compressed_output.CompressedFile(self.__path('out.gz'), 'gzip')
+        raw_file.fp.close()
+        with self.assertRaises(ValueError):
+            raw_file.write(b'x' * 10)
+            raw_file.close()
+
+    @skipIf(compressed_output.zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        path = self.__path('out.csv.zst')
+        write_messages_to_csv(path, TestCompressedOutput.ROWS, compression='zstd')
+        with open(path, 'rb') as fp:
+            data = compressed_output.zstandard.ZstdDecompressor().decompressobj().decompress(
+                fp.read())
+        self.assertEqual(len(data.decode('utf-8-sig').splitlines()),
+                         len(TestCompressedOutput.ROWS))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+from unittest import TestCase, main
+
+from iphone_message_extractor.contact_store import ContactStore
+
+class TestContactStore(TestCase):
+    '''
+    Tests for the compact store of contact names (see contact_store.py)
+    '''
+
+    def test_reads_like_a_dict(self):
+        contacts = ContactStore()
+        contacts.add('frodo@shire.net', 'Frodo', 'Baggins', 1)
+        contacts.add('+1 646-400-1212', 'Frodo', 'Baggins', 1)
+        contacts.add('+1 415-555-1212', 'Bilbo', None, 2)
+        self.assertEqual(dict(contacts), {'frodo@shire.net': ('Frodo', 'Baggins'),
+                                          '+1 646-400-1212': ('Frodo', 'Baggins'),
+                                          '+1 415-555-1212': ('Bilbo', None)})
+        self.assertEqual(len(contacts), 3)
+        self.assertIn('+1 415-555-1212', contacts)
+        self.assertNotIn('+1 212-555-1212', contacts)
+        self.assertIsNone(contacts.get('+1 212-555-1212'))
+        with self.assertRaises(KeyError):
+            contacts['+1 212-555-1212']
+
+    def test_names_are_shared(self):
+        contacts = ContactStore.from_mapping({'a@shire.net': ('Frodo', 'Baggins'),
+                                              'b@shire.net': ('Frodo', 'Baggins'),
+                                              'c@shire.net': ('Bilbo', 'Baggins')})
+        self.assertEqual(len(contacts.names), 2)
+        self.assertIs(contacts['a@shire.net'], contacts['b@shire.net'])
+        self.assertIs(contacts['a@shire.net'][1], contacts['c@shire.net'][1])
+        self.assertIs(ContactStore.from_mapping(contacts), contacts)
+
+    def test_handle_columns(self):
+        contacts = ContactStore.from_mapping({'+1 212-555-1212': ('Samwise', 'Gamgee')})
+        self.assertEqual(contacts.handle_columns({'212 555 1212': '+1 212-555-1212',
+                                                  'mailto:a@b.net': 'a@b.net'}),
+                         {'212 555 1212': ('Gamgee', 'Samwise', '+1 212-555-1212'),
+                          'mailto:a@b.net': ('', '', 'a@b.net')})
+
+    def test_find_keys(self):
+        contacts = ContactStore()
+        contacts.add('frodo@shire.net', 'Frodo', 'Baggins', 1)
+        contacts.add('+1 646-400-1212', 'Frodo', 'Baggins', 1)
+        contacts.add('+1 415-555-1212', 'Bilbo', None, 2)
+        self.assertEqual(contacts.contact_keys('frodo@shire.net'),
+                         {'frodo@shire.net', '+1 646-400-1212'})
+        self.assertEqual(contacts.contact_keys('sauron@mordor.net'), {'sauron@mordor.net'})
+        self.assertEqual(contacts.find_keys('frodo baggins'), contacts.find_keys('Baggins Fro'))
+        self.assertEqual(contacts.find_keys('BAGGINS'), {'frodo@shire.net', '+1 646-400-1212'})
+        self.assertEqual(contacts.find_keys('bilbo'), {'+1 415-555-1212'})
+        self.assertEqual(contacts.find_keys('Bilbo Baggins'), set())
+
+if __name__ == '__main__':
+    main()
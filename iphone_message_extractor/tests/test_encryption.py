@@ -0,0 +1,84 @@
+import hashlib
+import os
+import tempfile
+from unittest import TestCase, main, mock, skipIf
+
+from iphone_message_extractor import encryption
+from iphone_message_extractor.message_extractor import extract_messages
+from . import fixtures
+
+@skipIf(encryption.Cipher is None, 'cryptography is not installed')
+class TestEncryption(TestCase):
+    '''
+    Tests for extracting encrypted backups (see fixtures.create_encrypted_backup)
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        self.output_path = os.path.join(self.tmp_dir.name, 'messages.csv')
+        fixtures.create_encrypted_backup(self.backup_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_extract_encrypted_backup(self):
+        for engine in ('python', 'sql'):
+            self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                              engine=engine, password=fixtures.BACKUP_PASSWORD),
+                             7)
+            self.assertEqual(fixtures.read_csv_output(self.output_path),
+                             fixtures.read_expected_output())
+
+    def test_extract_encrypted_attachments(self):
+        attachments_dir = os.path.join(self.tmp_dir.name, 'attachments')
+        extract_messages(self.backup_dir, self.output_path, 'US', attachments_dir=attachments_dir,
+                         password=fixtures.BACKUP_PASSWORD)
+        paths = [row[7] for row in fixtures.read_csv_output(self.output_path) if row[7]]
+        self.assertEqual(len(paths), 3)
+        with open(paths[0], 'rb') as fp:
+            self.assertEqual(fp.read(), b'volcano')
+
+    def test_missing_or_wrong_password(self):
+        with self.assertRaises(ValueError):
+            extract_messages(self.backup_dir, self.output_path, 'US')
+        with self.assertRaises(ValueError):
+            extract_messages(self.backup_dir, self.output_path, 'US', password='mellon')
+
+    def test_only_needed_files_are_decrypted(self):
+        with encryption.EncryptedBackup(self.backup_dir, fixtures.BACKUP_PASSWORD) as backup:
+            sms_db_path = os.path.join(self.backup_dir, fixtures.SMS_DB_FILE_ID[:2],
+                                       fixtures.SMS_DB_FILE_ID)
+            decrypted = backup.decrypt_files([sms_db_path, sms_db_path])
+            self.assertEqual(list(decrypted), [sms_db_path])
+            self.assertEqual(sorted(os.listdir(backup.tmp_dir)),
+                             sorted(['Manifest.db', fixtures.SMS_DB_FILE_ID]))
+            self.assertEqual(os.path.getsize(decrypted[sms_db_path]) % 512, 0)
+        self.assertFalse(os.path.exists(backup.tmp_dir))
+
+    def test_failed_open_removes_temp_dir(self):
+        ''' The temp dir doesn't outlive a backup that couldn't be opened '''
+        tmp_dirs = []
+        real_mkdtemp = tempfile.mkdtemp
+        def mkdtemp(**kwargs):
+            tmp_dirs.append(real_mkdtemp(**kwargs))
+            return tmp_dirs[-1]
+        with mock.patch.object(encryption.tempfile, 'mkdtemp', side_effect=mkdtemp), \
+             mock.patch.object(encryption, 'decrypt_file', side_effect=OSError('Disk full')):
+            with self.assertRaises(OSError):
+                encryption.EncryptedBackup(self.backup_dir, fixtures.BACKUP_PASSWORD)
+        self.assertEqual(len(tmp_dirs), 1)
+        self.assertFalse(os.path.exists(tmp_dirs[0]))
+
+    def test_class_keys_are_cached(self):
+        encryption._class_key_cache.clear()
+        with mock.patch.object(encryption.hashlib, 'pbkdf2_hmac',
+                               wraps=hashlib.pbkdf2_hmac) as pbkdf2_hmac:
+            for _ in range(2):
+                extract_messages(self.backup_dir, self.output_path, 'US',
+                                 password=fixtures.BACKUP_PASSWORD)
+        # Once with SHA256 and once with SHA1, for the first extract only
+        self.assertEqual(pbkdf2_hmac.call_count, 2)
+
+if __name__ == '__main__':
+    main()
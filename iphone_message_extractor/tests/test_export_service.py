@@ -0,0 +1,175 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, main
+
+from iphone_message_extractor import split_output
+from iphone_message_extractor.export_service import ExportService
+from iphone_message_extractor.message_extractor import extract_messages
+from iphone_message_extractor.progress import ProgressReporter, ExportCancelled
+from . import fixtures
+
+class CountingExecutor(ThreadPoolExecutor):
+    ''' Keeps track of the most exports that ran at the same time '''
+
+    def __init__(self):
+        super().__init__(max_workers=8)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def submit(self, fn, *args, **kwargs):
+        def counted():
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.running -= 1
+        return super().submit(counted)
+
+class TestExportService(TestCase):
+    '''
+    Tests for running exports from asyncio code with progress and cancellation (see
+    export_service.py and progress.py)
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        fixtures.create_backup(self.backup_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def __output_path(self, name='messages.csv'):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_progress_events(self):
+        async def export():
+            job = ExportService().start(self.backup_dir, self.__output_path(), 'US',
+                                        batch_size=2)
+            return [event async for event in job], await job.result()
+        events, row_count = asyncio.run(export())
+
+        stages = [event.stage for event in events]
+        self.assertEqual(stages[:2], ['queued', 'manifest'])
+        self.assertIn('contacts', stages)
+        self.assertEqual(stages[-1], 'done')
+        rows = [event.rows for event in events if event.stage == 'export']
+        self.assertEqual(rows, sorted(rows))
+        self.assertEqual(events[-1].rows, row_count)
+        self.assertEqual(events[-1].total_rows, row_count)
+        self.assertEqual(events[-1].eta, 0)
+        self.assertEqual(events[-1].bytes_written, os.path.getsize(self.__output_path()))
+        self.assertEqual(fixtures.read_csv_output(self.__output_path()),
+                         fixtures.read_expected_output())
+
+    def test_progress_bytes_of_split_and_sqlite_exports(self):
+        ''' Sizes come from the writer: the parts of a split export, and the pages of a SQLite
+        export that are still in its open transaction '''
+        async def export(output_path, **options):
+            job = ExportService().start(self.backup_dir, output_path, 'US', batch_size=2,
+                                        **options)
+            return [event async for event in job]
+
+        events = asyncio.run(export(self.__output_path(), split_rows=2))
+        manifest = split_output.load_manifest(self.__output_path())
+        self.assertEqual(len(manifest['parts']), 4)
+        sizes = [event.bytes_written for event in events if event.stage == 'export' and event.rows]
+        self.assertEqual(sizes, sorted(sizes))
+        self.assertGreater(sizes[0], 0)
+        self.assertEqual(events[-1].bytes_written,
+                         sum(os.path.getsize(os.path.join(self.tmp_dir.name, part['path']))
+                             for part in manifest['parts']))
+
+        events = asyncio.run(export(self.__output_path('messages.sqlite'),
+                                    output_format='sqlite'))
+        self.assertTrue(all(event.bytes_written > 0 for event in events
+                            if event.stage == 'export' and event.rows))
+        self.assertEqual(events[-1].bytes_written,
+                         os.path.getsize(self.__output_path('messages.sqlite')))
+
+    def test_progress_total_with_chats(self):
+        ''' With chats, a message in two chats is written (and so counted) twice '''
+        sms_db_path = os.path.join(self.backup_dir, fixtures.SMS_DB_FILE_ID[:2],
+                                   fixtures.SMS_DB_FILE_ID)
+        conn = sqlite3.connect(sms_db_path)
+        with conn:
+            conn.execute("INSERT INTO chat_message_join(chat_id, message_id) VALUES(2, 1)")
+        conn.close()
+
+        async def export():
+            job = ExportService().start(self.backup_dir, self.__output_path(), 'US', chats=True)
+            return [event async for event in job], await job.result()
+        events, row_count = asyncio.run(export())
+        self.assertEqual(row_count, 8)
+        self.assertEqual(max(event.total_rows or 0 for event in events), row_count)
+
+    def test_export_matches_sync(self):
+        service = ExportService()
+        row_count = asyncio.run(service.export(self.backup_dir, self.__output_path('async.csv'),
+                                               'US', chats=True))
+        self.assertEqual(row_count, extract_messages(self.backup_dir,
+                                                     self.__output_path('sync.csv'), 'US',
+                                                     chats=True))
+        self.assertEqual(fixtures.read_csv_output(self.__output_path('async.csv')),
+                         fixtures.read_csv_output(self.__output_path('sync.csv')))
+
+    def test_cancel(self):
+        # Cancelled part way through writing messages
+        def cancel_after_first_batch(event):
+            if event.rows:
+                reporter.cancel()
+        reporter = ProgressReporter(cancel_after_first_batch)
+        with self.assertRaises(ExportCancelled):
+            extract_messages(self.backup_dir, self.__output_path(), 'US', batch_size=2,
+                             progress=reporter)
+        # It stops the next time it reports in
+        self.assertEqual(reporter.rows, 4)
+
+        # Cancelled before it got a slot
+        async def cancel_queued():
+            service = ExportService(max_concurrent_exports=1)
+            first = service.start(self.backup_dir, self.__output_path('first.csv'), 'US')
+            second = service.start(self.backup_dir, self.__output_path('second.csv'), 'US')
+            second.cancel()
+            await first.result()
+            with self.assertRaises(ExportCancelled):
+                await second.result()
+        asyncio.run(cancel_queued())
+        self.assertFalse(os.path.exists(self.__output_path('second.csv')))
+
+    def test_timeout(self):
+        async def export():
+            await ExportService().export(self.backup_dir, self.__output_path(), 'US', timeout=0)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(export())
+
+    def test_timeout_of_failing_export(self):
+        ''' The timeout is reported, not whatever the export failed with as it stopped '''
+        async def export():
+            await ExportService().export(os.path.join(self.tmp_dir.name, 'missing'),
+                                         self.__output_path(), 'US', timeout=0)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(export())
+
+    def test_concurrency_limit(self):
+        executor = CountingExecutor()
+        async def export_all():
+            service = ExportService(max_concurrent_exports=2, executor=executor)
+            return await asyncio.gather(*[
+                service.export(self.backup_dir, self.__output_path('{}.csv'.format(i)), 'US')
+                for i in range(5)])
+        row_counts = asyncio.run(export_all())
+        executor.shutdown()
+        self.assertEqual(len(set(row_counts)), 1)
+        self.assertLessEqual(executor.max_running, 2)
+
+if __name__ == '__main__':
+    main()
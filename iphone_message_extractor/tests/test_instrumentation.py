@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+from unittest import TestCase, main
+
+from iphone_message_extractor import instrumentation
+from iphone_message_extractor.instrumentation import Profiler
+from iphone_message_extractor.message_extractor import extract_messages
+from iphone_message_extractor.phone_db import MessageDB
+from . import fixtures
+
+class TestInstrumentation(TestCase):
+    '''
+    Tests for profiling exports (see instrumentation.py)
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        self.output_path = os.path.join(self.tmp_dir.name, 'messages.csv')
+        fixtures.create_backup(self.backup_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_profiled_queries(self):
+        profiler = Profiler()
+        db_file = os.path.join(self.tmp_dir.name, 'sms.db')
+        fixtures.create_message_db(db_file).close()
+        message_db = MessageDB(db_file, profiler=profiler)
+        message_db.connect()
+        self.assertEqual(len(message_db.generate_handle_dict()), 6)
+        message_db.close()
+        query = profiler.queries['SELECT DISTINCT id FROM handle WHERE id IS NOT NULL']
+        self.assertEqual((query['calls'], query['rows']), (2, 6))
+
+    def test_profile_extract(self):
+        profiler = Profiler(cpu=True, memory=True)
+        profiler.start()
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US', chats=True,
+                                          profiler=profiler), 7)
+        profiler.stop()
+        # Profiling doesn't change the output
+        self.assertEqual(len(fixtures.read_csv_output(self.output_path)), 7)
+
+        report = instrumentation.save_profile(profiler, self.output_path)
+        with open(instrumentation.report_path_for_output(self.output_path)) as fp:
+            self.assertEqual(json.load(fp), json.loads(json.dumps(report)))
+        self.assertTrue(os.path.isfile(self.output_path + '.prof'))
+
+        self.assertEqual(list(report['stages']),
+                         ['manifest', 'contacts', 'handles', 'chats', 'export'])
+        self.assertEqual(report['counters']['rows'], 7)
+        self.assertGreater(report['rows_per_second'], 0)
+        # Both DBs are looked up once (not again for each path)
+        self.assertEqual(report['caches']['manifest'], {'hits': 0, 'misses': 2, 'hit_rate': 0.0})
+        # Every message is fetched by the main query
+        self.assertEqual(max(query['rows'] for query in report['queries']), 7)
+        self.assertIn('peak_bytes', report['memory'])
+        self.assertTrue(report['cpu'])
+
+        summary = instrumentation.format_report(report)
+        self.assertIn('Slowest queries:', summary)
+        self.assertIn('Manifest cache: 0 hits, 2 misses (0%)', summary)
+
+    def test_stage_without_profiler(self):
+        with instrumentation.stage(None, 'nothing'):
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+from unittest import TestCase, main
+
+from iphone_message_extractor.manifest_cache import ManifestResolver
+from iphone_message_extractor.phone_db import ManifestDB
+from . import fixtures
+
+class TestManifestResolver(TestCase):
+
+    MISSING_DOMAIN_PATH = ('HomeDomain', 'Library/Missing.db')
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        fixtures.create_backup(self.backup_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resolve(self):
+        resolver = ManifestResolver(self.backup_dir, self.cache_dir)
+        paths = resolver.resolve([ManifestDB.SMS_DB_DOMAIN_PATH,
+                                  TestManifestResolver.MISSING_DOMAIN_PATH])
+        self.assertEqual(paths, {ManifestDB.SMS_DB_DOMAIN_PATH: os.path.join(
+            self.backup_dir, fixtures.SMS_DB_FILE_ID[:2], fixtures.SMS_DB_FILE_ID)})
+        with self.assertRaises(FileNotFoundError):
+            resolver.get_physical_path(TestManifestResolver.MISSING_DOMAIN_PATH)
+
+    def test_cache_is_reused_until_manifest_changes(self):
+        ManifestResolver(self.backup_dir, self.cache_dir).resolve(
+            [ManifestDB.SMS_DB_DOMAIN_PATH, TestManifestResolver.MISSING_DOMAIN_PATH])
+
+        # Both the hit and the miss are remembered by the next resolver for this backup...
+        resolver = ManifestResolver(self.backup_dir, self.cache_dir)
+        self.assertEqual(resolver.file_ids, {
+            ManifestDB.SMS_DB_DOMAIN_PATH: fixtures.SMS_DB_FILE_ID,
+            TestManifestResolver.MISSING_DOMAIN_PATH: None})
+
+        # ...but not once Manifest.db has been touched
+        manifest_db_path = os.path.join(self.backup_dir, 'Manifest.db')
+        stat = os.stat(manifest_db_path)
+        os.utime(manifest_db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(ManifestResolver(self.backup_dir, self.cache_dir).file_ids, {})
+
+    def test_stats(self):
+        ''' Each file looked up counts once, as a hit or a miss '''
+        resolver = ManifestResolver(self.backup_dir, self.cache_dir)
+        resolver.get_physical_paths([ManifestDB.SMS_DB_DOMAIN_PATH,
+                                     ManifestDB.ADDRESS_BOOK_DOMAIN_PATH])
+        self.assertEqual(resolver.stats, {'hits': 0, 'misses': 2})
+        resolver = ManifestResolver(self.backup_dir, self.cache_dir)
+        resolver.get_physical_paths([ManifestDB.SMS_DB_DOMAIN_PATH,
+                                     ManifestDB.ADDRESS_BOOK_DOMAIN_PATH])
+        self.assertEqual(resolver.stats, {'hits': 2, 'misses': 0})
+
+    def test_no_cache_dir(self):
+        ManifestResolver(self.backup_dir).resolve([ManifestDB.SMS_DB_DOMAIN_PATH])
+        self.assertEqual(ManifestResolver(self.backup_dir).file_ids, {})
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+from unittest import TestCase, main, skipIf
+
+from iphone_message_extractor import export_state
+from iphone_message_extractor.message_extractor import extract_messages, ColumnarMessageWriter
+from . import fixtures
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+class TestMessageExtractor(TestCase):
+    '''
+    End-to-end tests for extract_messages against an on-disk backup (see fixtures.create_backup)
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        self.output_path = os.path.join(self.tmp_dir.name, 'messages.csv')
+        fixtures.create_backup(self.backup_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def __execute(self, file_id, sql, params=()):
+        conn = sqlite3.connect(os.path.join(self.backup_dir, file_id[:2], file_id))
+        with conn:
+            conn.execute(sql, params)
+        conn.close()
+
+    def __add_message(self, text):
+        self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(handle_id, date, is_from_me, text)
+                                                   VALUES(3, '345999999000000000', 1, ?)''', (text,))
+
+    def test_extract_messages(self):
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US'), 7)
+        self.assertEqual(fixtures.read_csv_output(self.output_path),
+                         fixtures.read_expected_output())
+
+    def test_extract_messages_sql_engine(self):
+        ''' The SQL engine should produce exactly the same output as the Python one '''
+        # Give one of the handles no name at all, and one a contact with no last name
+        self.__execute(fixtures.SMS_DB_FILE_ID,
+                       "INSERT INTO handle(ROWID, id, service) VALUES(7, '917-555-0000', 'SMS')")
+        self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(handle_id, date, text)
+                                                   VALUES(7, '345999999000000000', 'Hi')''')
+        self.__execute(fixtures.ADDRESS_BOOK_FILE_ID, "UPDATE ABPerson SET Last = NULL WHERE ROWID = 5")
+
+        python_path = os.path.join(self.tmp_dir.name, 'python.csv')
+        self.assertEqual(extract_messages(self.backup_dir, python_path, 'US'), 8)
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US', engine='sql'), 8)
+        self.assertEqual(fixtures.read_csv_output(self.output_path),
+                         fixtures.read_csv_output(python_path))
+
+    def test_extract_messages_dates(self):
+        ''' Dates in seconds and nanoseconds are both handled, messages within the same second
+        stay in order, and both engines honour the timezone '''
+        for date, text in [('346000000900000000', 'Second'), ('346000000100000000', 'First'),
+                           ('346000001', 'Third')]:
+            self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(handle_id, date, text)
+                                                       VALUES(3, ?, ?)''', (date, text))
+        for engine in ('python', 'sql'):
+            self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                              engine=engine, timezone='UTC'), 10)
+            rows = [row for row in fixtures.read_csv_output(self.output_path)
+                    if row[5] in ('First', 'Second', 'Third')]
+            self.assertEqual([(row[3], row[5]) for row in rows],
+                             [('2011-12-19 15:06:40', 'First'), ('2011-12-19 15:06:40', 'Second'),
+                              ('2011-12-19 15:06:41', 'Third')])
+
+    def test_extract_messages_with_chats(self):
+        ''' Messages are grouped by chat, including one sent to the group without a handle '''
+        self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(ROWID, handle_id, date,
+                                                                     is_from_me, text)
+                                                   VALUES(8, 0, '345999999000000000', 1,
+                                                          'Fly, you fools!')''')
+        self.__execute(fixtures.SMS_DB_FILE_ID, "INSERT INTO chat_message_join VALUES(2, 8, 0)")
+
+        expected_output = fixtures.read_expected_output()
+        sam_chat = ['+12125551212', '', 'Samwise Gamgee']
+        fellowship = ['chat1234567890', 'Fellowship', 'Samwise Gamgee; Gandalf the Grey']
+        for engine in ('python', 'sql'):
+            self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                              engine=engine, chats=True), 8)
+            rows = fixtures.read_csv_output(self.output_path)
+            self.assertEqual(rows[:5], [row + sam_chat for row in expected_output[:5]])
+            self.assertEqual(rows[5:7], [row + fellowship for row in expected_output[5:]])
+            self.assertEqual(rows[7][2:], ['', '2011-12-19 10:06:39', 'Yes', 'Fly, you fools!', '']
+                             + fellowship)
+
+    def test_incremental_sql_engine(self):
+        extract_messages(self.backup_dir, self.output_path, 'US', incremental=True)
+        self.__add_message('Po-tay-toes!')
+        # The contacts snapshot is the same regardless of engine, so this is just an append
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True, engine='sql'), 1)
+        self.assertEqual(len(fixtures.read_csv_output(self.output_path)), 8)
+
+    def test_incremental_appends_new_messages(self):
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True), 7)
+        state = export_state.load_export_state(self.output_path)
+        self.assertEqual(state['max_rowid'], 7)
+
+        # Nothing new, nothing written
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True), 0)
+
+        self.__add_message('Po-tay-toes!')
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True), 1)
+        rows = fixtures.read_csv_output(self.output_path)
+        self.assertEqual(rows[:7], fixtures.read_expected_output())
+        self.assertEqual(rows[7][0:3] + rows[7][5:6], ['Gamgee', 'Samwise', '+1 212-555-1212',
+                                                       'Po-tay-toes!'])
+        with open(self.output_path, 'rb') as fp:
+            self.assertEqual(fp.read().count(b'\xef\xbb\xbf'), 1)
+
+    def test_incremental_rebuilds_when_names_change(self):
+        extract_messages(self.backup_dir, self.output_path, 'US', incremental=True)
+
+        # A new contact nobody has messaged doesn't invalidate the export...
+        self.__execute(fixtures.ADDRESS_BOOK_FILE_ID,
+                       "INSERT INTO ABMultiValue(record_id, value) VALUES(5, '917 555 1212')")
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True), 0)
+
+        # ...and neither does someone new messaging for the first time...
+        self.__execute(fixtures.SMS_DB_FILE_ID,
+                       "INSERT INTO handle(ROWID, id, service) VALUES(7, '917-555-0000', 'SMS')")
+        self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(handle_id, date, text)
+                                                   VALUES(7, '345999999000000000', 'Hi')''')
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True), 1)
+
+        # ...but renaming someone in it does
+        self.__execute(fixtures.ADDRESS_BOOK_FILE_ID,
+                       "UPDATE ABPerson SET First = 'Sam' WHERE First = 'Samwise'")
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True), 8)
+        rows = fixtures.read_csv_output(self.output_path)
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[0][1], 'Sam')
+
+    def test_extract_messages_filtered(self):
+        ''' Filters on dates (in seconds and nanoseconds), contacts, service and direction '''
+        self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(handle_id, date, text)
+                                                   VALUES(3, '346000001', 'Po-tay-toes!')''')
+        def extract(**filters):
+            rows = {}
+            for engine in ('python', 'sql'):
+                row_count = extract_messages(self.backup_dir, self.output_path, 'US',
+                                             engine=engine, timezone='UTC', **filters)
+                rows[engine] = fixtures.read_csv_output(self.output_path)
+                self.assertEqual(len(rows[engine]), row_count)
+            self.assertEqual(rows['python'], rows['sql'])
+            return [row[5] for row in rows['python']]
+
+        self.assertEqual(extract(since='2011-12-19 12:01:20', until='2011-12-19 12:01:40'),
+                         ["I don't suppose we'll ever see them again.",
+                          'We may yet, Mr. Frodo. We may.'])
+        self.assertEqual(extract(since='2011-12-19 15:00:00'), ['Po-tay-toes!'])
+        self.assertEqual(len(extract(until='2011-12-19')), 8)
+        self.assertEqual(extract(until='2011-12-18'), [])
+        self.assertEqual(len(extract(contacts=['samwise'])), 6)
+        self.assertEqual(len(extract(contacts=['212 555 1212', 'The Grey'])), 8)
+        self.assertEqual(extract(contacts=['frodo@shire.net']), [])
+        self.assertEqual(len(extract(from_me=True)), 5)
+        self.assertEqual(len(extract(from_me=False, service='iMessage')), 3)
+        self.assertEqual(extract(service='SMS'), [])
+        with self.assertRaises(ValueError):
+            extract(contacts=['Sauron'])
+
+    def test_extract_messages_filtered_with_chats(self):
+        ''' Your own messages in a group chat have no handle, so they're kept if someone in the chat
+        passes the filter '''
+        self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(ROWID, handle_id, date,
+                                                                     is_from_me, text)
+                                                   VALUES(8, 0, '345999999000000000', 1,
+                                                          'Fly, you fools!')''')
+        self.__execute(fixtures.SMS_DB_FILE_ID, "INSERT INTO chat_message_join VALUES(2, 8, 0)")
+        for engine in ('python', 'sql'):
+            extract = lambda **filters: [row[5] for row in fixtures.read_csv_output(
+                self.output_path)] if extract_messages(self.backup_dir, self.output_path, 'US',
+                                                       engine=engine, chats=True, **filters) \
+                else []
+            self.assertEqual(extract(contacts=['Gandalf'])[-1], 'Fly, you fools!')
+            self.assertEqual(len(extract(contacts=['Gandalf'])), 3)
+            self.assertEqual(len(extract(contacts=['Samwise'])), 6)
+            self.assertEqual(len(extract(service='iMessage', from_me=True)), 6)
+            self.assertEqual(extract(service='SMS'), [])
+
+    def test_incremental_rebuilds_when_filters_change(self):
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True, from_me=True), 5)
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True, from_me=True), 0)
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          incremental=True), 7)
+
+    def test_tapbacks(self):
+        ''' Tapbacks can be kept as messages, skipped or folded into the message they react to '''
+        self.__execute(fixtures.SMS_DB_FILE_ID, "UPDATE message SET guid = 'G' || ROWID")
+        for handle_id, is_from_me, tapback_type, associated_guid, text in [
+                (3, 0, 2000, 'p:0/G1', 'Loved "Mordor! I hope the others find a safer road."'),
+                (3, 1, 2003, 'p:0/G1', 'Laughed at "Mordor! I hope the others find..."'),
+                (3, 1, 3003, 'p:0/G1', 'Removed a laugh from "Mordor! I hope the others..."'),
+                (3, 1, 2001, 'bp:G1', 'Liked "Mordor! I hope the others find a safer road."'),
+                (6, 0, 2004, 'p:0/G7', 'Emphasized "So do all who live to see such times..."'),
+                # A sticker isn't a tapback, so it's always kept
+                (6, 0, 2007, 'p:0/G7', 'Sticker')]:
+            self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(handle_id, date, is_from_me,
+                                                                         associated_message_type,
+                                                                         associated_message_guid,
+                                                                         text)
+                                                       VALUES(?, '345999999000000000', ?, ?, ?, ?)''',
+                           (handle_id, is_from_me, tapback_type, associated_guid, text))
+        expected_output = fixtures.read_expected_output()
+        for engine in ('python', 'sql'):
+            self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                              engine=engine), 13)
+            self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                              engine=engine, tapbacks='skip'), 8)
+            rows = fixtures.read_csv_output(self.output_path)
+            self.assertEqual(rows[:7], expected_output)
+            self.assertEqual(rows[7][5], 'Sticker')
+
+            self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                              engine=engine, tapbacks='fold', chats=True), 8)
+            # (the sticker isn't in a chat, so it comes first)
+            rows = fixtures.read_csv_output(self.output_path)
+            self.assertEqual(rows[0][5], 'Sticker')
+            self.assertEqual([row[:7] for row in rows[1:]], expected_output)
+            self.assertEqual([row[-1] for row in rows],
+                             ['', 'Loved by Samwise Gamgee; Liked by me', '', '', '', '', '',
+                              'Emphasized by Gandalf the Grey'])
+        with self.assertRaises(ValueError):
+            extract_messages(self.backup_dir, self.output_path, 'US', tapbacks='hide')
+
+    def test_changed_tapbacks(self):
+        ''' A new tapback replaces the one the same person left on the message before '''
+        self.__execute(fixtures.SMS_DB_FILE_ID, "UPDATE message SET guid = 'G' || ROWID")
+        for handle_id, is_from_me, tapback_type, associated_guid in [
+                (3, 0, 2000, 'p:0/G1'),
+                (3, 0, 2001, 'p:0/G1'),
+                # Taking back the love that was already changed to a like leaves the like
+                (3, 0, 3000, 'p:0/G1'),
+                (3, 1, 2006, 'p:0/G1'),
+                (3, 1, 2005, 'p:0/G1'),
+                (6, 0, 2002, 'p:0/G7'),
+                (6, 0, 2004, 'p:0/G7')]:
+            self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(handle_id, date, is_from_me,
+                                                                         associated_message_type,
+                                                                         associated_message_guid)
+                                                       VALUES(?, '345999999000000000', ?, ?, ?)''',
+                           (handle_id, is_from_me, tapback_type, associated_guid))
+        for engine in ('python', 'sql'):
+            self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                              engine=engine, tapbacks='fold', chats=True), 7)
+            self.assertEqual([row[-1] for row in fixtures.read_csv_output(self.output_path)],
+                             ['Liked by Samwise Gamgee; Reacted to by me; Questioned by me', '',
+                              '', '', '', '', 'Emphasized by Gandalf the Grey'])
+
+    def __check_columnar_table(self, table):
+        self.assertEqual(table.column_names, ['last_name', 'first_name', 'phone', 'date_time',
+                                              'is_from_me', 'message', 'service'])
+        self.assertEqual(table.num_rows, 7)
+        self.assertEqual(table.schema.field('date_time').type, pyarrow.timestamp('us', tz='UTC'))
+        self.assertEqual(table.column('date_time')[0].as_py(),
+                         datetime(2011, 12, 19, 12, 0, 10, tzinfo=timezone.utc))
+        self.assertEqual(table.column('is_from_me').to_pylist()[:2], [True, False])
+        self.assertEqual(str(table.schema.field('service').type),
+                         'dictionary<values=string, indices=int32, ordered=0>')
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_extract_messages_to_parquet(self):
+        import pyarrow.parquet
+        self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                          output_format='parquet'), 7)
+        self.__check_columnar_table(pyarrow.parquet.read_table(self.output_path))
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_timestamps(self):
+        ''' Timestamps keep the timezone they're shown in and the precision of nanosecond dates '''
+        import pyarrow.parquet
+        self.__execute(fixtures.SMS_DB_FILE_ID, '''INSERT INTO message(handle_id, date, text)
+                                                   VALUES(3, '346000000123456789', 'Po-tay-toes!')''')
+        for engine in ('python', 'sql'):
+            extract_messages(self.backup_dir, self.output_path, 'US', output_format='parquet',
+                             engine=engine, timezone='Europe/London')
+            table = pyarrow.parquet.read_table(self.output_path)
+            self.assertEqual(table.schema.field('date_time').type,
+                             pyarrow.timestamp('us', tz='Europe/London'))
+            dates = dict(zip(table.column('message').to_pylist(),
+                             table.column('date_time').to_pylist()))
+            self.assertEqual(dates['Po-tay-toes!'].astimezone(timezone.utc),
+                             datetime(2011, 12, 19, 15, 6, 40, 123456, tzinfo=timezone.utc))
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_columnar_writer_row_groups(self):
+        ''' Arrow IPC files need the dictionary to only grow between row groups '''
+        import pyarrow.ipc
+        rows = fixtures.read_expected_output()
+        rows[5][6] = 'SMS'
+        with ColumnarMessageWriter(self.output_path, ['Is from me?', 'Service'], use_parquet=False,
+                                   row_group_size=2) as writer:
+            self.assertEqual(writer.write_rows((row[4], row[6]) for row in rows), 7)
+
+        table = pyarrow.ipc.open_file(self.output_path).read_all()
+        self.assertEqual(table.column('service').to_pylist(),
+                         ['iMessage'] * 5 + ['SMS', 'iMessage'])
+
+if __name__ == '__main__':
+    main()
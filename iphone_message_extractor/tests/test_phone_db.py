@@ -1,8 +1,12 @@
 import os
+import sqlite3
+import tempfile
 from unittest import TestCase, main
 
-from iphone_message_extractor import util
-from iphone_message_extractor.phone_db import PhoneDB, ManifestDB, AddressDB, MessageDB
+from iphone_message_extractor import synthetic, util
+from iphone_message_extractor.contact_store import ContactStore
+from iphone_message_extractor.phone_db import PhoneDB, ManifestDB, AddressDB, MessageDB, \
+    MessageFilter
 from . import fixtures
 
 class TestPhoneDB(TestCase):
@@ -35,6 +39,16 @@ class TestPhoneDB(TestCase):
         with self.assertRaises(FileNotFoundError):
             TestPhoneDB.manifest_db.get_physical_path_for_file('com.apple.Preferences.plist')
 
+    def test_manifest_get_file_ids(self):
+        ''' Ensure many files are looked up at once by exact domain and relativePath '''
+        file_ids = TestPhoneDB.manifest_db.get_file_ids([ManifestDB.SMS_DB_DOMAIN_PATH,
+                                                         ManifestDB.ADDRESS_BOOK_DOMAIN_PATH,
+                                                         ('MediaDomain', 'Library/SMS/sms.db'),
+                                                         ('HomeDomain', 'Library/Missing.db')])
+        self.assertEqual(file_ids, {ManifestDB.SMS_DB_DOMAIN_PATH: fixtures.SMS_DB_FILE_ID,
+                                    ManifestDB.ADDRESS_BOOK_DOMAIN_PATH: \
+                                        fixtures.ADDRESS_BOOK_FILE_ID})
+
     def __expected_dict(self):
          return {'frodo@shire.net': ('Frodo', 'Baggins'),
                  '+1 646-400-1212': ('Frodo', 'Baggins'),
@@ -68,13 +82,123 @@ class TestPhoneDB(TestCase):
             res = cur.execute("DELETE FROM ABMultiValue WHERE value = 'http://mithrandir.net'")
         conn.commit()
         
+    def test_message_handle_dict(self):
+        ''' Ensure each distinct handle is normalized in the pre-pass '''
+        self.assertEqual(TestPhoneDB.message_db.generate_handle_dict(),
+                         {'mailto:frodo@shire.net': 'frodo@shire.net',
+                          '646-400-1212': '+1 646-400-1212',
+                          '+1 (212) 555-1212': '+1 212-555-1212',
+                          '646 555 1212': '+1 646-555-1212',
+                          'tel:415-555-1212': '+1 415-555-1212',
+                          'mailto:mithrandir@gondor.net': 'mithrandir@gondor.net'})
+
     def test_matching_messages_to_contact_dict(self):
         ''' Ensure that match_messages_to_contact_dict matches to the right contacts '''
-        expected_output = fixtures.read_expected_output()
+        expected_output = [tuple(row) for row in fixtures.read_expected_output()]
         
         self.assertEqual(expected_output,\
                     TestPhoneDB.message_db.match_messages_to_contact_dict(self.__expected_dict()))
+
+    def test_iter_messages_in_small_batches(self):
+        ''' Ensure streaming with a batch smaller than the result set yields every row in order '''
+        expected_output = [tuple(row) for row in fixtures.read_expected_output()]
+        messages = TestPhoneDB.message_db.iter_messages_matched_to_contact_dict(
+                        self.__expected_dict(), batch_size=2)
+
+        self.assertFalse(isinstance(messages, list))
+        self.assertEqual(expected_output, list(messages))
+
+    def test_contact_store(self):
+        ''' Ensure the address book is loaded into a compact store sharing names per contact '''
+        contacts = TestPhoneDB.address_db.generate_dict_from_address_book()
+        self.assertIsInstance(contacts, ContactStore)
+        self.assertEqual(contacts.contact_id('frodo@shire.net'),
+                         contacts.contact_id('+1 646-400-1212'))
+        self.assertIs(contacts['frodo@shire.net'], contacts['+1 646-400-1212'])
+        self.assertIsNone(contacts.contact_id('sauron@mordor.net'))
+        self.assertEqual(ContactStore.from_mapping(self.__expected_dict()), contacts)
+
+        handle_columns = contacts.handle_columns(TestPhoneDB.message_db.generate_handle_dict())
+        self.assertEqual(handle_columns['+1 (212) 555-1212'],
+                         ('Gamgee', 'Samwise', '+1 212-555-1212'))
+        # Every message from a handle shares its name columns
+        rows = TestPhoneDB.message_db.match_messages_to_contact_dict(contacts)
+        self.assertIs(rows[0][0], rows[1][0])
+
+
+    def test_message_filter(self):
+        ''' Filtered queries pick the same messages as filtering every message afterwards, and go
+        by sms.db's indexes on message.date and message.handle_id '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backup_dir = os.path.join(tmp_dir, 'backup')
+            synthetic.create_synthetic_backup(backup_dir, contacts=20, handles=15, messages=3000,
+                                              group_chats=2)
+            sms_db_path = synthetic.backup_file_path(backup_dir, ManifestDB.SMS_DB_DOMAIN_PATH)
+            # Some messages from older iOS versions, with dates in seconds
+            conn = sqlite3.connect(sms_db_path)
+            with conn:
+                conn.execute("UPDATE message SET date = date / 1000000000 WHERE ROWID % 3 = 0")
+            conn.close()
+
+            message_db = MessageDB(sms_db_path, **PhoneDB.BACKUP_DB_OPTIONS)
+            message_db.connect()
+            try:
+                conn = message_db.connection()
+                columns = 'handle.ROWID, {}, message.is_from_me, handle.service'.format(
+                    MessageDB.UNIX_SECONDS_SQL)
+                sql = '''SELECT {} FROM message
+                          INNER JOIN handle ON handle.ROWID = message.handle_id'''
+                rows = conn.execute(sql.format(columns)).fetchall()
+                since, until = rows[100][1], rows[2000][1]
+
+                for message_filter, keep in [
+                        (MessageFilter(since, until), lambda row: since <= row[1] < until),
+                        (MessageFilter(until=until, handle_rowids=[3, 4], from_me=True),
+                         lambda row: row[1] < until and row[0] in (3, 4) and row[2]),
+                        (MessageFilter(since, service='SMS', from_me=False),
+                         lambda row: row[1] >= since and row[3] == 'SMS' and not row[2]),
+                        (MessageFilter(handle_rowids=[]), lambda row: False)]:
+                    where_sql, params = message_filter.where()
+                    self.assertEqual(
+                        sorted(conn.execute(sql.format(columns) + ' WHERE ' +
+                                            ' AND '.join(where_sql), params).fetchall()),
+                        sorted(filter(keep, rows)))
+                    self.assertEqual(message_db.count_messages(message_filter=message_filter),
+                                     len(list(filter(keep, rows))))
+
+                for message_filter, index in [(MessageFilter(since, until), 'message_idx_date'),
+                                              (MessageFilter(since, handle_rowids=[3]),
+                                               'message_idx_handle')]:
+                    where_sql, params = message_filter.where()
+                    plan = conn.execute('EXPLAIN QUERY PLAN SELECT ROWID FROM message WHERE ' +
+                                        ' AND '.join(where_sql), params).fetchall()
+                    self.assertIn(index, ' '.join(row[-1] for row in plan))
+            finally:
+                message_db.close()
+
+        # Dates in seconds and nanoseconds are both matched
+        message_filter = MessageFilter(util.apple_date_to_timestamp(345988845),
+                                       util.apple_date_to_timestamp(345988900))
+        self.assertEqual(TestPhoneDB.message_db.count_messages(message_filter=message_filter), 2)
+        with self.assertRaises(ValueError):
+            MessageFilter(service='Carrier pigeon')
+
+    def test_read_only_connection(self):
+        ''' Backup DBs are opened read-only with the scan pragmas applied '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_file = os.path.join(tmp_dir, 'sms #1.db')
+            fixtures.create_message_db(db_file).close()
+
+            message_db = MessageDB(db_file, **PhoneDB.BACKUP_DB_OPTIONS)
+            conn = message_db.connect()
+            self.assertEqual(len(message_db.match_messages_to_contact_dict(self.__expected_dict())),
+                             7)
+            self.assertEqual(conn.execute('PRAGMA cache_size').fetchone()[0], -65536)
+            self.assertEqual(conn.execute('PRAGMA temp_store').fetchone()[0], 2)
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM message")
+            message_db.close()
         
-        
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,91 @@
+from unittest import TestCase, main
+
+from iphone_message_extractor import schema
+from iphone_message_extractor.phone_db import MessageDB, MessageFilter
+from . import fixtures
+
+class TestSchema(TestCase):
+    '''
+    Tests for probing the schema of sms.db and adapting the queries to it (see schema.py)
+    '''
+
+    def __create_old_message_db(self):
+        ''' An sms.db from before attributedBody and tapbacks '''
+        def message_sql(cur):
+            cur.execute('''CREATE TABLE message (ROWID INTEGER PRIMARY KEY AUTOINCREMENT,
+                                                 guid TEXT, text TEXT, handle_id INTEGER,
+                                                 date INTEGER, is_from_me INTEGER)''')
+            cur.execute("CREATE TABLE handle (ROWID INTEGER PRIMARY KEY, id TEXT, service TEXT)")
+            cur.execute("INSERT INTO handle VALUES (1, '+1 (212) 555-1212', 'SMS')")
+            cur.executemany('''INSERT INTO message(handle_id, date, is_from_me, text)
+                               VALUES (1, ?, ?, ?)''',
+                            [(345988810, 1, 'Mordor!'), (345988845, 0, "Strider'll look after them.")])
+        return fixtures.create_db(MessageDB, message_sql)
+
+    def test_probe(self):
+        message_db = fixtures.create_message_db()
+        message_schema = message_db.get_schema()
+        self.assertIs(message_db.get_schema(), message_schema)
+        self.assertTrue(message_schema.has_column('message', 'attributedBody'))
+        self.assertFalse(message_schema.has_column('message', 'associated_message_emoji'))
+        self.assertEqual(message_schema.text_sql, 'COALESCE(message.text, message.attributedBody)')
+        self.assertTrue(message_schema.can_fold_tapbacks)
+        self.assertEqual(message_schema.tapback_emoji_sql, 'NULL')
+
+        # DBs with the same schema share one MessageSchema (and the queries planned for it)
+        other_db = fixtures.create_message_db()
+        self.assertIs(other_db.get_schema(), message_schema)
+        self.assertEqual(other_db.match_messages_to_contact_dict({}),
+                         message_db.match_messages_to_contact_dict({}))
+        query_count = len(message_schema.queries)
+        other_db.match_messages_to_contact_dict({})
+        self.assertEqual(len(message_schema.queries), query_count)
+        message_db.close()
+        other_db.close()
+
+    def test_old_schema(self):
+        message_db = self.__create_old_message_db()
+        message_schema = message_db.get_schema()
+        new_db = fixtures.create_message_db()
+        self.assertIsNot(message_schema, new_db.get_schema())
+        new_db.close()
+        self.assertEqual(message_schema.columns['attachment'], frozenset())
+        self.assertEqual(message_schema.text_sql, 'message.text')
+        self.assertIsNone(message_schema.tapback_where())
+        self.assertFalse(message_schema.can_fold_tapbacks)
+
+        contacts = {'+1 212-555-1212': ('Samwise', 'Gamgee')}
+        self.assertEqual([row[5] for row in message_db.match_messages_to_contact_dict(contacts)],
+                         ['Mordor!', "Strider'll look after them."])
+        self.assertEqual(message_db.count_messages(
+            message_filter=MessageFilter(skip_tapbacks=True)), 2)
+        self.assertEqual(message_db.generate_reaction_dict(contacts, {}), {})
+
+        # No chat or attachment tables: every message is in no chat and has no attachments
+        self.assertFalse(message_schema.has_chats or message_schema.has_attachments)
+        self.assertEqual(message_db.get_attachments(), [])
+        chat_dict = message_db.generate_chat_dict(contacts, {})
+        self.assertEqual(chat_dict, {})
+        rows = list(message_db.iter_messages_matched_to_contact_dict(contacts, chat_dict=chat_dict,
+                                                                     sort_keys=True))
+        self.assertEqual([message[-3:] for _, message in rows], [MessageDB.NO_CHAT] * 2)
+        message_db.close()
+
+    def test_queries_are_bounded(self):
+        ''' Only the most recently used queries are kept (e.g. filtering on ever more handles) '''
+        message_schema = schema.MessageSchema({'message': ['ROWID', 'text']})
+        for handle_count in range(schema.MessageSchema.MAX_QUERIES + 10):
+            message_schema.query(('messages', handle_count), lambda: 'SELECT 1')
+            # The first query stays in use, so it's never the one dropped
+            message_schema.query(('messages', 0), lambda: self.fail('Query built again'))
+        self.assertEqual(len(message_schema.queries), schema.MessageSchema.MAX_QUERIES)
+        self.assertNotIn(('messages', 1), message_schema.queries)
+
+    def test_parent_guid(self):
+        self.assertEqual(schema.parent_guid('p:0/1A2B-3C'), '1A2B-3C')
+        self.assertEqual(schema.parent_guid('p:12/1A2B-3C'), '1A2B-3C')
+        self.assertEqual(schema.parent_guid('bp:1A2B-3C'), '1A2B-3C')
+        self.assertEqual(schema.parent_guid('1A2B-3C'), '1A2B-3C')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase, main
+
+from iphone_message_extractor import search_index
+from iphone_message_extractor.message_extractor import extract_messages, SQLiteMessageWriter
+from . import fixtures
+
+class TestSearchIndex(TestCase):
+    '''
+    Tests for searchable SQLite exports (see search_index.py)
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        self.output_path = os.path.join(self.tmp_dir.name, 'messages.sqlite')
+        fixtures.create_backup(self.backup_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_extract_messages_to_sqlite(self):
+        for engine in ('python', 'sql'):
+            self.assertEqual(extract_messages(self.backup_dir, self.output_path, 'US',
+                                              output_format='sqlite', engine=engine, chats=True),
+                             7)
+            conn = sqlite3.connect(self.output_path)
+            # Everyone is only stored once
+            self.assertEqual(conn.execute("SELECT first_name, last_name FROM contacts").fetchall(),
+                             [('Samwise', 'Gamgee'), ('Gandalf', 'the Grey')])
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM handles").fetchone(), (2,))
+            self.assertEqual(conn.execute("SELECT identifier, name FROM chats").fetchall(),
+                             [('+12125551212', ''), ('chat1234567890', 'Fellowship')])
+            # The view has the same rows as a CSV export
+            self.assertEqual([list(row[1:8]) for row in conn.execute(
+                                 "SELECT * FROM messages_view ORDER BY id")],
+                             [row[:4] + [int(row[4] == 'Yes'), row[5], row[6]]
+                              for row in fixtures.read_expected_output()])
+            indexes = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")]
+            self.assertIn('messages_handle_date', indexes)
+            conn.close()
+
+    def test_search_messages(self):
+        extract_messages(self.backup_dir, self.output_path, 'US', output_format='sqlite')
+        search = lambda **criteria: [row[5] for row in
+                                     search_index.search_messages(self.output_path, **criteria)]
+        self.assertEqual(search(text='ring'), ["I wish the ring had never come to me, I wish "
+                                               "none of this had happened."])
+        self.assertEqual(len(search(text='mordor OR frodo')), 2)
+        self.assertEqual(len(search(contact='samwise gamgee')), 5)
+        self.assertEqual(len(search(contact='Grey Gandalf')), 2)
+        self.assertEqual(len(search(contact='212-555')), 5)
+        self.assertEqual(search(contact='Gamgee', text='safer'),
+                         ['Mordor! I hope the others find a safer road.'])
+        self.assertEqual(len(search(since='2011-12-19 07:01:30', until='2011-12-19 08:00:00')), 2)
+        self.assertEqual(len(search(since='2011-12-19', until='2011-12-19')), 7)
+        self.assertEqual(search(until='2011-12-18'), [])
+        self.assertEqual(search(limit=1), ['Mordor! I hope the others find a safer road.'])
+        row = search_index.search_messages(self.output_path, text='road')[0]
+        self.assertEqual(dict(zip(search_index.SEARCH_HEADER_ROW, row))['Last Name'], 'Gamgee')
+
+    def test_search_contact_with_one_name(self):
+        ''' Contacts with only a first (or only a last) name can be searched for too '''
+        conn = sqlite3.connect(os.path.join(self.backup_dir, fixtures.ADDRESS_BOOK_FILE_ID[:2],
+                                            fixtures.ADDRESS_BOOK_FILE_ID))
+        with conn:
+            conn.execute("UPDATE ABPerson SET Last = NULL WHERE First = 'Gandalf'")
+        conn.close()
+        for engine in ('python', 'sql'):
+            extract_messages(self.backup_dir, self.output_path, 'US', output_format='sqlite',
+                             engine=engine)
+            self.assertEqual(len(search_index.search_messages(self.output_path,
+                                                              contact='Gandalf')), 2)
+
+    def test_sqlite_writer_chunks(self):
+        rows = fixtures.read_expected_output()
+        header_row = ['Last Name', 'First Name', 'Phone #', 'Date & Time', 'Is from me?',
+                      'Message', 'Service']
+        with SQLiteMessageWriter(self.output_path, header_row, chunk_size=2) as writer:
+            self.assertEqual(writer.write_rows(iter(rows[:3])), 3)
+            self.assertEqual(writer.write_rows(rows[3:]), 4)
+        self.assertEqual(len(search_index.search_messages(self.output_path, contact='Samwise')), 5)
+
+    def test_sqlite_writer_failure(self):
+        ''' A failed export doesn't leave a partial database behind '''
+        def rows():
+            yield from fixtures.read_expected_output()
+            raise RuntimeError('Backup went away')
+        header_row = ['Last Name', 'First Name', 'Phone #', 'Date & Time', 'Is from me?',
+                      'Message', 'Service']
+        with self.assertRaises(RuntimeError):
+            with SQLiteMessageWriter(self.output_path, header_row, chunk_size=2) as writer:
+                writer.write_rows(rows())
+        self.assertFalse(os.path.exists(self.output_path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+from unittest import TestCase, main
+
+from iphone_message_extractor import shards, synthetic
+from iphone_message_extractor.message_extractor import extract_messages
+from . import fixtures
+
+class TestShards(TestCase):
+    '''
+    Tests for parallel exports over shards of sms.db (see shards.py)
+    '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def __extract(self, backup_dir, name, **options):
+        output_path = os.path.join(self.tmp_dir.name, name)
+        row_count = extract_messages(backup_dir, output_path, 'US', **options)
+        rows = fixtures.read_csv_output(output_path)
+        self.assertEqual(len(rows), row_count)
+        return rows
+
+    def test_split_rowid_range(self):
+        self.assertEqual(shards.split_rowid_range((0, 10), 3), [(0, 3), (3, 6), (6, 10)])
+        self.assertEqual(shards.split_rowid_range((5, 7), 4), [(5, 6), (6, 7)])
+        self.assertEqual(shards.split_rowid_range((0, 0), 4), [(0, 0)])
+
+    def test_parallel_export_matches_sequential(self):
+        backup_dir = os.path.join(self.tmp_dir.name, 'backup')
+        synthetic.create_synthetic_backup(backup_dir, contacts=50, handles=40, messages=2000,
+                                          group_chats=5)
+        for options in [{}, {'chats': True}, {'timezone': 'UTC', 'date_format': '%d/%m/%Y'}]:
+            sequential = self.__extract(backup_dir, 'sequential.csv', **options)
+            self.assertGreater(len(sequential), 1000)
+            self.assertEqual(self.__extract(backup_dir, 'parallel.csv', query_workers=3,
+                                            **options),
+                             sequential)
+
+        # Filters are applied in every shard
+        filters = {'since': '2019-01-20', 'contacts': ['Baggins'], 'from_me': False}
+        sequential = self.__extract(backup_dir, 'sequential.csv', **filters)
+        self.assertGreater(len(sequential), 0)
+        self.assertEqual(self.__extract(backup_dir, 'parallel.csv', query_workers=3, **filters),
+                         sequential)
+
+    def test_parallel_export_with_attachments(self):
+        backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        fixtures.create_backup(backup_dir)
+        attachments_dir = os.path.join(self.tmp_dir.name, 'attachments')
+        sequential = self.__extract(backup_dir, 'sequential.csv', attachments_dir=attachments_dir)
+        self.assertEqual(self.__extract(backup_dir, 'parallel.csv', query_workers=2,
+                                        attachments_dir=attachments_dir),
+                         sequential)
+
+    def test_parallel_export_needs_python_engine(self):
+        backup_dir = os.path.join(self.tmp_dir.name, '9504c9835a9fcd2da71a23b42cd4e7c971a23842')
+        fixtures.create_backup(backup_dir)
+        with self.assertRaises(ValueError):
+            extract_messages(backup_dir, os.path.join(self.tmp_dir.name, 'messages.csv'), 'US',
+                             engine='sql', query_workers=2)
+
+if __name__ == '__main__':
+    main()
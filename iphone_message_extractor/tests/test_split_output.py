@@ -0,0 +1,184 @@
+import csv
+import gzip
+import hashlib
+import os
+import tempfile
+from unittest import TestCase, main
+
+from iphone_message_extractor import split_output, synthetic
+from iphone_message_extractor.message_extractor import extract_messages
+from iphone_message_extractor.progress import ProgressReporter, ExportCancelled
+from . import fixtures
+
+class TestSplitOutput(TestCase):
+    '''
+    Tests for exports split into parts with a manifest (see split_output.py)
+    '''
+
+    @classmethod
+    def setUpClass(klass):
+        klass.backup_tmp_dir = tempfile.TemporaryDirectory()
+        klass.backup_dir = os.path.join(klass.backup_tmp_dir.name, 'backup')
+        synthetic.create_synthetic_backup(klass.backup_dir, contacts=50, handles=40,
+                                          messages=3000, group_chats=5)
+
+    @classmethod
+    def tearDownClass(klass):
+        klass.backup_tmp_dir.cleanup()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_path = os.path.join(self.tmp_dir.name, 'messages.csv')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def __extract(self, output_path=None, **options):
+        return extract_messages(TestSplitOutput.backup_dir, output_path or self.output_path, 'US',
+                                **options)
+
+    def __read_parts(self, manifest):
+        ''' Reads the rows of every part in a manifest, checking each one against it '''
+        rows = []
+        for part in manifest['parts']:
+            path = os.path.join(self.tmp_dir.name, part['path'])
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            self.assertEqual(len(data), part['bytes'])
+            self.assertEqual(hashlib.sha256(data).hexdigest(), part['sha256'])
+            if path.endswith('.gz'):
+                data = gzip.decompress(data)
+            part_rows = list(csv.reader(data.decode('utf-8-sig').splitlines()))
+            self.assertEqual(part_rows[0][:3], ['Last Name', 'First Name', 'Phone #'])
+            self.assertEqual(len(part_rows) - 1, part['rows'])
+            rows.extend(part_rows[1:])
+        self.assertEqual(len(rows), manifest['rows'])
+        return rows
+
+    def test_split_by_rows(self):
+        expected = fixtures.read_csv_output(self.output_path) if self.__extract() else None
+        row_count = self.__extract(split_rows=700, compression='gzip')
+        manifest = split_output.load_manifest(self.output_path)
+        self.assertTrue(manifest['complete'])
+        self.assertEqual([part['path'] for part in manifest['parts'][:2]],
+                         ['messages.00001.csv.gz', 'messages.00002.csv.gz'])
+        self.assertEqual([part['rows'] for part in manifest['parts'][:-1]],
+                         [700] * (len(manifest['parts']) - 1))
+        self.assertEqual(self.__read_parts(manifest), expected)
+        self.assertEqual(row_count, len(expected))
+
+    def test_split_by_bytes(self):
+        self.__extract(split_bytes=50000)
+        manifest = split_output.load_manifest(self.output_path)
+        self.assertGreater(len(manifest['parts']), 2)
+        for part in manifest['parts']:
+            self.assertEqual(part['bytes'], part['csv_bytes'])
+            # Sizes are checked every SplitMessageWriter.ROWS_PER_CHECK rows
+            self.assertLess(part['csv_bytes'], 50000 + 200000)
+        self.__read_parts(manifest)
+
+    def test_split_by_contact_and_month(self):
+        self.__extract(chats=True)
+        expected = fixtures.read_csv_output(self.output_path)
+        self.__extract(chats=True, split_by='contact')
+        manifest = split_output.load_manifest(self.output_path)
+        keys = [part['key'] for part in manifest['parts']]
+        self.assertEqual(len(keys), len(set(row[7] for row in expected)))
+        self.assertEqual(self.__read_parts(manifest), expected)
+
+        self.__extract(chats=True, split_by='month', split_rows=50)
+        manifest = split_output.load_manifest(self.output_path)
+        for part in manifest['parts']:
+            self.assertLessEqual(part['rows'], 50)
+        rows = self.__read_parts(manifest)
+        self.assertEqual(sorted(rows), sorted(expected))
+        for part in manifest['parts']:
+            self.assertTrue(part['path'].startswith('messages.' + part['key']))
+        # Every month's messages are in its own parts
+        months = set()
+        for part in manifest['parts']:
+            path = os.path.join(self.tmp_dir.name, part['path'])
+            self.assertEqual(set(row[3][:7] for row in fixtures.read_csv_output(path)),
+                             {part['key']})
+            months.add(part['key'])
+        self.assertEqual(months, set(row[3][:7] for row in expected))
+
+    def test_resume(self):
+        self.__extract()
+        expected = fixtures.read_csv_output(self.output_path)
+
+        # Interrupted part way through
+        def cancel(event):
+            if event.rows >= 1500:
+                reporter.cancel()
+        reporter = ProgressReporter(cancel)
+        with self.assertRaises(ExportCancelled):
+            self.__extract(split_rows=400, compression='gzip', batch_size=100,
+                           progress=reporter)
+        manifest = split_output.load_manifest(self.output_path)
+        self.assertFalse(manifest['complete'])
+        # Up to the last full part before it noticed (at 1600 rows)
+        self.assertEqual(manifest['rows'], 1600)
+        first_part = os.path.join(self.tmp_dir.name, manifest['parts'][0]['path'])
+        first_part_mtime = os.stat(first_part).st_mtime_ns
+
+        # Picked up after the last complete part
+        self.assertEqual(self.__extract(split_rows=400, compression='gzip', resume=True),
+                         len(expected))
+        manifest = split_output.load_manifest(self.output_path)
+        self.assertTrue(manifest['complete'])
+        self.assertEqual(self.__read_parts(manifest), expected)
+        self.assertEqual(os.stat(first_part).st_mtime_ns, first_part_mtime)
+
+        # Different settings start over (and clear out the old parts)
+        self.__extract(split_rows=1000, resume=True)
+        manifest = split_output.load_manifest(self.output_path)
+        self.assertEqual(self.__read_parts(manifest), expected)
+        self.assertFalse(os.path.exists(first_part))
+
+    def test_resume_by_month(self):
+        self.__extract()
+        expected = fixtures.read_csv_output(self.output_path)
+        def cancel(event):
+            if event.rows >= 1000:
+                reporter.cancel()
+        reporter = ProgressReporter(cancel)
+        with self.assertRaises(ExportCancelled):
+            self.__extract(split_by='month', compression='gzip', batch_size=100,
+                           progress=reporter)
+        self.__extract(split_by='month', compression='gzip', resume=True)
+        manifest = split_output.load_manifest(self.output_path)
+        self.assertEqual(sorted(self.__read_parts(manifest)), sorted(expected))
+
+        # Interrupted while the months were being written out: only the months that weren't
+        # done get written again
+        last_part = manifest['parts'].pop()
+        split_output.save_manifest(self.output_path, manifest['settings'],
+                                   manifest['rows'] - last_part['rows'], manifest['parts'])
+        first_part = os.path.join(self.tmp_dir.name, manifest['parts'][0]['path'])
+        first_part_mtime = os.stat(first_part).st_mtime_ns
+        self.__extract(split_by='month', compression='gzip', resume=True)
+        manifest = split_output.load_manifest(self.output_path)
+        self.assertEqual(manifest['parts'][-1], last_part)
+        self.assertEqual(sorted(self.__read_parts(manifest)), sorted(expected))
+        self.assertEqual(os.stat(first_part).st_mtime_ns, first_part_mtime)
+
+    def test_split_needs_csv(self):
+        with self.assertRaises(ValueError):
+            self.__extract(output_format='sqlite', split_rows=100)
+        with self.assertRaises(ValueError):
+            self.__extract(resume=True)
+
+    def test_split_key(self):
+        header_row = ['Last Name', 'First Name', 'Phone #', 'Date & Time']
+        row = ['', '', '+1 212-555-1212', '19/12/2011']
+        self.assertIsNone(split_output.split_key(header_row, None))
+        self.assertEqual(split_output.split_key(header_row, 'contact')(row), '+1 212-555-1212')
+        self.assertEqual(split_output.split_key(header_row, 'month', '%d/%m/%Y')(row), '2011-12')
+        self.assertEqual(split_output.split_key(header_row, 'month')(['', '', '', '']),
+                         split_output.NO_MONTH)
+        self.assertEqual(split_output.part_path('/tmp/messages.csv', '00001', 'xz'),
+                         '/tmp/messages.00001.csv.xz')
+
+if __name__ == '__main__':
+    main()
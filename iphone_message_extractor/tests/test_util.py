@@ -1,5 +1,6 @@
 import os
-from unittest import TestCase, main
+from datetime import datetime
+from unittest import TestCase, main, mock
 
 from iphone_message_extractor import util
 
@@ -33,10 +34,122 @@ class TestUtil(TestCase):
         for phone_tuple in good_phones:
             self.assertEqual(util.normalize_phone(phone_tuple[0]), phone_tuple[1])
         
+    def test_cached_normalize_contact_value(self):
+        util.normalize_cache_clear()
+        for _ in range(3):
+            self.assertEqual(util.cached_normalize_contact_value('(415) 555-1212'),
+                             '+1 415-555-1212')
+        # the cache is keyed on the assumed country as well as the value
+        self.assertEqual(util.cached_normalize_contact_value('020 7946 0018', 'GB'),
+                         '+44 20 7946 0018')
+        cache_info = util.normalize_cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses), (2, 2))
+
+    def test_canonical_numbers_skip_phonenumbers(self):
+        util.normalize_cache_clear()
+        self.assertEqual(util.normalize_phone('(415) 555-1212'), '+1 415-555-1212')
+        # Both the INTERNATIONAL and E.164 forms of a number that has been seen are canonical
+        with mock.patch.object(util.phonenumbers, 'parse') as parse:
+            self.assertEqual(util.normalize_phone('+1 415-555-1212'), '+1 415-555-1212')
+            self.assertEqual(util.normalize_phone('+14155551212'), '+1 415-555-1212')
+            self.assertEqual(parse.call_count, 0)
+
+    def test_normalize_contact_values(self):
+        util.normalize_cache_clear()
+        values = ['(415) 555-1212', 'mailto:frodo@shire.net', '415.555.1212', '(415) 555-1212']
+        self.assertEqual(util.normalize_contact_values(values),
+                         ['+1 415-555-1212', 'frodo@shire.net', '+1 415-555-1212',
+                          '+1 415-555-1212'])
+        # Each distinct value is only normalized once
+        self.assertEqual(util.normalize_cache_info().misses, 3)
+
+    def test_normalize_warnings_are_deduplicated(self):
+        util.report_normalize_warnings()
+        with mock.patch('builtins.print') as mock_print:
+            for _ in range(3):
+                self.assertIsNone(util.normalize_contact_value('http://www.apple.com'))
+            self.assertIsNone(util.normalize_phone('+'))
+            mock_print.assert_not_called()
+            self.assertEqual(util.report_normalize_warnings(), 4)
+            self.assertEqual(mock_print.call_count, 3)
+            self.assertIn('(x3)', mock_print.call_args_list[1][0][0])
+            # Reported warnings are cleared
+            self.assertEqual(util.report_normalize_warnings(), 0)
+
+    def test_normalization_context_fallback_regions(self):
+        util.normalize_cache_clear()
+        context = util.NormalizationContext('US', ['GB'])
+        self.assertEqual(util.normalize_phone('(415) 555-1212', context), '+1 415-555-1212')
+        # Not a valid US number, but a valid UK one
+        self.assertEqual(util.normalize_phone('020 7946 0018', context), '+44 20 7946 0018')
+        # Without fallbacks the assumed country is all there is
+        self.assertIsNone(util.normalize_phone('020 7946 0019', 'US'))
+        self.assertEqual(util.normalize_contact_values(['020 7946 0018', 'frodo@shire.net'],
+                                                       context),
+                         ['+44 20 7946 0018', 'frodo@shire.net'])
+
+    def test_normalization_context_caches_region_by_prefix(self):
+        util.normalize_cache_clear()
+        context = util.NormalizationContext('US', ['FR', 'GB'])
+        self.assertEqual(util.normalize_phone('020 7946 0018', context), '+44 20 7946 0018')
+        self.assertEqual(context.prefix_regions, {('020', 11): 'GB'})
+        # A number like it goes straight to the region that worked
+        with mock.patch.object(util.phonenumbers, 'parse', wraps=util.phonenumbers.parse) as parse:
+            self.assertEqual(util.normalize_phone('020 7946 0123', context), '+44 20 7946 0123')
+            self.assertEqual(parse.call_count, 1)
+        # Contexts with the same regions are interchangeable (e.g. as cache keys)
+        self.assertEqual(context, util.NormalizationContext('US', ['FR', 'GB']))
+        self.assertNotEqual(context, util.NormalizationContext('US', ['GB', 'FR']))
+        self.assertIs(util.get_normalization_context(context), context)
+        self.assertIs(util.get_normalization_context('GB'), util.get_normalization_context('GB'))
+
+    def test_date_converter(self):
+        # nanoseconds (newer iOS), seconds (older iOS), sub-second precision and no date at all
+        apple_dates = [345988810000000000, 345988810, 345988810999999999, None]
+        utc = util.get_timezone('UTC')
+        expected = ['2011-12-19 12:00:10', '2011-12-19 12:00:10', '2011-12-19 12:00:10', '']
+        self.assertEqual(util.DateConverter(utc, use_numpy=False).convert(apple_dates), expected)
+        if util.np is not None:
+            self.assertEqual(util.DateConverter(utc).convert(apple_dates), expected)
+        self.assertEqual(util.DateConverter(utc, '%d/%m/%Y %H:%M').convert(apple_dates),
+                         ['19/12/2011 12:00', '19/12/2011 12:00', '19/12/2011 12:00', ''])
+
+    def test_date_converter_matches_datetime(self):
+        # Every 7 hours or so over a couple of years, across DST changes
+        apple_dates = [345988810 + i * 25013 for i in range(3000)]
+        tz = util.get_timezone('America/New_York')
+        expected = [datetime.fromtimestamp(util.apple_date_to_timestamp(apple_date), tz)
+                    .strftime(util.DEFAULT_DATE_FORMAT) for apple_date in apple_dates]
+        for use_numpy in (False, True):
+            self.assertEqual(util.DateConverter(tz, use_numpy=use_numpy).convert(apple_dates),
+                             expected)
+
     def test_normalize_phone_invalid_nums(self):
         bad_phones = ['1 (650) 555-1212,626626262#', '34 98 72', '415 555 121', '21']
         for num in bad_phones:
             self.assertEqual(util.normalize_phone(num), None)  
+
+    def test_parse_date_bound(self):
+        utc = util.get_timezone('UTC')
+        self.assertEqual(util.parse_date_bound('2011-12-19', utc), 1324252800)
+        self.assertEqual(util.parse_date_bound('2011-12-19', utc, end=True), 1324339200)
+        self.assertEqual(util.parse_date_bound('2011-12-19 12:00:10', utc), 1324296010)
+        self.assertEqual(util.parse_date_bound('2011-12-19 12:00:10', utc, end=True), 1324296011)
+        # A whole day in local time, however long it is
+        new_york = util.get_timezone('America/New_York')
+        self.assertEqual(util.parse_date_bound('2019-03-10', new_york, end=True) -
+                         util.parse_date_bound('2019-03-10', new_york), 23 * 3600)
+        for date in ['', '19/12/2011', '2011-12-19T12:00:10', '2011-13-01']:
+            with self.assertRaises(ValueError):
+                util.parse_date_bound(date)
+
+    def test_parse_size(self):
+        self.assertEqual(util.parse_size('1000'), 1000)
+        self.assertEqual(util.parse_size('500M'), 500 * 1024 * 1024)
+        self.assertEqual(util.parse_size('2gb'), 2 * 1024 ** 3)
+        for size in ['', 'M', '1.5G', '10T']:
+            with self.assertRaises(ValueError):
+                util.parse_size(size)
     
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,28 +1,97 @@
 import os, platform, re
-from datetime import datetime, date
+from collections import Counter
+from datetime import datetime, date, timedelta, timezone
 import time
+from functools import lru_cache
 import phonenumbers
 from os.path import expanduser
 
-PROBABLE_PHONE_RE = re.compile(r"(tel:)?[\+\(\)\-\. 0-9]+")
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+# Classifies a contact value in one pass: anything with an @ is an e-mail, anything starting like
+# a phone number is a phone number (and anything else is junk, e.g. a URL)
+CONTACT_VALUE_SCANNER = re.compile(r"(?P<email>[^@]*@)|(?P<phone>(?:tel:)?[+()\-. 0-9])")
+NON_PHONE_CHARS_RE = re.compile(r"[^+0-9]+")
+
+# Max number of distinct (value, country) pairs kept by cached_normalize_contact_value. Backups
+# typically have a few thousand distinct handles/address book values, so this is plenty
+NORMALIZE_CACHE_SIZE = 65536
+
+# Numbers already produced by phonenumbers, by their INTERNATIONAL and E.164 forms, so values
+# that are already canonical (e.g. '+12125551212' in handle.id once '+1 212-555-1212' has been
+# seen in the address book) skip phonenumbers entirely. Canonical forms don't depend on the
+# assumed country, so this is shared across all of them
+CANONICAL_PHONES = {}
+
+# Problems with contact values seen so far (message: count), reported once by
+# report_normalize_warnings rather than printed for every row
+NORMALIZE_WARNINGS = Counter()
 
 def hash_to_path(hash):
     """ iTunes stores backup files in a dir that matches the first 2 chars of the hash; this
     generates this path (e.g. 3d0d7bcef8... -> /3d/3d0d7bcef8...) """
     return os.path.join(hash[:2], hash)
     
-def normalize_contact_value(val):
+def normalize_contact_value(val, assumed_country_code='US'):
     """ Detect whether something is likely an e-mail or phone number and then normalize it """
-    probable_phone_re = re.compile(r"(tel:)?[\+\(\)\-\. 0-9]+")
-    
-    if '@' in val:
-        return normalize_email(val)
-    elif re.match(PROBABLE_PHONE_RE, val):
-        return normalize_phone(val)
-    else:
-    # this is either a URL, or name or something we can't use (e.g. partner shows up here)
-        print("Warning: couldn't make sense of '{}' as a phone number or e-mail".format(val))
+    match = CONTACT_VALUE_SCANNER.match(val)
+    if match is None:
+        # this is either a URL, or name or something we can't use (e.g. partner shows up here)
+        NORMALIZE_WARNINGS["couldn't make sense of '{}' as a phone number or e-mail".format(
+            val)] += 1
         return None
+    elif match.lastgroup == 'email':
+        return normalize_email(val)
+    return normalize_phone(val, assumed_country_code)
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def cached_normalize_contact_value(val, assumed_country_code='US'):
+    """ Memoized (bounded LRU) version of normalize_contact_value keyed on the raw value and the
+    assumed country. Phone parsing is by far the most expensive part of an export, and the same
+    handles/address book values come up over and over, so both AddressDB and MessageDB go
+    through this. See normalize_cache_info() for hit/miss stats """
+    return normalize_contact_value(val, assumed_country_code)
+
+def normalize_cache_info():
+    """ Hit/miss stats for cached_normalize_contact_value (a functools CacheInfo named tuple) """
+    return cached_normalize_contact_value.cache_info()
+
+def normalize_cache_clear():
+    """ Empties the normalization cache and resets its stats """
+    cached_normalize_contact_value.cache_clear()
+    CANONICAL_PHONES.clear()
+
+def normalize_contact_values(vals, assumed_country_code='US'):
+    """ Normalizes a whole list of values in one go; each distinct value is only normalized once
+    (and only if it isn't already in the cache)
+    @return: a list of normalized values in the same order as vals
+    """
+    normalized = dict((val, cached_normalize_contact_value(val, assumed_country_code))
+                      for val in set(vals))
+    return [normalized[val] for val in vals]
+
+def report_normalize_warnings(max_examples=10):
+    """ Prints a summary of the contact values that couldn't be normalized since the last report
+    (each distinct problem once, with how often it came up) and resets the warnings
+    @return: the total number of warnings
+    """
+    total = sum(NORMALIZE_WARNINGS.values())
+    if total:
+        print("Warning: {} contact value(s) couldn't be normalized ({} distinct):".format(
+            total, len(NORMALIZE_WARNINGS)))
+        for message, count in NORMALIZE_WARNINGS.most_common(max_examples):
+            print("  {}{}".format(message, '' if count == 1 else ' (x{})'.format(count)))
+        if len(NORMALIZE_WARNINGS) > max_examples:
+            print("  ...and {} more".format(len(NORMALIZE_WARNINGS) - max_examples))
+        NORMALIZE_WARNINGS.clear()
+    return total
 
 def normalize_email(email):
     """ Strip mailto: from e-mails (don't know why this is sometimes present...) """
@@ -31,38 +100,299 @@ def normalize_email(email):
 def normalize_phone(orig_phone_num, assumed_country_code='US'):
     """ Remove all non-numeric values (or +) and standardize per the Google phone numbers library
     @param orig_phone: Guess :p
-    @param assumed_country_code: The country code to apply when # is lacking one (your home country)
+    @param assumed_country_code: The country code to apply when # is lacking one (your home
+    country), or a NormalizationContext
     @return: a number in standard international/E164 format (e.g. +1 212 555 1212)
     """
-    phone = re.sub(r"(^ +)|( +$)|(^tel:)", "", re.sub(r"[^\+0-9]+", " ", orig_phone_num))
+    canonical = CANONICAL_PHONES.get(orig_phone_num)
+    if canonical is not None:
+        return canonical
+    phone = NON_PHONE_CHARS_RE.sub(' ', orig_phone_num).strip()
     # Use the python port of Google's libphonenumber library to parse
-    # and standardize/canonicalize international phone numbers
+    # and standardize/canonicalize international phone numbers. Only numbers without a country
+    # code need the assumed country
     try:
-        return parse_phone_number(phone)
+        if phone.startswith('+'):
+            return parse_phone_number(phone)
+        return get_normalization_context(assumed_country_code).parse_phone_number(phone)
     except phonenumbers.phonenumberutil.NumberParseException:
-        try:
-            # Try again making the explicit assumption of a US number
-            return parse_phone_number(phone, assumed_country_code)
-        except phonenumbers.phonenumberutil.NumberParseException:
-            print('Warning: unparseable number encountered: {}'.format(orig_phone_num))
+        NORMALIZE_WARNINGS['unparseable number encountered: {}'.format(orig_phone_num)] += 1
     return None
     
 def parse_phone_number(phone, region=None):
     """ Helper method that takes a striped phone # and sends it through the phonenumbers lib """
     parsed_num = phonenumbers.parse(phone, region)
     if phonenumbers.is_possible_number(parsed_num):
-        return phonenumbers.format_number(parsed_num, phonenumbers.PhoneNumberFormat.INTERNATIONAL)
+        return format_phone_number(parsed_num)
     return None
-    
+
+def format_phone_number(parsed_num):
+    """ Formats a parsed number in INTERNATIONAL format, remembering it as canonical (see
+    CANONICAL_PHONES) """
+    canonical = phonenumbers.format_number(parsed_num, phonenumbers.PhoneNumberFormat.INTERNATIONAL)
+    if len(CANONICAL_PHONES) < NORMALIZE_CACHE_SIZE:
+        CANONICAL_PHONES[canonical] = canonical
+        CANONICAL_PHONES[phonenumbers.format_number(
+            parsed_num, phonenumbers.PhoneNumberFormat.E164)] = canonical
+    return canonical
+
+# Shared NormalizationContexts for plain country codes (see get_normalization_context)
+_normalization_contexts = {}
+
+def get_normalization_context(assumed_country_code='US'):
+    """ The NormalizationContext for a country code (the same one every time, so its prefix
+    cache is shared), or assumed_country_code itself if it already is one """
+    if isinstance(assumed_country_code, NormalizationContext):
+        return assumed_country_code
+    context = _normalization_contexts.get(assumed_country_code)
+    if context is None:
+        context = _normalization_contexts.setdefault(assumed_country_code,
+                                                     NormalizationContext(assumed_country_code))
+    return context
+
+
+class NormalizationContext():
+    """ How phone numbers without a country code are read: as numbers from region, or if they
+    aren't valid there, from the first of fallback_regions they are valid in (e.g. a UK number in
+    the address book of a US phone). Which region a number was valid in is remembered by its
+    leading digits and length, so later numbers like it are parsed once, in that region, rather
+    than tried against every region in turn. Can be passed anywhere a country code is taken
+    (e.g. to AddressDB and MessageDB); contexts with the same regions are equal, so they share
+    entries in the normalization cache
+    """
+
+    # How many leading digits (plus the number's length) the region that worked is cached by
+    PREFIX_LENGTH = 3
+
+    def __init__(self, region='US', fallback_regions=None):
+        """
+        @param region: two-letter country code to assume when numbers lack one
+        @param fallback_regions: two-letter country codes to try, in order, for numbers that
+        aren't valid in region (default=None, just region)
+        """
+        self.region = region
+        self.regions = (region,) + tuple(fallback_region for fallback_region
+                                         in fallback_regions or () if fallback_region != region)
+        # (leading digits, number of digits): the region numbers like that are valid in
+        self.prefix_regions = {}
+
+    def parse_phone_number(self, phone):
+        """ Parses a stripped phone # without a country code
+        @return: the number in INTERNATIONAL format, or None if it isn't a possible number
+        """
+        if len(self.regions) == 1:
+            return parse_phone_number(phone, self.region)
+        digits = phone.replace(' ', '')
+        prefix = (digits[:NormalizationContext.PREFIX_LENGTH], len(digits))
+        region = self.prefix_regions.get(prefix)
+        if region is not None:
+            return parse_phone_number(phone, region)
+        for region in self.regions:
+            parsed_num = phonenumbers.parse(phone, region)
+            if phonenumbers.is_valid_number(parsed_num):
+                self.prefix_regions[prefix] = region
+                return format_phone_number(parsed_num)
+        # Not valid anywhere, so go with whatever is possible in the assumed region
+        return parse_phone_number(phone, self.region)
+
+    def __eq__(self, other):
+        return isinstance(other, NormalizationContext) and self.regions == other.regions
+
+    def __hash__(self):
+        return hash(self.regions)
+
+    def __repr__(self):
+        return 'NormalizationContext({!r}, {!r})'.format(self.region, list(self.regions[1:]))
+
 def convert_timestamp_to_date(ts):
     """ Unix timestamp (1970, from Apple time from not 2001) to string representation of date """
     return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
         
+# Apple dates count from 2001-01-01 instead of 1970-01-01
+APPLE_EPOCH_OFFSET = 978307200
+
+# Older iOS versions store message.date in seconds, newer ones in nanoseconds. A date in seconds
+# stays below this for the next ~3000 years, and one in nanoseconds is above it for any date
+# after 2001-01-01 00:01:40
+NANOSECOND_DATE_THRESHOLD = 10 ** 11
+
+DEFAULT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def apple_date_to_timestamp(apple_date):
+    """ Converts a message.date (seconds or nanoseconds since 2001) to a (fractional) Unix
+    timestamp, or None if there's no date """
+    if apple_date is None:
+        return None
+    if apple_date > NANOSECOND_DATE_THRESHOLD:
+        apple_date = apple_date / 1e9
+    return apple_date + APPLE_EPOCH_OFFSET
+
+def apple_date_to_seconds(apple_date):
+    """ Like apple_date_to_timestamp but rounded down to whole seconds, using integer arithmetic
+    so that nanoseconds just short of the next second aren't rounded up into it """
+    if apple_date is None:
+        return None
+    if apple_date > NANOSECOND_DATE_THRESHOLD:
+        return int(apple_date) // 1000000000 + APPLE_EPOCH_OFFSET
+    return int(apple_date // 1) + APPLE_EPOCH_OFFSET
+
+def apple_date_to_microseconds(apple_date):
+    """ Converts a message.date to whole microseconds since 1970-01-01 UTC (e.g. for Arrow
+    timestamps), using integer arithmetic so nanosecond dates keep their precision """
+    if apple_date is None:
+        return None
+    if apple_date > NANOSECOND_DATE_THRESHOLD:
+        return int(apple_date) // 1000 + APPLE_EPOCH_OFFSET * 1000000
+    return int(apple_date * 1000000) + APPLE_EPOCH_OFFSET * 1000000
+
+def get_timezone(name):
+    """ Looks up a timezone for date conversion by name (e.g. 'UTC', 'Europe/London'); None means
+    the local timezone """
+    if name is None:
+        return None
+    if name.upper() == 'UTC':
+        return timezone.utc
+    if ZoneInfo is None:
+        raise ValueError('Named timezones need Python 3.9+ (zoneinfo); use UTC or local time')
+    return ZoneInfo(name)
+
+def parse_date_bound(text, tz=None, end=False):
+    """ Parses a date ('YYYY-MM-DD') or date and time ('YYYY-MM-DD HH:MM:SS'), e.g. from the
+    command line, in the timezone dates are shown in
+    @param tz: a tzinfo (default=None, the local timezone)
+    @param end: if True, the bound just after it instead (the next day for a date, the next
+    second for a date and time), so that an 'until' takes in the whole of it
+    @return: a Unix timestamp (in whole seconds)
+    @raise ValueError: if it isn't a date
+    """
+    for date_format, length in (('%Y-%m-%d %H:%M:%S', timedelta(seconds=1)),
+                                ('%Y-%m-%d', timedelta(days=1))):
+        try:
+            parsed = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        if end:
+            parsed += length
+        if tz is not None:
+            parsed = parsed.replace(tzinfo=tz)
+        return int(parsed.timestamp())
+    raise ValueError('Invalid date: {}'.format(text))
+
+class DateConverter():
+    """ Converts whole batches of message.date values to formatted strings. With NumPy installed
+    and the default format, a batch is converted in a handful of vectorized operations (timezone
+    offsets are only looked up once per 15 minutes of timestamps, which all real-world DST
+    transitions line up with). Otherwise each value is formatted in Python, but with the
+    'YYYY-MM-DD HH:MM:' prefix cached per minute so strftime only runs once a minute's worth of
+    messages rather than for every message
+    """
+
+    # Max number of cached prefixes/offsets before the caches are reset
+    MAX_CACHE_SIZE = 100000
+    OFFSET_BUCKET_SECONDS = 900
+
+    def __init__(self, tz=None, date_format=DEFAULT_DATE_FORMAT, use_numpy=True):
+        """
+        @param tz: a tzinfo to convert to (default=None, the local timezone)
+        @param date_format: a strftime format (default='%Y-%m-%d %H:%M:%S'), or None to leave
+        dates unformatted as microseconds since 1970-01-01 UTC (see apple_date_to_microseconds)
+        @param use_numpy: use NumPy when it's installed (only for the default format)
+        """
+        self.tz = tz
+        self.date_format = date_format
+        self.use_numpy = use_numpy and np is not None and date_format == DEFAULT_DATE_FORMAT
+        self.prefixes = {}
+        self.offsets = {}
+
+    def convert(self, apple_dates):
+        """ Converts a batch (list) of message.date values
+        @return: a list of formatted dates ('' where there's no date)
+        """
+        if self.date_format is None:
+            return [apple_date_to_microseconds(apple_date) for apple_date in apple_dates]
+        if self.use_numpy:
+            return self.__convert_numpy(apple_dates)
+        return [self.__format(apple_date_to_seconds(apple_date)) for apple_date in apple_dates]
+
+    def __datetime(self, timestamp):
+        return datetime.fromtimestamp(timestamp, self.tz)
+
+    def __format(self, seconds):
+        if seconds is None:
+            return ''
+        if self.date_format != DEFAULT_DATE_FORMAT:
+            return self.__datetime(seconds).strftime(self.date_format)
+        minute, second = divmod(seconds, 60)
+        prefix = self.prefixes.get(minute)
+        if prefix is None:
+            if len(self.prefixes) >= DateConverter.MAX_CACHE_SIZE:
+                self.prefixes.clear()
+            prefix = self.prefixes[minute] = self.__datetime(minute * 60).strftime(
+                '%Y-%m-%d %H:%M:')
+        return '{}{:02d}'.format(prefix, second)
+
+    def __offset(self, bucket):
+        offset = self.offsets.get(bucket)
+        if offset is None:
+            if len(self.offsets) >= DateConverter.MAX_CACHE_SIZE:
+                self.offsets.clear()
+            if self.tz is None:
+                offset = datetime.fromtimestamp(bucket * DateConverter.OFFSET_BUCKET_SECONDS) \
+                    .astimezone().utcoffset().total_seconds()
+            else:
+                offset = self.__datetime(bucket * DateConverter.OFFSET_BUCKET_SECONDS) \
+                    .utcoffset().total_seconds()
+            self.offsets[bucket] = offset
+        return offset
+
+    def __convert_numpy(self, apple_dates):
+        if not apple_dates:
+            return []
+        # int64 rather than float64, which can't hold nanosecond dates exactly
+        missing = np.array([d is None for d in apple_dates])
+        dates = np.array([0 if d is None else int(d // 1) for d in apple_dates], dtype=np.int64)
+        seconds = np.where(dates > NANOSECOND_DATE_THRESHOLD, dates // 1000000000, dates) + \
+            APPLE_EPOCH_OFFSET
+
+        buckets = seconds // DateConverter.OFFSET_BUCKET_SECONDS
+        unique_buckets, inverse = np.unique(buckets, return_inverse=True)
+        offsets = np.array([self.__offset(int(bucket)) for bucket in unique_buckets],
+                           dtype=np.int64)[inverse.reshape(-1)]
+        formatted = np.datetime_as_string((seconds + offsets).astype('datetime64[s]'), unit='s')
+        formatted = np.char.replace(formatted, 'T', ' ').tolist()
+        if missing.any():
+            for i in np.flatnonzero(missing).tolist():
+                formatted[i] = ''
+        return formatted
+
+# Multipliers of the suffixes parse_size takes
+SIZE_SUFFIXES = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def parse_size(size):
+    """ Parses a size like '500M' or '2G' (or a plain number of bytes)
+    @return: the number of bytes
+    @raise ValueError: if it isn't a size
+    """
+    match = re.match(r"^\s*(\d+)\s*([KMG]?)B?\s*$", size, re.IGNORECASE)
+    if match is None:
+        raise ValueError('Invalid size: {}'.format(size))
+    return int(match.group(1)) * SIZE_SUFFIXES[match.group(2).upper()]
+
+def get_cache_dir():
+    """ Returns the directory the extractor keeps its caches in (e.g. resolved Manifest.db
+    lookups), following XDG_CACHE_HOME where it's set """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(expanduser("~"), ".cache")
+    return os.path.join(cache_home, "iphone_message_extractor")
+
 def get_backup_dir():
     """ Returns the default backup directory for macOS or Windows """
     home_path = expanduser("~")
     if platform.system() == 'Darwin':
         return os.path.join(home_path, "Library/Application Support/MobileSync/Backup")
     elif platform.system() == 'Windows':
+        # iTunes from the Microsoft Store keeps them in the user's home directory instead
+        store_path = os.path.join(home_path, "Apple\\MobileSync\\Backup\\")
+        if os.path.isdir(store_path):
+            return store_path
         return os.path.join(home_path, "AppData\\Roaming\\Apple Computer\\MobileSync\\Backup\\")
     return None
\ No newline at end of file